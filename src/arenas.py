@@ -0,0 +1,53 @@
+'''
+Arenas hosted by one Communication Broker
+Each arena is an independent GA session (its own robots, target image,
+matchmaking and result; see communication_broker.Arena). A connection is
+routed to its arena by IP when only one arena has that IP configured;
+otherwise (several simulated sessions on the same loopback addresses, say)
+the client names its arena in its HELLO, which needs the framed format.
+'''
+
+import threading
+
+DEFAULT = "default" # Name of the arena set up from -i/-f
+
+
+class ArenaRegistry(object):
+
+    def __init__(self):
+        self.by_name = {}
+        self.by_ip = {} # ip -> arenas that have it configured
+        self.lock = threading.Lock()
+
+    def add(self, arena):
+
+        with self.lock:
+            if arena.name in self.by_name:
+                raise ValueError("arena {} already exists".format(arena.name))
+            self.by_name[arena.name] = arena
+            for color in arena.myRIOs:
+                self.by_ip.setdefault(arena.myRIOs[color].ip, []).append(arena)
+
+    # Arenas a connection from ip may belong to
+    def for_address(self, ip):
+        return self.by_ip.get(ip, ())
+
+    # Arena named name, or None
+    def get(self, name):
+        return self.by_name.get(name)
+
+    # Have all the arenas got their result?
+    def all_done(self):
+        return all(arena.DONE for arena in list(self.by_name.values()))
+
+    def __getitem__(self, name):
+        return self.by_name[name]
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __iter__(self):
+        return iter(list(self.by_name.values()))
+
+    def __len__(self):
+        return len(self.by_name)
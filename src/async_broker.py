@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+'''
+asyncio engine for the Communication Broker (communication_broker.py --engine asyncio)
+Every connection is a coroutine on a single event loop instead of an OS thread;
+it drives the same RobotSession state machine as the threaded engine, awaiting
+each effect. The server mimics the socketserver API (server_address,
+serve_forever, shutdown, server_close, and ThreadedTCPServer's
+stop_accepting) so the two engines are interchangeable.
+'''
+
+import asyncio
+import threading
+import time
+
+import communication_broker as broker
+import connections
+import framing
+
+READ_SIZE = 65536 # Most we read from a stream at once
+
+
+'''
+An asyncio engine connection. Writes only ever happen on the event loop, so
+a push (or close) from another thread is handed over to it; transport writes
+never block, and the loop flushes every pushed D at once.
+'''
+class AsyncConnection(connections.Connection):
+
+    def __init__(self, color, loop, writer, frames, counters=None, recording=None):
+        super().__init__(color, frames, counters, recording)
+        self.loop = loop
+        self.writer = writer
+
+    def finish(self, kind, payload=b""):
+        if self.loop.is_running() and not self.in_loop():
+            self.loop.call_soon_threadsafe(super().finish, kind, payload)
+            return True
+        return super().finish(kind, payload)
+
+    def close(self):
+        if self.loop.is_running() and not self.in_loop():
+            self.loop.call_soon_threadsafe(super().close)
+        else:
+            super().close()
+
+    def in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def write(self, buffers):
+        self.writer.writelines(buffers)
+
+    def close_output(self):
+        if self.writer.can_write_eof():
+            self.writer.write_eof()
+
+    def abort(self):
+        self.writer.close()
+
+
+class AsyncTCPServer(object):
+
+    def __init__(self, server_address):
+
+        self.loop = asyncio.new_event_loop()
+        self.stopped = threading.Event()
+        self.stopped.set()
+        self.closing_waiter = None # self.closing (set by init_server) as an asyncio future, once a session waits
+
+        # Bind right away, like socketserver does, so server_address is known before serving
+        self.listener = self.loop.run_until_complete(
+            asyncio.start_server(self.handle, server_address[0] or None, server_address[1]))
+        self.server_address = self.listener.sockets[0].getsockname()[:2]
+
+    # Coroutine for one connection: drive its RobotSession
+    async def handle(self, reader, writer):
+
+        client_address = writer.get_extra_info('peername')[:2]
+        frames = framing.FrameReader()
+        recording = self.recorder.open(client_address) if self.recorder is not None else None
+        connection = AsyncConnection(None, self.loop, writer, frames, self.metrics.open(), recording)
+        self.connections.add(connection)
+        robot = broker.RobotSession(self, client_address, "task {}".format(self.thread_index), connection)
+        session = robot.run()
+        result = None
+
+        try:
+            while True:
+                try:
+                    effect = session.send(result)
+                except StopIteration:
+                    break
+
+                result = None
+                if isinstance(effect, broker.Recv):
+                    result = frames.next_frame()
+                    while result is None:
+                        data = await reader.read(READ_SIZE)
+                        if not data:
+                            break
+                        frames.feed(data)
+                        connection.count_read(len(data))
+                        result = frames.next_frame()
+                    if result is not None:
+                        connection.received(result)
+                elif isinstance(effect, broker.Send):
+                    connection.send(frames.encode(effect.kind, effect.payload), effect.kind, effect.payload)
+                    await writer.drain()
+                elif isinstance(effect, broker.SendCached):
+                    connection.send((robot.ARENA.replies.encoded(frames.mode, effect.kind),), effect.kind)
+                    await writer.drain()
+                elif isinstance(effect, broker.Wait):
+                    # asyncio.wait never cancels what it waits on, so the partner's shared future is left alone
+                    if self.closing_waiter is None:
+                        self.closing_waiter = asyncio.wrap_future(self.closing)
+                    started = time.perf_counter() if self.metrics.timing else None
+                    await asyncio.wait((asyncio.wrap_future(effect.future), self.closing_waiter), timeout=effect.timeout,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    result = effect.future.result() if effect.future.done() else None
+                    if started is not None:
+                        self.metrics.waiting.observe(time.perf_counter() - started, (robot.STATE,))
+        except framing.ProtocolError as err:
+            robot.log.warning('%s:%s protocol error: %s', client_address[0], client_address[1], str(err))
+        except ConnectionError:
+            pass
+        finally:
+            if recording is not None:
+                recording.close()
+            self.metrics.close(connection.counters)
+            self.connections.remove(connection)
+            writer.close()
+            robot.log.info('%s:%s disconnected', *client_address)
+
+    # Run the event loop until shutdown() is called
+    def serve_forever(self):
+
+        self.stopped.clear()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.listener.close()
+            self.loop.run_until_complete(self.listener.wait_closed())
+            self.stopped.set()
+
+    # Stop accepting connections (from any thread); the ones already open keep being served
+    def stop_accepting(self):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.listener.close)
+
+    # Stop serve_forever (from any thread) and wait for it to return
+    def shutdown(self):
+
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.stopped.wait()
+
+    # Release the event loop, once serve_forever has returned
+    def server_close(self):
+        if self.stopped.is_set() and not self.loop.is_closed():
+            self.loop.close()
@@ -0,0 +1,113 @@
+'''
+Background writers for the Communication Broker
+The snapshots (snapshots.py), the session recording (recording.py) and the
+generation histories (history.py) go to disk without holding up the robots:
+their owners queue() what is to be written and return, and a thread of its
+own writes it, a batch at a time. The queue is bounded, so a writer that
+falls behind drops what doesn't fit (and counts it) instead of taking the
+broker's memory.
+
+A writer never dies of a failed write: it counts the item as failed (the
+first failure is logged) and goes on with the next, so the queue keeps
+draining, and close() gives up after a timeout rather than hang the broker's
+stop on a writer stuck on its disk.
+'''
+
+import queue
+import threading
+
+import broker_logging
+
+CLOSE_TIMEOUT = 10.0 # Seconds close() waits to hand over the stop, then for the writer to finish
+
+
+'''
+A bounded queue drained by a writer thread. Subclasses implement write(item)
+(True once written, False if the item was no good: it counts as dropped), or
+write_batch(batch) to handle a whole batch at once; they set up what write()
+needs before calling __init__, which starts the thread.
+'''
+class BackgroundWriter(object):
+
+    def __init__(self, name, max_pending, batch_size):
+
+        self.name = name
+        self.batch_size = batch_size
+        self.pending = queue.Queue(max_pending)
+        self.written = 0
+        self.dropped = 0 # Didn't fit in the queue, or wasn't any good
+        self.failed = 0 # Raised while being written
+        self.lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Queue item to be written; False if it was dropped (the writer is behind)
+    def queue(self, item):
+
+        try:
+            self.pending.put_nowait(item)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+        return True
+
+    # Writer thread: write everything queued, a batch at a time, until close()
+    def run(self):
+
+        while True:
+            batch = [self.pending.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            if stop:
+                batch = batch[:batch.index(None)]
+            self.write_batch(batch)
+            if stop:
+                return
+
+    # Writer thread: write the items of a batch one by one
+    def write_batch(self, batch):
+
+        for item in batch:
+            try:
+                written = self.write(item)
+            except Exception as err:
+                self.write_failed(err)
+                continue
+
+            if written:
+                self.written += 1
+            else:
+                with self.lock:
+                    self.dropped += 1
+
+    def write(self, item):
+        raise NotImplementedError
+
+    # Writer thread: count a failed write, and log the first one
+    def write_failed(self, err, count=1):
+
+        with self.lock:
+            first = self.failed == 0
+            self.failed += count
+        if first:
+            broker_logging.log.warning("The %s writer could not write: %s", self.name, repr(err))
+
+    # Write what is still queued and stop the writer thread; False if it didn't finish within timeout seconds
+    def close(self, timeout=CLOSE_TIMEOUT):
+
+        try:
+            self.pending.put(None, timeout=timeout)
+        except queue.Full:
+            return False
+        self.thread.join(timeout)
+
+        return not self.thread.is_alive()
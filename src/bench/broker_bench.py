@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark suite for the Communication Broker
+Runs the broker in-process on loopback (robots on 127.0.0.2.., the webcam on
+127.0.0.1), once per engine, through these scenarios:
+
+ - webcam: W updates paced at several rates; achieved rate and reply latency
+ - exchanges: every pair of robots collides and swaps G and T at once, round
+   after round; exchanges per second and G/T latency
+ - barrier: N robots say HELLO, the last one late; time until all have START
+ - done: a robot sends D; time until every other robot has the pushed result
+
+Random data comes from fixed seeds, so runs are comparable. Results are
+written as JSON ({engine: {scenario: {metric: value}}}); give a previous
+result file with -b to flag metrics that got worse by more than the
+tolerance (names ending in _ms should go down, _per_s up). Exits with 1 if
+anything regressed.
+
+usage: broker_bench.py [-e threads,asyncio] [-s <scenario,...>] [-n <robots>] [-d <seconds>]
+                       [-r <seed>] [-o <output.json>] [-b <baseline.json>] [-t <tolerance>] [--framed]
+'''
+
+import getopt
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import communication_broker as broker
+import framing
+import load_generator
+
+SCENARIOS = ("webcam", "exchanges", "barrier", "done")
+WEBCAM_RATES = (100, 1000, 0) # Updates per second (0: as fast as replies come back)
+BARRIER_STAGGER = 0.2 # Seconds the last robot is late for the start barrier
+EXCHANGE_ROUNDS = 20
+
+
+def usage():
+    print('usage: broker_bench.py [-e threads,asyncio] [-s <scenario,...>] [-n <robots>] [-d <seconds>]')
+    print('                       [-r <seed>] [-o <output.json>] [-b <baseline.json>] [-t <tolerance>] [--framed]')
+
+# Latency percentiles, in milliseconds, of a list of seconds
+def latency_stats(prefix, latencies):
+
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    return dict(("{}_{}_ms".format(prefix, name), 1000.0 * load_generator.percentile(latencies, fraction))
+                for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0)))
+
+# Run fn(i, item) for every item on its own thread; returns the results in order
+def concurrently(fn, items):
+
+    results = [None] * len(items)
+    errors = []
+
+    def run(i, item):
+        try:
+            results[i] = fn(i, item)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=run, args=(i, item)) for i, item in enumerate(items)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    return results
+
+# Deterministic genes for robot i
+def genes_for(rng, i):
+    return bytes(rng.getrandbits(8) for j in range(framing.GENE_SIZE - 1)) + bytes([i % 256])
+
+def expect(reply, kind):
+    if reply is None or reply[0] != kind:
+        raise IOError("expected {} but got {}".format(kind, reply and reply[0]))
+    return reply
+
+
+'''
+A broker with num_robots robots and the webcam, all connected. The robots
+haven't said HELLO yet unless started is set.
+'''
+class Session(object):
+
+    def __init__(self, engine, num_robots, framed, started=True):
+
+        configuration = load_generator.loopback_configuration(num_robots)
+        self.broker = load_generator.start_local_broker(configuration, engine)
+        address = self.broker.server_address
+        self.robots = [load_generator.BrokerConnection(address, ip, framed) for color, ip in configuration[:-1]]
+        self.webcam = load_generator.BrokerConnection(address, configuration[-1][1], framed)
+        if started:
+            concurrently(lambda i, robot: expect(robot.request(b"H")[0], b"S"), self.robots)
+
+    def locate(self, i, x, y):
+        expect(self.webcam.request(b"W", "robot{}:{},{}".format(i, x, y).encode())[0], b"A")
+
+    def close(self):
+
+        for connection in self.robots + [self.webcam]:
+            connection.close()
+        self.broker.stop()
+
+
+# Webcam update rate vs. the broker's reply latency
+def webcam_scenario(engine, num_robots, duration, seed, framed):
+
+    rng = random.Random(seed)
+    session = Session(engine, num_robots, framed, started=False)
+    result = {}
+
+    try:
+        for rate in WEBCAM_RATES:
+            name = "rate_{}".format(rate) if rate else "rate_max"
+            latencies = []
+            start = time.perf_counter()
+            sent = 0
+            while time.perf_counter() - start < duration:
+                if rate:
+                    time.sleep(max(0.0, start + sent / float(rate) - time.perf_counter()))
+                message = "robot{}:{},{}".format(rng.randrange(num_robots), rng.randrange(1000), rng.randrange(1000)).encode()
+                reply, latency = session.webcam.request(b"W", message)
+                expect(reply, b"A")
+                latencies.append(latency)
+                sent += 1
+            result["{}_achieved_per_s".format(name)] = sent / (time.perf_counter() - start)
+            result.update(latency_stats(name, latencies))
+    finally:
+        session.close()
+
+    return result
+
+# Every pair collides and swaps genes at the same time, EXCHANGE_ROUNDS times
+def exchanges_scenario(engine, num_robots, duration, seed, framed):
+
+    rng = random.Random(seed)
+    session = Session(engine, num_robots, framed)
+    genes = [genes_for(rng, i) for i in range(num_robots)]
+    latencies = {b"C": [], b"G": [], b"T": []}
+
+    # Partners (2k, 2k+1) on top of each other, pairs far apart
+    for i in range(num_robots):
+        session.locate(i, (i // 2) * 10000, 0)
+
+    def exchange(i, robot):
+        replies = {}
+        for kind, payload in ((b"C", b""), (b"G", genes[i]), (b"T", genes[i])):
+            reply, latency = robot.request(kind, payload)
+            replies[kind] = expect(reply, b"R" if kind == b"C" else kind)[1]
+            latencies[kind].append(latency)
+        if replies[b"G"] != genes[i ^ 1] or replies[b"T"] != genes[i ^ 1]:
+            raise IOError("robot{} got the wrong genes".format(i))
+
+    try:
+        start = time.perf_counter()
+        for i in range(EXCHANGE_ROUNDS):
+            concurrently(exchange, session.robots)
+        elapsed = time.perf_counter() - start
+    finally:
+        session.close()
+
+    result = {"exchanges_per_s": (num_robots // 2) * EXCHANGE_ROUNDS / elapsed}
+    for kind, name in ((b"C", "collision"), (b"G", "genes"), (b"T", "second_best")):
+        result.update(latency_stats(name, latencies[kind]))
+
+    return result
+
+# Start barrier: everybody waits for the last robot's HELLO; how long until all have START
+def barrier_scenario(engine, num_robots, duration, seed, framed):
+
+    session = Session(engine, num_robots, framed, started=False)
+    received = [None] * num_robots
+    last_hello = [None]
+
+    def hello(i, robot):
+        if i == num_robots - 1:
+            time.sleep(BARRIER_STAGGER)
+            last_hello[0] = time.perf_counter()
+            robot.send(b"H")
+        else:
+            robot.send(b"H")
+        expect(robot.recv(), b"S")
+        received[i] = time.perf_counter()
+
+    try:
+        concurrently(hello, session.robots)
+    finally:
+        session.close()
+
+    release = [t - last_hello[0] for t in received]
+    result = {"release_ms": 1000.0 * max(release)}
+    result.update(latency_stats("robot_release", release))
+
+    return result
+
+# DONE: the first robot reports the result; how long until the broker has pushed it to every other robot
+def done_scenario(engine, num_robots, duration, seed, framed):
+
+    rng = random.Random(seed)
+    session = Session(engine, num_robots, framed)
+    result_genes = genes_for(rng, 0)
+    others = session.robots[1:]
+    received = [None] * len(others)
+
+    def collect(i, robot):
+        reply = expect(robot.recv(), b"D")
+        if reply[1] != result_genes:
+            raise IOError("robot{} got the wrong result".format(i + 1))
+        received[i] = time.perf_counter()
+
+    try:
+        start = time.perf_counter()
+        session.robots[0].send(b"D", result_genes)
+        session.robots[0].recv() # Hung up once the broker has the result
+        concurrently(collect, others)
+    finally:
+        session.close()
+
+    delivered = [t - start for t in received]
+    result = {"done_ms": 1000.0 * max(delivered)}
+    result.update(latency_stats("robot_done", delivered))
+
+    return result
+
+SCENARIO_FUNCTIONS = {
+    "webcam": webcam_scenario,
+    "exchanges": exchanges_scenario,
+    "barrier": barrier_scenario,
+    "done": done_scenario,
+}
+
+# Metrics that got worse than baseline by more than tolerance, as printable lines
+def regressions(results, baseline, tolerance):
+
+    found = []
+    for engine, scenarios in results.items():
+        for scenario, metrics in scenarios.items():
+            for metric, value in metrics.items():
+                old = baseline.get(engine, {}).get(scenario, {}).get(metric)
+                if not old:
+                    continue
+                if metric.endswith("_ms") and value > old * (1 + tolerance):
+                    worse = value / old - 1
+                elif metric.endswith("_per_s") and value < old * (1 - tolerance):
+                    worse = 1 - value / old
+                else:
+                    continue
+                found.append("{} {} {}: {:.3f} -> {:.3f} ({:.0f}% worse)".format(engine, scenario, metric, old, value, 100 * worse))
+
+    return found
+
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "he:s:n:d:r:o:b:t:", ["framed"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    engines = list(broker.ENGINES)
+    scenarios = list(SCENARIOS)
+    num_robots = 20
+    duration = 1.0
+    seed = 0
+    output_file = None
+    baseline_file = None
+    tolerance = 0.25
+    framed = False
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt == '-e':
+            engines = arg.split(',')
+        elif opt == '-s':
+            scenarios = arg.split(',')
+        elif opt == '-n':
+            num_robots = int(arg)
+        elif opt == '-d':
+            duration = float(arg)
+        elif opt == '-r':
+            seed = int(arg)
+        elif opt == '-o':
+            output_file = arg
+        elif opt == '-b':
+            baseline_file = arg
+        elif opt == '-t':
+            tolerance = float(arg)
+        elif opt == '--framed':
+            framed = True
+
+    if any(engine not in broker.ENGINES for engine in engines) or any(s not in SCENARIOS for s in scenarios) \
+            or num_robots < 2 or num_robots % 2 or num_robots > 250:
+        usage()
+        sys.exit(2)
+
+    results = {}
+    for engine in engines:
+        results[engine] = {}
+        for scenario in scenarios:
+            results[engine][scenario] = SCENARIO_FUNCTIONS[scenario](engine, num_robots, duration, seed, framed)
+
+    report = {
+        "settings": {"robots": num_robots, "duration": duration, "seed": seed, "framed": framed,
+                     "python": platform.python_version(), "machine": platform.machine()},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output_file is None:
+        print(text)
+    else:
+        with open(output_file, 'w') as f:
+            f.write(text + "\n")
+
+    if baseline_file is not None:
+        with open(baseline_file) as f:
+            found = regressions(results, json.load(f)["results"], tolerance)
+        for line in found:
+            print("REGRESSION: {}".format(line), file=sys.stderr)
+        if found:
+            sys.exit(1)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark for gene payload encoding (gene_codec.py)
+Evolves the demo's target image with the genetic package and encodes the
+mother's genes every few generations, as a robot would send them in G, at
+the robots' 32x16 and genetic_algorithm.cpp's 283x240. Reports how big the
+payloads get against the raw genes, which methods were picked, and what
+encoding and decoding cost.
+
+usage: codec_bench.py [-k <generations between exchanges>] [-x <exchanges>] [-i <target image>]
+'''
+
+import collections
+import getopt
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import gene_codec
+import genetic
+
+TARGET = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '16_32_uva grad.bmp')
+METHODS = {gene_codec.RAW: "raw", gene_codec.ZLIB: "zlib", gene_codec.DELTA: "delta"}
+
+
+def usage():
+    print('usage: codec_bench.py [-k <generations between exchanges>] [-x <exchanges>] [-i <target image>]')
+
+# Target image as a (rows, cols, 3) array
+def load_target(input_file, rows, cols):
+    img = Image.open(input_file).convert('RGB').resize((cols, rows))
+    return np.asarray(img, dtype=np.uint8)
+
+# Genes a robot sends: the mother every k generations, exchanges times
+def sent_genes(target, k, exchanges):
+
+    ga = genetic.GeneticAlgorithm(target, seed=1)
+    genes = []
+    for i in range(exchanges):
+        for j in range(k):
+            ga.step()
+        genes.append(genetic.to_bytes(ga.mother))
+
+    return genes
+
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hk:x:i:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    k = 5
+    exchanges = 50
+    input_file = TARGET
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt == '-k':
+            k = int(arg)
+        elif opt == '-x':
+            exchanges = int(arg)
+        elif opt == '-i':
+            input_file = arg
+
+    for rows, cols in ((16, 32), (240, 283)):
+        genes = sent_genes(load_target(input_file, rows, cols), k, exchanges)
+        sender, receiver = gene_codec.GeneCodec(), gene_codec.GeneCodec()
+        methods = collections.Counter()
+        raw = wire = 0
+        encoding = decoding = 0.0
+
+        for g in genes:
+            start = time.perf_counter()
+            payload = sender.encode(g)
+            encoding += time.perf_counter() - start
+
+            start = time.perf_counter()
+            decoded = receiver.decode(payload)
+            decoding += time.perf_counter() - start
+
+            if decoded != g:
+                raise RuntimeError("genes did not survive the round trip")
+            methods[METHODS[payload[0]]] += 1
+            raw += len(g)
+            wire += len(payload)
+
+        print("{:>3}x{:<3} every {} generations: {:5.1%} of the raw genes on the wire ({})  encode {:8.1f}us  decode {:8.1f}us".format(
+            cols, rows, k, float(wire) / raw, ", ".join("{} {}".format(n, m) for m, n in sorted(methods.items())),
+            1e6 * encoding / len(genes), 1e6 * decoding / len(genes)))
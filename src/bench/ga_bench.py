@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark for the vectorized genetic algorithm (genetic package)
+Evolves a random target with a fixed seed and reports generations per second
+for the robots' 32x16 images and for genetic_algorithm.cpp's 283x240, and
+what scoring one generation costs by full rescan vs. incrementally.
+
+usage: ga_bench.py [-c <children>] [-g <generations>]
+'''
+
+import getopt
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import genetic
+
+
+def usage():
+    print('usage: ga_bench.py [-c <children>] [-g <generations>]')
+
+# Milliseconds per call of fn (best of a few)
+def best_time(fn, repeat=5):
+
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best * 1000.0
+
+# Cost of scoring one generation: full rescan vs. crossover mask + mutation deltas
+def fitness_costs(ga):
+
+    mask = genetic.crossover_mask(ga.num_children, ga.rows, ga.cols, ga.rng)
+    genetic.crossover(ga.mother, ga.father, ga.num_children, ga.rng, out=ga.population, mask=mask)
+    genetic.mutate(ga.population, ga.rng, ga.mutation_rate)
+
+    full = best_time(lambda: genetic.fitness(ga.population, ga.target))
+    incremental = best_time(lambda: genetic.crossover_fitness(ga.mother_distance, ga.father_distance, mask))
+
+    # The mutation deltas come with the mutations; count what scoring them adds
+    scratch = ga.population.copy()
+    scored = best_time(lambda: genetic.mutate(scratch, ga.rng, ga.mutation_rate, target=ga.target))
+    unscored = best_time(lambda: genetic.mutate(scratch, ga.rng, ga.mutation_rate))
+    incremental += max(0.0, scored - unscored)
+
+    return full, incremental
+
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:g:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    children = genetic.ga.NUM_CHILDREN
+    generations = 200
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt == '-c':
+            children = int(arg)
+        elif opt == '-g':
+            generations = int(arg)
+
+    for rows, cols in ((16, 32), (283, 240)):
+        target = genetic.random_genes(rows, cols, np.random.default_rng(0))
+        ga = genetic.GeneticAlgorithm(target, num_children=children, seed=1)
+        start_fitness = ga.mother_fitness
+
+        # Big images are slow; don't spend more than a few seconds on them
+        start = time.perf_counter()
+        while ga.generation < generations and (ga.generation < 5 or time.perf_counter() - start < 5.0):
+            ga.step()
+        elapsed = time.perf_counter() - start
+
+        print("{:>3}x{:<3} {} children: {:8.1f} generations/s  fitness {} -> {} in {} generations".format(
+            cols, rows, children, ga.generation / elapsed, start_fitness, ga.mother_fitness, ga.generation))
+
+        full, incremental = fitness_costs(ga)
+        print("{:>3}x{:<3} scoring a generation: full rescan {:8.2f}ms  incremental {:8.2f}ms".format(
+            cols, rows, full, incremental))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark for the island-model genetic algorithm (genetic.IslandModel)
+Evolves a random 32x16 target with a fixed seed on 1, 2, 4, ... worker
+processes (one island each, up to the number of cores, or -w) and reports
+generations per second (over all islands) and the time it took until some
+island's mother was under the threshold.
+
+usage: island_bench.py [-w <max workers>] [-t <threshold>] [-e <max epochs>] [-c <children>]
+'''
+
+import getopt
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import genetic
+
+
+def usage():
+    print('usage: island_bench.py [-w <max workers>] [-t <threshold>] [-e <max epochs>] [-c <children>]')
+
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hw:t:e:c:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    max_workers = os.cpu_count() or 1
+    threshold = 40000
+    epochs = 100
+    children = genetic.ga.NUM_CHILDREN
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt == '-w':
+            max_workers = int(arg)
+        elif opt == '-t':
+            threshold = int(arg)
+        elif opt == '-e':
+            epochs = int(arg)
+        elif opt == '-c':
+            children = int(arg)
+
+    target = genetic.random_genes(16, 32, np.random.default_rng(0))
+    print("{} cores, threshold {}, {} generations between swaps".format(os.cpu_count(), threshold, genetic.islands.MIGRATION_INTERVAL))
+
+    workers = 1
+    while workers <= max_workers:
+        with genetic.IslandModel(target, workers=workers, num_children=children, seed=1) as islands:
+            list(islands.pool.map(abs, range(workers))) # Start the worker processes
+
+            start = time.perf_counter()
+            best = islands.run(epochs, threshold)
+            elapsed = time.perf_counter() - start
+
+        reached = "{:6.2f}s".format(elapsed) if best < threshold else "   not reached"
+        print("{:2} workers: {:8.1f} generations/s  time to threshold {}  (best {} after {} epochs)".format(
+            workers, islands.generations / elapsed, reached, best, islands.epoch))
+        workers *= 2
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark for the broker's gene relay: how many bytes get allocated (and how
+long it takes) to take a received G message and forward it to the partner.
+Compares the old path (split, bytearray, "G:" + genes, sendall) with the
+current one (copy_into the robot's preallocated buffer, sendmsg of the
+cached header and the buffer) on a local socket pair, in both framings.
+Also compares ways of sending the R reply (which carries the target image):
+joining prefix and target, sendmsg of both, and the cached encoded reply.
+
+usage: relay_bench.py [-n <relays>]
+'''
+
+import getopt
+import os
+import socket
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import communication_broker as broker
+import framing
+
+
+def usage():
+    print('usage: relay_bench.py [-n <relays>]')
+
+# The relay as it was: three copies before the send
+def old_relay(sock, reader, frame, robot):
+    data = b"G:" + bytes(frame.payload) # What recv() used to hand us
+    robot["genes"] = bytearray(data.split(b'G:')[1])
+    sock.sendall(b"G:" + robot["genes"])
+
+# The relay as the broker does it now
+def new_relay(sock, reader, frame, robot):
+    robot["genes"] = broker.copy_into(robot["genes"], frame.payload)
+    broker.sendall_buffers(sock, reader.encode(b"G", robot["genes"]))
+
+# R reply: prefix + target joined for every send (as the broker used to)
+def joined_reply(sock, reader, frame, robot):
+    sock.sendall(b"".join(reader.encode(b"R", robot["target"])))
+
+# R reply: prefix and target sent with one sendmsg
+def buffers_reply(sock, reader, frame, robot):
+    broker.sendall_buffers(sock, reader.encode(b"R", robot["target"]))
+
+# R reply: encoded once, sent as is (what the broker does now)
+def cached_reply(sock, reader, frame, robot):
+    sock.sendall(robot["replies"].encoded(reader.mode, b"R"))
+
+'''
+Run relays relays through a socket pair; returns (bytes allocated per relay
+(peak over the relay), microseconds per relay).
+'''
+def measure(relay, mode, relays):
+
+    broker_side, partner_side = socket.socketpair()
+    sink = bytearray(1 << 16) # The partner drains into this, without allocating
+
+    # A reader in the requested framing holding one received G message
+    reader = framing.FrameReader()
+    genes = os.urandom(framing.GENE_SIZE)
+    if mode == framing.FRAMED:
+        reader.feed(framing.MAGIC + framing.encode_frame(b"G", genes))
+    else:
+        reader.feed(b"G:" + genes)
+    frame = reader.next_frame()
+    robot = {"genes": broker.gene_buffer(), "target": bytearray(os.urandom(framing.GENE_SIZE)), "replies": framing.ReplyCache()}
+    robot["replies"].update(b"R", robot["target"])
+
+    relay(broker_side, reader, frame, robot) # Warm up caches
+    partner_side.recv_into(sink)
+
+    allocated = 0
+    elapsed = 0.0
+    for i in range(relays):
+        tracemalloc.start()
+        start = time.perf_counter()
+        relay(broker_side, reader, frame, robot)
+        elapsed += time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        allocated += peak
+
+        received = 0
+        while received < framing.GENE_SIZE:
+            received += partner_side.recv_into(sink)
+
+    broker_side.close()
+    partner_side.close()
+
+    return allocated / float(relays), 1e6 * elapsed / relays
+
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    relays = 1000
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt == '-n':
+            relays = int(arg)
+
+    for name, relay in (("old", old_relay), ("new", new_relay)):
+        for mode in (framing.LEGACY, framing.FRAMED):
+            allocated, micros = measure(relay, mode, relays)
+            # Anything gene-sized is a copy of the payload; the rest is sendmsg's iovec bookkeeping
+            copies = int(allocated // framing.GENE_SIZE)
+            print("{} relay ({:<6}): {} payload copies, {:8.1f} bytes allocated per relay  {:6.1f}us per relay".format(name, mode, copies, allocated, micros))
+
+    for name, reply in (("joined", joined_reply), ("sendmsg", buffers_reply), ("cached", cached_reply)):
+        for mode in (framing.LEGACY, framing.FRAMED):
+            allocated, micros = measure(reply, mode, relays)
+            copies = int(allocated // framing.GENE_SIZE)
+            print("{:<7} R reply ({:<6}): {} payload copies, {:8.1f} bytes allocated per reply  {:6.1f}us per reply".format(name, mode, copies, allocated, micros))
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark for the broker's robot rendezvous (start barrier, G and T exchanges)
+Runs the Communication Broker in-process on loopback with N simulated robots
+(one loopback IP alias per robot) and reports, for each phase, how much CPU the
+process burned while robots were waiting on their partner and how long it took
+to release everybody once the last robot showed up.
+
+Run it once per engine (-e threads|asyncio): both must come out with every
+robot holding its partner's genes, so it doubles as a protocol check.
+
+usage: rendezvous_bench.py [-n <robots>] [-s <stagger seconds>] [-e <engine>]
+'''
+
+import getopt
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import communication_broker as broker
+import robot_state
+
+GENE_SIZE = 1536
+MESSAGE_SIZE = GENE_SIZE + 2
+
+
+def usage():
+    print('usage: rendezvous_bench.py [-n <robots>] [-s <stagger seconds>] [-e threads|asyncio]')
+
+# Read exactly n bytes from the socket
+def recv_exactly(sock, n):
+
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise IOError("broker closed the connection")
+        data += chunk
+
+    return data
+
+# CPU seconds (user + system) used by this process so far
+def cpu_time():
+
+    t = os.times()
+    return t[0] + t[1]
+
+# Create a broker on loopback with robot0..robotN-1 on 127.0.0.2.. and a webcam on 127.0.0.1
+def start_broker(num_robots, engine):
+
+    myRIOs = robot_state.RobotRegistry()
+    for i in range(num_robots):
+        myRIOs.add("robot{}".format(i), "127.0.0.{}".format(i + 2))
+    myRIOs.add("webcam", "127.0.0.1")
+
+    return broker.Broker(myRIOs, num_robots, bytearray(GENE_SIZE), ('127.0.0.1', 0), engine).start()
+
+# Connect from a given loopback alias so the broker can tell the robots apart
+def connect(server, ip):
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.bind((ip, 0))
+    sock.connect(server.server_address)
+    return sock
+
+'''
+Everybody but the late robots sends `message` right away; the late ones send it
+after `stagger` seconds. Returns (CPU seconds burned while waiting, seconds from
+the last send until every robot had its reply, replies by robot index).
+'''
+def staggered_phase(robots, messages, late, stagger, reply_size):
+
+    replies = [None] * len(robots)
+
+    def receive(i):
+        replies[i] = recv_exactly(robots[i], reply_size)
+
+    threads = [threading.Thread(target=receive, args=(i,)) for i in range(len(robots))]
+    for thread in threads:
+        thread.start()
+
+    for i, sock in enumerate(robots):
+        if i not in late:
+            sock.sendall(messages[i])
+
+    cpu_start = cpu_time()
+    time.sleep(stagger)
+    cpu_waiting = cpu_time() - cpu_start
+
+    release_start = time.time()
+    for i in late:
+        robots[i].sendall(messages[i])
+    for thread in threads:
+        thread.join()
+    release = time.time() - release_start
+
+    return cpu_waiting, release, replies
+
+def report(phase, num_waiting, stagger, cpu_waiting, release):
+    print("{:<12} {:>3} robots waiting {:.1f}s: cpu {:7.3f}s ({:5.1f}% of a core)  release {:7.2f}ms".format(
+        phase, num_waiting, stagger, cpu_waiting, 100.0 * cpu_waiting / stagger, release * 1000.0))
+
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:s:e:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    num_robots = 10
+    stagger = 2.0
+    engine = "threads"
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt == '-n':
+            num_robots = int(arg)
+        elif opt == '-s':
+            stagger = float(arg)
+        elif opt == '-e':
+            engine = arg
+
+    if engine not in broker.ENGINES:
+        usage()
+        sys.exit(2)
+
+    if num_robots < 2 or num_robots % 2:
+        print("Need an even number of robots (at least 2)")
+        sys.exit(2)
+
+    local_broker = start_broker(num_robots, engine)
+
+    robots = [connect(local_broker, "127.0.0.{}".format(i + 2)) for i in range(num_robots)]
+    webcam = connect(local_broker, "127.0.0.1")
+
+    # Start barrier: everybody but the last robot waits for the last HELLO
+    cpu_waiting, release, _ = staggered_phase(robots, [b"H"] * num_robots, [num_robots - 1], stagger, MESSAGE_SIZE)
+    barrier = ("start", num_robots - 1, stagger, cpu_waiting, release)
+
+    # Put each pair of robots on top of each other, pairs far apart
+    for i in range(num_robots):
+        webcam.sendall("W:robot{}:{},0".format(i, (i // 2) * 10000).encode())
+        recv_exactly(webcam, len(b"Thanks"))
+
+    # Collide everybody at once; partners are robot 2k and 2k+1
+    for sock in robots:
+        sock.sendall(b"C")
+    for sock in robots:
+        if not recv_exactly(sock, MESSAGE_SIZE).startswith(b"R"):
+            raise RuntimeError("robot did not get a partner")
+    pairing = local_broker.arena().matchmaker.stats()
+
+    # G and T exchanges: the even robot of each pair waits on its odd partner
+    late = range(1, num_robots, 2)
+    exchanges = []
+    for prefix in (b"G:", b"T:"):
+        messages = [prefix + bytes(bytearray([i]) * GENE_SIZE) for i in range(num_robots)]
+        cpu_waiting, release, replies = staggered_phase(robots, messages, late, stagger, MESSAGE_SIZE)
+        for i in range(num_robots):
+            if replies[i] != messages[i ^ 1]:
+                raise RuntimeError("robot{} got the wrong genes".format(i))
+        exchanges.append((prefix.decode()[0] + " exchange", num_robots // 2, stagger, cpu_waiting, release))
+
+    for sock in robots + [webcam]:
+        sock.close()
+    local_broker.stop()
+
+    for result in [barrier] + exchanges:
+        report(*result)
+    print("pairing      {} pairs, collision to reply p50 {:.2f}ms max {:.2f}ms".format(
+        pairing["pairings"], pairing["latency_p50"] * 1000.0, pairing["latency_max"] * 1000.0))
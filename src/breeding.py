@@ -0,0 +1,209 @@
+'''
+Offloaded generations for the Communication Broker (N messages)
+A robot too small to run the genetic algorithm can send its mother and father
+in one N frame instead of G and T; the broker breeds its next generation and
+answers N with the new mother and father. Paired with a robot that also
+offloads, both robots are bred in one job, where each takes the other's
+mother as a parent (as G does) and the other's second best child as its
+father if that's better (as T does), so neither waits on a second exchange.
+
+Breeding runs on worker processes (a Breeder), never on an engine's threads or
+event loop. They are spawned rather than forked, so they don't hold on to the
+robots' sockets (a closed connection would not hang up while a worker still
+had it open), and started along with the Breeder, so the first N doesn't wait
+for NumPy to load. Jobs queue up while every worker is busy; the next free worker
+takes all of an arena's queued jobs (up to BATCH_BYTES of children) and breeds
+them with one call of genetic.next_generations, so under load the batches
+grow instead of the queue.
+'''
+
+import collections
+import multiprocessing
+import os
+import threading
+from concurrent import futures
+
+import numpy as np
+
+import broker_logging
+import genetic
+from genetic.ga import MUTATION_RATE
+
+NUM_CHILDREN = 100 # Children per robot per generation
+BATCH_BYTES = 64 * 1024 * 1024 # Children's pixel bytes bred in one batch at most (at least one job is)
+
+Job = collections.namedtuple("Job", ["broods", "future"]) # Parents (lists of candidate genes) of one robot, or of two partners
+
+
+# Worker side: nothing, but loading this module (and NumPy) on the way
+def ready():
+    return True
+
+# Mother and father of the best two candidates (genes as bytes), as (rows, cols, 3) arrays
+def pick_parents(candidates, target):
+
+    rows, cols = target.shape[:2]
+    parents = np.stack([genetic.from_bytes(genes, rows, cols) for genes in candidates])
+    order = np.argsort(genetic.fitness(parents, target), kind="stable")
+    return parents[order[0]], parents[order[min(1, len(order) - 1)]]
+
+# Offspring after taking second_best (a partner's, with its fitness) as father if it beats him, or as mother if it beats her too
+def adopt(offspring, second_best, second_best_fitness):
+
+    if second_best_fitness >= offspring.father_fitness:
+        return offspring
+    if second_best_fitness >= offspring.mother_fitness:
+        return offspring._replace(father=second_best, father_fitness=second_best_fitness)
+    return offspring._replace(mother=second_best, mother_fitness=second_best_fitness, father=offspring.mother, father_fitness=offspring.mother_fitness)
+
+'''
+Worker side: one generation for every brood of a batch of jobs of one arena
+(target is its image, size its width and height). Returns, for each job, a
+(mother, father, second best child) of genes per brood; two-brood jobs are
+partners, who adopt each other's second best child.
+'''
+def breed(target, size, jobs, num_children, mutation_rate):
+
+    width, height = size
+    target = genetic.from_bytes(target, height, width)
+
+    parents = [pick_parents(candidates, target) for broods in jobs for candidates in broods]
+    mothers = np.stack([mother for mother, father in parents])
+    fathers = np.stack([father for mother, father in parents])
+    bred = iter(genetic.next_generations(target, mothers, fathers, num_children, np.random.default_rng(), mutation_rate))
+
+    results = []
+    for broods in jobs:
+        offspring = [next(bred) for candidates in broods]
+        if len(offspring) == 2:
+            first, second = offspring
+            offspring = [adopt(first, second.second_best, second.second_best_fitness),
+                         adopt(second, first.second_best, first.second_best_fitness)]
+        results.append([(genetic.to_bytes(o.mother), genetic.to_bytes(o.father), genetic.to_bytes(o.second_best)) for o in offspring])
+
+    return results
+
+
+'''
+Pool of worker processes breeding offloaded generations, in batches per
+arena. submit() returns a concurrent.futures.Future that resolves to a list
+of (mother, father, second best child) per brood, or to None if breeding
+failed (the robot then gets its parents back).
+'''
+class Breeder(object):
+
+    def __init__(self, workers=None, num_children=NUM_CHILDREN, mutation_rate=MUTATION_RATE):
+
+        self.workers = workers or os.cpu_count() or 1
+        self.num_children = num_children
+        self.mutation_rate = mutation_rate
+        self.pool = self.start_pool()
+
+        self.pending = collections.OrderedDict() # Arena -> its queued Jobs, oldest arena first
+        self.busy = 0 # Batches on the workers
+        self.closed = False
+        self.lock = threading.Lock()
+
+        self.generations = 0 # Broods bred
+        self.batches = 0
+        self.failed = 0 # Broods whose batch failed
+
+    # A pool of spawned workers, started right away
+    def start_pool(self):
+
+        pool = futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        for i in range(self.workers):
+            pool.submit(ready)
+
+        return pool
+
+    # Breed broods (each a list of candidate parents' genes, two or more) of arena's robots; one brood per robot
+    def submit(self, arena, broods):
+
+        job = Job([[bytes(genes) for genes in candidates] for candidates in broods], futures.Future())
+        with self.lock:
+            if self.closed:
+                job.future.set_result(None)
+                return job.future
+            self.pending.setdefault(arena, []).append(job)
+
+        self.dispatch()
+        return job.future
+
+    # Hand queued jobs to idle workers, a batch per arena
+    def dispatch(self):
+
+        batches = []
+        with self.lock:
+            while self.pending and self.busy < self.workers and not self.closed:
+                arena, queued = next(iter(self.pending.items()))
+                limit = max(1, BATCH_BYTES // (self.num_children * arena.gene_size))
+
+                broods = 0
+                taken = 0
+                while taken < len(queued) and (taken == 0 or broods + len(queued[taken].broods) <= limit):
+                    broods += len(queued[taken].broods)
+                    taken += 1
+
+                batch = queued[:taken]
+                del queued[:taken]
+                del self.pending[arena]
+                if queued:
+                    self.pending[arena] = queued # Back of the line, behind the other arenas
+                self.busy += 1
+                batches.append((arena, batch))
+            pool = self.pool
+
+        for arena, batch in batches:
+            try:
+                work = pool.submit(breed, bytes(arena.target_image), arena.image_size, [job.broods for job in batch],
+                                        self.num_children, self.mutation_rate)
+            except RuntimeError as err: # Closed (or a worker died) since
+                work = futures.Future()
+                work.set_exception(err)
+            work.add_done_callback(lambda work, batch=batch: self.finished(batch, work, pool))
+
+    # A batch is back (from pool): resolve its jobs, then keep the worker busy
+    def finished(self, batch, work, pool):
+
+        try:
+            results = work.result()
+        except Exception as err:
+            broker_logging.log.warning("Breeding %d offloaded generations failed: %s", sum(len(job.broods) for job in batch), repr(err))
+            results = [None] * len(batch)
+
+            # A worker died (killed, out of memory); the pool is no use anymore, so start another
+            with self.lock:
+                if isinstance(err, futures.process.BrokenProcessPool) and pool is self.pool and not self.closed:
+                    self.pool = self.start_pool()
+
+        with self.lock:
+            self.busy -= 1
+            self.batches += 1
+            for job, result in zip(batch, results):
+                if result is None:
+                    self.failed += len(job.broods)
+                else:
+                    self.generations += len(job.broods)
+
+        for job, result in zip(batch, results):
+            job.future.set_result(result)
+
+        self.dispatch()
+
+    # Whatever is still queued resolves to None; wait for the batches on the workers, then stop them
+    def close(self):
+
+        with self.lock:
+            self.closed = True
+            queued = [job for jobs in self.pending.values() for job in jobs]
+            self.pending.clear()
+
+        for job in queued:
+            job.future.set_result(None)
+        self.pool.shutdown()
+
+    def stats(self):
+        with self.lock:
+            return {"workers": self.workers, "generations": self.generations, "batches": self.batches,
+                    "failed": self.failed, "queued": sum(len(job.broods) for jobs in self.pending.values() for job in jobs)}
@@ -0,0 +1,114 @@
+'''
+Logging for the Communication Broker
+Sessions log through a session_log(), which tags every record with the
+connection's index (indented by it, like the old print_tabs output) and the
+robot's color, into the "broker" logger.
+
+setup() puts a queue between the loggers and the output: logging a message
+only enqueues the record, and a background QueueListener formats and writes
+it, so a network handler never waits on stdout. Since records are formatted
+on that thread, only pass immutable values (str, int, bytes, tuples of those)
+as message arguments.
+'''
+
+import functools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+FORMATS = ("text", "json")
+LEVELS = ("debug", "info", "warning", "error")
+
+log = logging.getLogger("broker")
+
+listener = None # The background writer, once setup() ran
+
+
+# Indentation for connection index (cached; the same few indexes log all session)
+@functools.lru_cache(maxsize=256)
+def indent(index):
+    return "\t" * index
+
+# Logger for one connection; set .extra["color"] once the robot is known
+def session_log(index, color=None):
+    return logging.LoggerAdapter(log, {"index": index, "color": color})
+
+
+# Human-readable lines: indented by connection, warnings and errors marked
+class TextFormatter(logging.Formatter):
+
+    def format(self, record):
+
+        message = super().format(record)
+        if record.levelno >= logging.WARNING:
+            message = "{}: {}".format(record.levelname, message)
+        return indent(getattr(record, "index", 0)) + message
+
+
+# One JSON object per line, for feeding log tools
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "index": getattr(record, "index", None),
+            "color": getattr(record, "color", None),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+'''
+QueueHandler formats the message before enqueueing it (in the logging
+thread); this one enqueues the record as is and leaves all formatting to the
+listener.
+'''
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        return record
+
+
+'''
+Send the broker's log to stream (stdout by default) at level (a logging level
+or one of LEVELS) in fmt (one of FORMATS), through a queue and a background
+writer. Call shutdown() to flush it.
+'''
+def setup(level=logging.INFO, fmt="text", stream=None):
+
+    global listener
+
+    if isinstance(level, str):
+        level = getattr(logging, level.upper())
+
+    shutdown()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JSONFormatter() if fmt == "json" else TextFormatter())
+
+    records = queue.SimpleQueue()
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+    log.addHandler(DeferredQueueHandler(records))
+    log.setLevel(level)
+    log.propagate = False
+
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+
+    return log
+
+# Write out whatever is still queued and stop the background writer
+def shutdown():
+
+    global listener
+
+    if listener is not None:
+        listener.stop()
+        listener = None
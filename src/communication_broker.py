@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 '''
 Code originally written by Philip Asare; modified by Tommy Tracy II
@@ -7,13 +7,28 @@ This is the Communication Broker for the Genetic Algorithm System Demo
 '''
 
 import threading
-import SocketServer
+import socket
+import socketserver
 import sys
 import getopt
-import Image
-import random
+import re
+import logging
+import signal
 import time
-import math
+from concurrent import futures
+
+import arenas
+import broker_logging
+import connections
+import framing
+import gene_codec
+import image_codec
+import matchmaking
+import metrics
+import recording
+import robot_state
+import snapshots
+import spatial_index
 
 
 # ---------- DEBUG Flags ----------
@@ -23,6 +38,16 @@ ROBOT_COLLISION = True # True for Robot collision; False for Obstacle collision
 SINGLE_BOT = False # Used if debugging a single robot := don't wait to start, don't send robot collision messages
 
 DISTANCE_THRESHOLD = 150 # Threshold distance for mating robots # THIS MUST BE CALIBRATED
+LOCATION_ENTRY = re.compile(br"([^:\n]+):(-?[0-9]+),(-?[0-9]+)") # One robot's location in an L batch: color:x,y
+
+START_TIMEOUT = None # Seconds to wait for every robot to say HELLO before starting anyway (None waits forever)
+DRAIN_TIMEOUT = 5 # Seconds a stopping broker waits for gene exchanges in progress (and, once DONE, for clients to hang up)
+CLOSE_TIMEOUT = 2 # Seconds a stopping broker waits for its handlers to notice their sockets are closed
+EXCHANGE_TIMEOUT = 30 # Seconds to wait for a partner's genes during the G and T exchanges
+PAIRING_TIMEOUT = 1 # Most seconds a colliding robot waits for a partner before it gets the O (obstacle) reply
+COMPACT_REPLIES = False # Send O and R without the (unused) target image (--compact-replies; the firmware must expect it)
+
+ENGINES = ("threads", "asyncio") # Available broker engines (--engine)
 
 # -------------------- -------------- --------------------
 
@@ -32,554 +57,1417 @@ DISTANCE_THRESHOLD = 150 # Threshold distance for mating robots # THIS MUST BE C
 
 # Display the usage
 def usage():
-	print('usage: communication_broker.py -i <target image filename> -f <configuration file>')
+    print('usage: communication_broker.py -i <target image filename> -f <configuration file> [--engine threads|asyncio]')
+    print('                               [--log-level debug|info|warning|error] [--log-format text|json]')
+    print('                               [--snapshots <directory> [--snapshot-format png|bmp|ppm]] [--compact-replies]')
+    print('                               [--drain-timeout <seconds>] [--arena <name>,<configuration file>,<target image> ...]')
+    print('                               [--image-size <width>x<height>] [--stats-port <port> [--timing]]')
+    print('                               [--record <recording file>] [--offload <worker processes>]')
+    print('                               [--history <directory> [--history-size <megabytes>]]')
 
-# Use an external viewer to display the image passed in as parameter
-def show_image(genes):
+# Use an external viewer to display the image (of size (width, height)) passed in as parameter
+def show_image(genes, size=framing.IMAGE_SIZE):
+    image_codec.to_image(genes, size).show()
 
-        # Go through byte array, convert each byte into an integer (0-255) and add to list
-	int_list = []
-	for b in genes:
-        	int_list.append(int(b))
-	
-        # Grab three consecutive integer values and zip them into a 3-tuple (RGB)
-	tuple_list = zip(int_list[0::3],int_list[1::3],int_list[2::3])
+# Log the contents of an arena's data dictionary (robot states)
+def print_data_dictionary(arena):
 
-        # Create new Image with RGB mode (size=32x16) and set the data to the tuples
-	img = Image.new('RGB', (32,16))
-        img.putdata(tuple_list)
+    summaries = [arena.myRIOs[color].summary() for color in arena.myRIOs] # We don't want to show the gene bytes
+    broker_logging.log.info("Contents of the Data Dictionary (arena %s) \n ----------\n%s\n ---------- \n", arena.name, "\n".join(summaries))
 
-        # Display the image
-        img.show()
 
-# Print contents of the data dictionary (robot states)
-def print_data_dictionary():
+# Generate a random array of bytes (random image)
+def generate_random_genes(size=framing.GENE_SIZE):
+    return image_codec.random_genes(size)
 
-    print("Contents of the Data Dictionary \n ----------\n")
-    for color in server.myRIOs:
-        string = ""
-        for trait in server.myRIOs[color]:
-                if trait != "genes" and trait != "second_best_genes": # We don't want to show the gene bytes
-                        string += "{}:{}\t".format(trait, server.myRIOs[color][trait])
-        print(string)
-    print("\n ---------- \n")
+# Preallocated gene buffer: a memoryview, so copying into it never makes a temporary copy
+def gene_buffer(size=framing.GENE_SIZE):
+    return memoryview(bytearray(size))
 
+'''
+Copy a received payload into a robot's gene buffer (no allocation unless the
+size changed). Returns the buffer, which is what gets forwarded.
+A partner only sends from this buffer between our rendezvous and its own next
+post, and our robot can't send new genes before that, so it is never
+overwritten while being forwarded.
+'''
+def copy_into(buffer, payload):
 
-# Generate a random array of bytes (random image)
-def generate_random_genes():
+    if buffer is None or len(buffer) != len(payload):
+        buffer = gene_buffer(len(payload))
+    buffer[:] = payload
 
-    result = []
-    for i in range(1536):
-        result.append(random.randint(0,255))
+    return buffer
 
-    return bytearray(result)
+# Send a sequence of buffers with one sendmsg (scatter/gather) call, no joining copies
+def sendall_buffers(sock, buffers):
 
-# Print tabs to distinguish threads (index 0 thread has 0 tabs; 1 has 1 tab, etc)
-def print_tabs(index):
+    total = 0
+    for buf in buffers:
+        total += len(buf)
 
-        tabs = ""
-        # Print tabs to distinguish between bots, and then the index of the thread
-        for i in range(index):
-                tabs += '\t'
+    sent = sock.sendmsg(buffers)
 
-        return tabs
+    # Partial send (socket buffer full); send the rest from views of what's left
+    while sent < total:
+        remaining = []
+        for buf in buffers:
+            if sent >= len(buf):
+                sent -= len(buf)
+            else:
+                remaining.append(memoryview(buf)[sent:])
+                sent = 0
+        buffers = remaining
+        total = sum(len(buf) for buf in buffers)
+        sent = sock.sendmsg(buffers)
 
-# Find robots that are within the DISTANCE_THRESHOLD of this robot
-def find_potential_partners(my_color):
+# Parse a webcam location ("x,y") into integer coordinates; None if it's garbled
+def parse_location(location):
 
-        partners = []
-        result = []
-        for color in server.myRIOs:
-                if color != my_color and color != "webcam":
-                        partners.append((color, distance_between(my_color, color)))
+    try:
+        x, y = location.split(",")
+        return (int(x), int(y))
+    except ValueError:
+        return None
+
+# (color, (x, y)) of every color:x,y line of a batched location update (L payload), in order; malformed lines are skipped
+def parse_locations(payload):
+    return [(color.decode(errors='replace'), (int(x), int(y))) for color, x, y in LOCATION_ENTRY.findall(payload)]
 
-        partners = sorted(partners, key=lambda partner: partner[1])
+# Read the configuration file (color:ip per line); returns the myRIOs registry and the robot count
+def read_configuration(configuration_file):
 
-        for partner in partners:
-                result.append(partner[0])
+    myRIOs = robot_state.RobotRegistry()
+    count = 0
+
+    configuration = open(configuration_file, 'r')
+    for config in configuration:
+        if not config.strip():
+            continue
+        color = config.split(':')[0]
+        ip = config.split(':')[1].strip()
+        myRIOs.add(color, ip)
+        if color != "webcam":
+            count += 1
+    configuration.close()
 
-        return result
+    return myRIOs, count
 
-# Return TRUE if the two robots are considered close enough to be mating
-def distance_between(color_1, color_2):
+# Open the target image, resize it to image_size (32x16 by default) and convert it to a byte array
+def load_target_image(input_file, image_size=framing.IMAGE_SIZE):
+    return image_codec.load(input_file, image_size)
 
-        #print("Color_1: {} \t Color_2: {}".format(color_1, color_2))
+# Parse an --image-size option (WIDTHxHEIGHT)
+def parse_image_size(option):
 
-        # Grab the current location of both robots
-        color_1_location = server.myRIOs[color_1]["location"]
-        color_2_location = server.myRIOs[color_2]["location"]
+    width, height = option.lower().split("x")
+    width, height = int(width), int(height)
+    if not (0 < width < 65536 and 0 < height < 65536):
+        raise ValueError("{}x{} is no image size".format(width, height))
 
-        #print("Robot 1 location: {} \t Robot 2 location: {}".format(color_1_location, color_2_location))
+    return (width, height)
 
-        # Split locations into x and y components on the comma
-        x1 = int(color_1_location.split(",")[0])
-        y1 = int(color_1_location.split(",")[1])
+# Parse an --arena option (name,configuration file,target image)
+def parse_arena_option(option):
 
-        x2 = int(color_2_location.split(",")[0])
-        y2 = int(color_2_location.split(",")[1])
+    name, configuration_file, input_file = option.split(",", 2)
+    return name, configuration_file, input_file
 
-        # Calculate distance between robots
-        distance = math.sqrt((x2-x1)**2 + (y2-y1)**2)
+# Set up the state shared by every arena of a server (either engine); add_arena() adds the sessions
+def init_server(server, myRIOs=None, count=0, target_image=None, compact_replies=COMPACT_REPLIES, image_size=framing.IMAGE_SIZE):
 
-        #print("\t\t\t\t\t\t\t\t\t\t Distance between {} and {}: {}".format(color_1, color_2, distance))
+    server.thread_index = 0
 
-        return distance
+    # The arenas (GA sessions) this server hosts (arenas.ArenaRegistry)
+    server.arenas = arenas.ArenaRegistry()
+    server.finished = threading.Event() # Set once every arena is DONE, or when the broker is asked to stop
+
+    # Lifecycle (see Broker.stop): no new pairings once stopping; closing resolves when every wait must give up
+    server.stopping = False
+    server.closing = futures.Future()
+    server.exchanges = InFlight() # Gene exchanges in progress, which a stopping broker lets finish
+
+    # Every open connection, in any arena (connections.ConnectionRegistry), so a stopping broker can close them
+    server.connections = connections.ConnectionRegistry()
+
+    # Counters, and timing when switched on (metrics.BrokerMetrics); served on the stats port, if any
+    server.metrics = metrics.BrokerMetrics()
+    watch_server(server)
+
+    # Where every frame gets recorded (a recording.Recorder), if anywhere; see Broker.start
+    server.recorder = None
+
+    # Where offloaded generations (N) get bred (a breeding.Breeder), if anywhere; see Broker.start
+    server.breeder = None
+
+    # Where the arenas' generation histories get written (a history.History), if anywhere; see Broker.start
+    server.history = None
+
+    if myRIOs is not None:
+        add_arena(server, arenas.DEFAULT, myRIOs, count, target_image, compact_replies, image_size)
+
+# Gauges for what the server keeps track of anyway
+def watch_server(server):
+
+    server.metrics.gauge("broker_connections", "Open connections", lambda: len(server.connections))
+    server.metrics.gauge("broker_exchanges_in_progress", "Gene exchanges in progress", lambda: server.exchanges.count)
+    server.metrics.gauge("broker_pairings_total", "Collisions paired with a partner, by arena",
+                         lambda: {(arena.name,): arena.matchmaker.pairings for arena in server.arenas}, ("arena",), "counter")
+    server.metrics.gauge("broker_obstacles_total", "Collisions answered with O, by arena",
+                         lambda: {(arena.name,): arena.matchmaker.obstacles for arena in server.arenas}, ("arena",), "counter")
+    server.metrics.gauge("broker_stale_locations_total", "Batched location updates superseded before they were applied, by arena",
+                         lambda: {(arena.name,): arena.stale_locations for arena in server.arenas}, ("arena",), "counter")
+    server.metrics.gauge("broker_arena_done", "1 once a robot reported the arena's result", lambda: {(arena.name,): int(arena.DONE) for arena in server.arenas}, ("arena",))
+    server.metrics.gauge("broker_timing_enabled", "1 while the timing histograms are recorded", lambda: int(server.metrics.timing))
+
+# Gauges for the offloaded generations (N)
+def watch_breeder(server):
+
+    breeder = server.breeder
+    server.metrics.gauge("broker_offloaded_generations_total", "Generations bred for robots that offload them (N)", lambda: breeder.generations, kind="counter")
+    server.metrics.gauge("broker_breeding_batches_total", "Batches of offloaded generations bred", lambda: breeder.batches, kind="counter")
+    server.metrics.gauge("broker_breeding_failed_total", "Offloaded generations whose batch failed (the robot got its parents back)", lambda: breeder.failed, kind="counter")
+    server.metrics.gauge("broker_breeding_queued", "Offloaded generations waiting for a worker", lambda: breeder.stats()["queued"])
+
+# Snapshot of a server and its arenas' robots (JSON for the stats port)
+def server_state(server):
+
+    return {
+        "stopping": server.stopping,
+        "connections": len(server.connections),
+        "exchanges_in_progress": server.exchanges.count,
+        "timing": server.metrics.timing,
+        "offload": server.breeder.stats() if server.breeder is not None else None,
+        "arenas": {arena.name: {
+            "done": arena.DONE,
+            "image_size": list(arena.image_size),
+            "waiting_on_hello": max(arena.start_barrier.count, 0),
+            "matchmaking": arena.matchmaker.stats(),
+            "stale_locations": arena.stale_locations,
+            "robots": {color: arena.myRIOs[color].snapshot() for color in arena.myRIOs},
+        } for arena in server.arenas},
+    }
+
+# Host another GA session on a server; returns its Arena
+def add_arena(server, name, myRIOs, count, target_image, compact_replies=COMPACT_REPLIES, image_size=framing.IMAGE_SIZE):
+
+    arena = Arena(name, myRIOs, count, target_image, compact_replies, image_size)
+    server.arenas.add(arena)
+    if server.recorder is not None:
+        server.recorder.arena(arena)
+    if server.history is not None:
+        arena.history = server.history.open(arena)
+
+    return arena
 
 #
 # -------------------- -------------- --------------------
 #
 
+#
+# -------------------- Arenas --------------------
+#
+
+'''
+One GA session: its robots, image size, target image, matchmaking and result.
+A broker hosts any number of them (server.arenas); robots only ever pair up,
+and get D, within their own arena.
+'''
+class Arena(object):
+
+    def __init__(self, name, myRIOs, count, target_image, compact_replies=COMPACT_REPLIES, image_size=framing.IMAGE_SIZE):
+
+        self.name = name
+
+        # Size of the images (width, height) everybody evolves; the framed S tells the robots
+        self.image_size = tuple(image_size)
+        self.gene_size = framing.gene_size(self.image_size)
+
+        # A registry of connected myRIOS associating color and address (robot_state.RobotRegistry)
+        self.myRIOs = myRIOs
 
+        self.COUNT = count
+        self.start_barrier = StartBarrier(count) # Robots sleep here until all of them said HELLO
+        self.DONE = False
+        self.finished = threading.Event() # Set along with DONE
+
+        # Every open connection in this arena (connections.ConnectionRegistry), so D can be pushed to all of them
+        self.connections = connections.ConnectionRegistry()
+
+        # Where its target image, result and every exchanged genes get kept (a history.ArenaHistory), if anywhere
+        self.history = None
+
+        # S, O and R replies, encoded once per target image (framing.ReplyCache)
+        self.replies = framing.ReplyCache()
+        self.compact_replies = compact_replies
+        self.set_target_image(target_image)
+
+        # Where the webcam last saw each robot, bucketed by DISTANCE_THRESHOLD so partner lookups only scan nearby cells
+        self.locations = spatial_index.GridIndex(DISTANCE_THRESHOLD)
+        self.stale_locations = 0 # Batched updates overwritten by a later batch before they were applied
+
+        # Pairs up colliding robots within DISTANCE_THRESHOLD of each other as soon as both have collided
+        self.matchmaker = matchmaking.Matchmaker(self.locations, DISTANCE_THRESHOLD, GeneExchange)
+
+        # This is the final image
+        self.RESULT = None
+
+        # Where gene exchanges get saved as images (a snapshots.SnapshotWriter), if anywhere
+        self.snapshots = None
+
+    # Set the target image (image_size pixels), and rebuild the cached replies that carry it
+    def set_target_image(self, target_image):
+
+        if len(target_image) != self.gene_size:
+            raise ValueError("{} byte target image for {}x{} genes".format(len(target_image), *self.image_size))
+
+        self.target_image = target_image
+
+        self.replies.update(b"S", target_image, framing.encode_start(self.image_size, target_image))
+        for kind in (b"O", b"R"):
+            self.replies.update(kind, b"" if self.compact_replies else target_image)
+        if self.history is not None:
+            self.history.set_target(target_image)
+
+    # Snapshot label for an exchange (prefixed by the arena name, unless it's the default one)
+    def snapshot_label(self, label):
+        return label if self.name == arenas.DEFAULT else "{}_{}".format(self.name, label)
+
+#
+# -------------------- -------------- --------------------
+#
+
+#
+# -------------------- Synchronization primitives --------------------
+#
+
+'''
+The primitives below are built on concurrent.futures.Future, which is thread
+safe and can be awaited from asyncio (asyncio.wrap_future), so both engines
+share them. Nobody spins: threads block in Future.result(), coroutines await.
 '''
-The RequestHandler class for our server.
 
 '''
-class MyRIOConnectionHandler(SocketServer.BaseRequestHandler):
+Start barrier: every robot waits on the released future until all
+arena.COUNT robots have said HELLO.
+'''
+class StartBarrier(object):
+
+    def __init__(self, count):
+        self.count = count # Robots still expected to say HELLO
+        self.lock = threading.Lock()
+        self.released = futures.Future()
+        if count <= 0:
+            self.released.set_result(True)
+
+    # Register one robot; returns the number of robots still expected
+    def arrive(self):
+        with self.lock:
+            self.count -= 1
+            count = self.count
+        if count == 0:
+            self.released.set_result(True)
+        return count
+
+
+'''
+Rendezvous between two partners: each side posts a value and waits on the
+future of the other side, which resolves to the partner's value.
+A fresh Rendezvous is used for every exchange so no flags need resetting.
+'''
+class Rendezvous(object):
+
+    def __init__(self):
+        self.values = {} # color -> future of the value posted by that robot
+        self.lock = threading.Lock()
+
+    # Future for the value posted by color
+    def future(self, color):
+        with self.lock:
+            if color not in self.values:
+                self.values[color] = futures.Future()
+            return self.values[color]
+
+    # Post my value
+    def post(self, color, value):
+        self.future(color).set_result(value)
+
+
+'''
+Number of things in progress (gene exchanges), so a stopping broker can wait
+until there are none.
+'''
+class InFlight(object):
+
+    def __init__(self):
+        self.count = 0
+        self.changed = threading.Condition()
+
+    def begin(self):
+        with self.changed:
+            self.count += 1
+
+    def end(self):
+        with self.changed:
+            self.count -= 1
+            if self.count == 0:
+                self.changed.notify_all()
+
+    # Wait until nothing is in progress, or timeout seconds; True if nothing is
+    def wait_idle(self, timeout=None):
+        with self.changed:
+            return self.changed.wait_for(lambda: self.count == 0, timeout)
+
+
+'''
+Everything two paired robots exchange: the G (genes) and T (second best genes)
+rendezvous and, for robots that offload their generations (N), their parents
+and the job breeding both. Created by the robot that claims the partner,
+shared by both.
+'''
+class GeneExchange(object):
+
+    def __init__(self):
+        self.genes = Rendezvous()
+        self.second_best_genes = Rendezvous()
+        self.parents = Rendezvous() # (mother, father) of a robot that sent N
+        self.offspring = None # Future of the job breeding both partners, once one of them submitted it
+        self.lock = threading.Lock()
+
+    # The job breeding both partners: submit() starts it, unless the partner already did
+    def breed(self, submit):
+        with self.lock:
+            if self.offspring is None:
+                self.offspring = submit()
+            return self.offspring
+
+#
+# -------------------- -------------- --------------------
+#
+
+#
+# -------------------- Protocol state machine --------------------
+#
+
+'''
+The session below is a generator that yields these effects whenever it needs
+the outside world; the engine performs the effect and sends the result back in.
+That keeps one copy of the INIT/DRIVE/GEN_PROT/FORWARD_GENES state machine for
+both the threaded engine and the asyncio engine.
+'''
+
+# Receive the next message; resumes with a framing.Frame (None when the client closed the socket)
+class Recv(object):
+    __slots__ = ()
+
+# Send a message (encoded in the connection's framing); resumes with None
+class Send(object):
+    __slots__ = ("kind", "payload")
+    def __init__(self, kind, payload=b""):
+        self.kind = kind
+        self.payload = payload
+
+# Wait on a concurrent.futures.Future; resumes with its result, or None on timeout (or once the broker is closing)
+class Wait(object):
+    __slots__ = ("future", "timeout")
+    def __init__(self, future, timeout=None):
+        self.future = future
+        self.timeout = timeout
+
+# Send one of the arena's cached replies (arena.replies) as is; resumes with None
+class SendCached(object):
+    __slots__ = ("kind",)
+    def __init__(self, kind):
+        self.kind = kind
+
+
+'''
+One connected myRIO (or the webcam).
+'''
+class RobotSession(object):
+
+    '''
+    This is called the first time the myRIO connects to the server.
+
+    '''
+    def __init__(self, server, client_address, name, connection):
 
+        self.server = server
+        self.client_address = client_address
+        self.connection = connection # The engine's connections.Connection
 
-        '''
-        This is called the first time the myRIO connects to the server.
+        # Set the index of the thread
+        self.thread_index = server.thread_index # Set the index of the thread
+        server.thread_index += 1 # Increment the thread_index for the server
+        self.log = broker_logging.session_log(self.thread_index) # Indents by thread index, like the old print_tabs
 
-        '''
-    	def setup(self):
+        # Display connection details
+        self.log.info('%s:%s connected', *self.client_address) # Print connection details
+        self.log.info('Serving in %s', name)
 
-                # Current thread
-        	cur_thread = threading.current_thread() # Start a new thread
+        # Set state to INIT
+        self.STATE = "INIT" # State of the robot thread (always start in INIT)
+        self.ENTERED = time.perf_counter() # When it got into that state (metrics)
+        self.COLOR = None
+        self.ROBOT = None
+        self.ARENA = None
 
-                # Set the index of the thread
-                self.thread_index = server.thread_index # Set the index of the thread
-                server.thread_index += 1 # Increment the thread_index for the server
+        self.PARTNER = None # Single robot is sad
+        self.EXCHANGE = None # GeneExchange with the partner
+        self.IN_EXCHANGE = False # Counted in server.exchanges
+        self.CODEC = None # gene_codec.GeneCodec for G and T payloads, if the client asked for an encoding
 
-                # Display connection details
-        	print('{}{}:{} connected'.format(print_tabs(self.thread_index), *self.client_address)) # Print connection details
-        	print('{}Serving in {}'.format(print_tabs(self.thread_index), cur_thread.name))
+        # Figure out which arena this is (by IP); if the IP is in several, the HELLO will tell
+        candidates = server.arenas.for_address(self.client_address[0])
 
-                # Set state to INIT
-        	self.STATE = "INIT" # State of the robot thread (always start in INIT)
-            	self.COLOR = None
+        # If We don't know what color this robot is.... we have problems
+        if not candidates:
+            self.log.warning("**ILLEGAL ROBOT CONNECTING! UNKNOWN COLOR**")
 
-            	# Figure out what color myRIO is connecting; set the self.COLOR variable to that color
-            	for color in server.myRIOs:
-                	if self.client_address[0] == server.myRIOs[color]["ip"]:
-                    		self.COLOR = color
-				print("{}Thread's Color Set to: {}".format(print_tabs(self.thread_index), self.COLOR))
-                                break
+        elif len(candidates) == 1:
+            self.join(candidates[0])
 
-                # If We don't know what color this robot is.... we have problems
-            	if self.COLOR == None:
-                	print("{}**ILLEGAL ROBOT CONNECTING! UNKNOWN COLOR**".format(print_tabs(self.thread_index)))
-                        exit()
+        else:
+            self.log.info("%s is configured in %d arenas; waiting for a HELLO naming one", self.client_address[0], len(candidates))
 
-                # We don't need to set this stuff for webcam; these configurations are for robots!
+    # Join arena: figure out what color myRIO is connecting (by IP) and set the self.COLOR variable to that color
+    def join(self, arena):
+
+        self.ROBOT = arena.myRIOs.by_address(self.client_address[0])
+        if self.ROBOT == None:
+            self.log.warning("**ILLEGAL ROBOT CONNECTING! NOT IN ARENA %s**", arena.name)
+            return False
+
+        self.ARENA = arena
+        self.COLOR = self.ROBOT.color
+        self.connection.color = self.COLOR
+        self.connection.frames.set_gene_size(arena.gene_size)
+        arena.connections.add(self.connection)
+
+        self.ROBOT.state = self.STATE
+        self.log.extra["color"] = self.COLOR
+        self.log.info("Thread's Color Set to: %s (arena %s)", self.COLOR, arena.name)
+
+        # We don't need to set this stuff for webcam; these configurations are for robots!
+        if self.COLOR != "webcam":
+            # Set robot state to initial values
+            with self.ROBOT.lock:
+                self.ROBOT.genes = gene_buffer(arena.gene_size)
+                self.ROBOT.second_best_genes = gene_buffer(arena.gene_size)
+                self.ROBOT.partner = None
+
+        if DEBUG:
+            print_data_dictionary(arena)
+
+        return True
+
+
+    '''
+    Generator that runs the protocol for this connection, yielding effects.
+    'self.client_address' returns a (ip, 'port') pair, which you can use to
+    figure out which myRIO connected to the server
+    '''
+    def run(self):
+
+        try:
+            yield from self.protocol()
+        finally:
+            # Hung up (or was closed) in the middle of an exchange; don't keep a stopping broker waiting on it
+            self.end_exchange()
+            if self.ARENA is not None:
+                self.ARENA.connections.remove(self.connection)
+            if self.ROBOT is not None:
+                self.ROBOT.state = None
+
+    # Move to another handler state (timing how long the last one lasted, if timing is on)
+    def enter(self, state):
+
+        if state == self.STATE:
+            return
+
+        now = time.perf_counter()
+        if self.server.metrics.timing:
+            self.server.metrics.state.observe(now - self.ENTERED, (self.STATE,))
+        self.ENTERED = now
+        self.STATE = state
+        if self.ROBOT is not None:
+            self.ROBOT.state = state
+
+    # Genes of an encoded G or T payload; None (after logging it) if it doesn't decode, and we hang up
+    def decode_genes(self, payload):
+
+        try:
+            return self.CODEC.decode(payload)
+        except gene_codec.CodecError as err:
+            self.log.warning("%s sent genes that don't decode: %s", self.COLOR, str(err))
+            return None
+
+    # Where the webcam saw robot color: remember it, and move it in the arena's index
+    def move(self, color, coordinates):
+
+        arena = self.ARENA
+        if color in arena.myRIOs and color != "webcam":
+            arena.myRIOs[color].location = coordinates
+            arena.locations.update(color, *coordinates)
+
+    def begin_exchange(self):
+        self.IN_EXCHANGE = True
+        self.server.exchanges.begin()
+
+    def end_exchange(self):
+        if self.IN_EXCHANGE:
+            self.IN_EXCHANGE = False
+            self.server.exchanges.end()
+
+    def protocol(self):
+
+        server = self.server
+
+        # Nobody we know; hang up
+        if self.ARENA is None and not server.arenas.for_address(self.client_address[0]):
+            return
+
+        # Configured in several arenas: the first message must be a HELLO naming one (H with the arena name)
+        hello = None
+        while self.ARENA is None:
+
+            self.frame = yield Recv()
+            if self.frame is None:
+                return
+
+            kind, payload = self.frame
+            arena = server.arenas.get(bytes(payload).decode(errors='replace')) if kind == b"H" else None
+
+            if arena is None or not self.join(arena):
+                yield Send(b"X") # TRY AGAIN
+            elif self.COLOR == "webcam":
+                yield Send(b"A") # The webcam's HELLO only picks its arena
+            else:
+                hello = self.frame # Handled below, like any HELLO
+
+        arena = self.ARENA
+
+        # Loop so that the connection is not closed
+        while True:
+
+            # ---------- Special Conditions ----------
+
+            # Next complete message (the framing layer deals with partial and coalesced TCP packets)
+            if hello is None:
+                self.frame = yield Recv()
+            else:
+                self.frame, hello = hello, None
+
+            # check if the client closed the socket; if so, we're done with that connection
+            if self.frame is None:
+                self.log.info("%s is closing connection", self.COLOR)
+                break
+
+            kind, payload = self.frame
+
+            if self.COLOR != "webcam" and self.log.isEnabledFor(logging.DEBUG): # We don't want to see what the webcam is sending
+                self.log.debug("%s(Thread=%d) (STATE:%s, COLOR:%s) wrote:", self.client_address[0], self.thread_index, self.STATE, self.COLOR)
+                self.log.debug("Received(%d): %s", len(payload), kind.decode(errors='replace'))
+
+
+            # ---------- Special Conditions ----------
+
+            # ---------- If Server in DONE state ----------
+            # If the arena is in the DONE MODE; tell all robots and webcam to stop
+            if arena.DONE == True and DEBUG == False:
+
+                # Already pushed D; this is what the client sent before reading it, so drain until it hangs up
+                if self.connection is not None and self.connection.finished:
+                    continue
+
+                self.log.info("The Server is done; return the result and stop")
+
+                # It's the webcam; let him know he's done
+                if kind in (b"W", b"L"):
+                    yield Send(b"D")
+
+                # Robot is sending me a message
                 else:
-                        if self.COLOR != "webcam":
-                                # Set data dictionary to initial values, and print the contents
-                                server.myRIOs[self.COLOR]["colliding"] = False # Is robot in collision?
-                                server.myRIOs[self.COLOR]["genes"] = None # What are the robot's genes?
-                                server.myRIOs[self.COLOR]["genes_ready"] = False # Are the robot's genes ready to forward?
-                                server.myRIOs[self.COLOR]["second_best_genes"] = None # What is the robot's second best child's genes?
-                                server.myRIOs[self.COLOR]["second_best_genes_ready"] = False # Are those ready to be forwarded?
-                                server.myRIOs[self.COLOR]["second_best_genes_received"] = False # Have the 2nd best genes been received?
-                                server.myRIOs[self.COLOR]["partner"] = None
+                    yield Send(b"D", arena.RESULT) # Send the DONE message with result
+                break
 
-                if DEBUG:
-                        print_data_dictionary()
+            # ---------- ---------- ---------- ----------
 
-                self.PARTNER = None # Single robot is sad
-        	self.STILL_RECEIVING = False # If I don't receive the complete payload; need to fill up the rest of the buffer (TCP hack)
+            # ---------- If webcam is sending a message ----------
 
+            # If the webcam contacts us, update locations
+            elif kind == b"W":
 
-    	def handle(self):
+                # Do stuffs; update dictionary (payload is color:x,y)
+                color, _, location = bytes(payload).decode(errors='replace').partition(":")
 
-        	'''
-        	This is called every time the myRIO connected to this handler sends
-        	a message to the server. 'self.client_address' returns a (ip, 'port')
-        	pair, which you can use to figure out which myRIO connected to the server
-        	'''
-        
-        	# Loop so that the connection is not closed
-        	while True:
+                # Parse once here (not on every partner lookup) and move the robot in the index
+                coordinates = parse_location(location)
+                if coordinates is not None:
+                    self.move(color, coordinates)
 
-                        # ---------- Special Conditions ----------
+                self.log.debug("Webcam: Updating location:%s:%s", color, location)
 
-                        # If all data hasn't arrived yet, fill self.data with next TCP packet (TCP hack)
-            		if self.STILL_RECEIVING == True:
-            			self.data = self.data + self.request.recv(1538 - len(self.data))#.strip()
-            		else:
-            			self.data = self.request.recv(1538)#.strip()
+                yield Send(b"A") # Thanks
 
-                        # check if the client closed the socket; if so, we're done with that connection
-                        if len(self.data) == 0: 
-                                print("{}{} is closing connection".format(print_tabs(self.thread_index), self.COLOR))
-                                break
+            # ---------- ---------- ---------- ----------
 
 
-                        # Only display data if self.data is complete
-                        if not self.STILL_RECEIVING:
-                                if self.COLOR != "webcam": # We don't want to see what the webcam is sending
-                                        print("{}{}(Thread={}) (STATE:{}, COLOR:{}) wrote:".format(print_tabs(self.thread_index), self.client_address[0], self.thread_index, self.STATE, self.COLOR))
-                                        print("{}Received({}): {}".format(print_tabs(self.thread_index), len(self.data), self.data.split(':')[0]))
+            # ---------- If the webcam sends a batch of locations ----------
 
+            # Every robot's location in one frame (framed only), never acknowledged. Batches already
+            # received behind this one are merged in: each robot moves once, to where it was seen last
+            elif kind == b"L" and self.connection.frames.mode == framing.FRAMED:
 
-                        # ---------- Special Conditions ----------
+                locations = parse_locations(payload)
+                batches = 1
+                frame = self.connection.frames.next_frame_of(b"L")
+                while frame is not None:
+                    self.connection.received(frame)
+                    locations.extend(parse_locations(frame.payload))
+                    batches += 1
+                    frame = self.connection.frames.next_frame_of(b"L")
 
-                        # ---------- If Server in DONE state ----------
-            		# If server is in the DONE MODE; tell all robots and webcam to stop
-            		if server.DONE == True and DEBUG == False:
+                latest = dict(locations)
+                for color in latest:
+                    self.move(color, latest[color])
+                arena.stale_locations += len(locations) - len(latest)
 
-            			print("{}The Server is done; return the result and stop".format(print_tabs(self.thread_index)))
+                self.log.debug("Webcam: Updating %d locations from %d batches", len(latest), batches)
 
-            			# It's the webcam; let him know he's done
-            			if self.data.startswith("W"):
-            				self.response = "DONE"
+            # ---------- ---------- ---------- ----------
 
-            			# Robot is sending me a message
-            			else:
-            				self.response = "D:" + server.RESULT # Can include the final image here
-            			
-            			self.request.sendall(self.response) # Send the DONE message with result
-            			break
 
-                        # ---------- ---------- ---------- ----------
+            # ---------- If a framed client asks for a gene encoding ----------
 
-                        # ---------- If webcam is sending a message ----------
+            # Any time before its next G or T; we answer with the one we picked (empty: none, genes stay raw)
+            elif kind == b"E" and self.connection.frames.mode == framing.FRAMED:
 
-            		# If the webcam contacts us, update locations
-            		elif self.data.startswith("W"):
+                encoding = gene_codec.negotiate(payload)
+                self.CODEC = gene_codec.GeneCodec() if encoding is not None else None
+                self.log.info("%s asked for gene encodings %s; using %s", self.COLOR, bytes(payload).decode(errors='replace'), encoding or "none")
 
-            			# Do stuffs; update dictionary
-                                color = (self.data.split("W:")[1]).split(":")[0]
-                                location = (self.data.split("W:")[1]).split(":")[1]
+                yield Send(b"E", (encoding or "").encode())
 
-                                if color in server.myRIOs:
-				    server.myRIOs[color]["location"] = location # x and y are separated by commas
-                                 
-                                if DEBUG:
-                                        print("{} Webcam: Updating location:{}".format(print_tabs(self.thread_index), self.data))
+            # ---------- ---------- ---------- ----------
 
-            			self.request.sendall("Thanks")
 
-                        # ---------- ---------- ---------- ----------
+            # ---------- If in any state, and we get a DONE message ----------
 
+            # Check if we receive a DONE message; let everyone know it's DONE time!!
+            elif kind == b"D":
 
-                        # ---------- If in any state, and we get a DONE message ----------
+                if not DEBUG:
+                    self.enter("DONE") # Not strictly necessary, but to be consistent
 
-            		# Check if we receive a DONE message; let everyone know it's DONE time!!
-            		elif self.data.startswith("D"):
+                self.log.info("Received a D for Done from %s robot; setting RESULT", self.COLOR)
 
-                                if not DEBUG:
-                                        self.STATE = "DONE" # Not strictly necessary, but to be consistent
+                arena.RESULT = bytearray(payload) # Grab the result
+                if arena.history is not None:
+                    arena.history.set_result(arena.RESULT)
 
-            			if len(self.data) < 1538:
-            				self.STILL_RECEIVING = True
-            				continue
-            			else:
-            				self.STILL_RECEIVING = False
+                if not DEBUG:
+                    arena.DONE = True # Set the arena's DONE
 
-            			print("{}Received a D for Done from {} robot; setting RESULT".format(print_tabs(self.thread_index), self.COLOR))
-            			
-                                server.RESULT = bytearray(self.data.split("D:")[1]) # Grab the result
-            			
-                                if not DEBUG:
-                                        server.DONE = True # Set global DONE
+                    # Tell everybody else in the arena right away, rather than on their next message
+                    pushed = arena.connections.broadcast(b"D", arena.RESULT, exclude=self.connection)
+                    self.log.info("Pushing DONE to %d connections in arena %s", len(pushed), arena.name)
+                    arena.finished.set()
+                    if server.arenas.all_done():
+                        server.finished.set()
 
-                                if DEBUG:
-                                        print("Showing Result")
-                                        show_image(server.RESULT)
+                if DEBUG:
+                    self.log.info("Showing Result")
+                    show_image(arena.RESULT, arena.image_size)
 
-            			break
+                break
 
-                        # ---------- ---------- ---------- ----------
+            # ---------- ---------- ---------- ----------
 
 
-                        # ---------- If in the INIT state ----------
+            # ---------- If in the INIT state ----------
 
-            		# If in the INIT stage ...
-            		elif self.STATE == "INIT":
+            # If in the INIT stage ...
+            elif self.STATE == "INIT":
 
-            			# We received an incorrect message
-            			if(self.data.find("H") == -1):
-            				self.response = "TRY AGAIN"
-            				self.request.sendall(self.response)
-            				continue
+                # We received an incorrect message
+                if kind != b"H":
+                    yield Send(b"X") # TRY AGAIN
+                    continue
 
-                                print("{}Received HELLO from {}".format(print_tabs(self.thread_index), self.COLOR))
+                self.log.info("Received HELLO from %s", self.COLOR)
 
-                                # Wait for server.COUNT robots to connect to the Broker
-                                server.COUNT -= 1
+                # Wait for arena.COUNT robots to connect to the Broker
+                waiting = arena.start_barrier.arrive()
 
-                                print("{} Server Waiting on {} robots...".format(print_tabs(self.thread_index), server.COUNT))
+                self.log.info("Server Waiting on %d robots...", waiting)
 
-                                if not SINGLE_BOT:
-                                        while server.COUNT > 0:
-                                                pass
+                if not SINGLE_BOT:
+                    if (yield Wait(arena.start_barrier.released, START_TIMEOUT)) is None:
+                        self.log.warning("Timed out waiting on %d robots; starting anyway", arena.start_barrier.count)
 
-            			self.response = "S:"+server.target_image # Send target image
+                self.log.info("Sending START to %s robot", self.COLOR)
 
-                                print("{} Sending START to {} robot".format(print_tabs(self.thread_index), self.COLOR))
+                yield SendCached(b"S") # Send target image
+                self.enter("DRIVE")
 
-            			self.request.sendall(self.response)
-            			self.STATE = "DRIVE"
+            # ---------- ---------- ---------- ----------
 
-                        # ---------- ---------- ---------- ----------
 
+            # ---------- If in the DRIVE state ----------
+            elif self.STATE == "DRIVE":
 
-                        # ---------- If in the DRIVE state ----------
-            		elif self.STATE == "DRIVE":
+                # Robot Collided
+                if kind == b"C":
 
-            			# Robot Collided
-            			if(self.data.find("C") != -1):
+                    collided = time.time()
 
-                                        server.myRIOs[self.COLOR]["colliding"] = True
-                                        potential_partners = find_potential_partners(self.COLOR) # Return a list of potential partners (based on GVS)
+                    self.log.debug("Received a collision message from Robot %s", self.COLOR)
 
-            				print("{} Received a collision message from Robot {}".format(print_tabs(self.thread_index), self.COLOR))
-                                        print("{} There are {} potential partners".format(print_tabs(self.thread_index), len(potential_partners)))
+                    # The broker is stopping; no new exchanges
+                    if server.stopping:
+                        pairing = None
 
-                                        self.PARTNER = None # No partner assigned
+                    else:
+                        # Paired right away if a robot nearby is already waiting; otherwise wait (without holding anything) for one to collide
+                        matched = arena.matchmaker.collide(self.COLOR)
+                        pairing = yield Wait(matched, PAIRING_TIMEOUT)
 
-                                        time.sleep(1) # Wait for a whole second, and see who's available (has collided in the meantime)
+                        # Nobody came; unless somebody paired with us just as we gave up, it was an obstacle
+                        if pairing is None and not arena.matchmaker.cancel(self.COLOR, matched):
+                            pairing = matched.result()
 
-                                        server.lock.acquire()
+                    # Check who it collided with
+                    if pairing is None:
+                        self.PARTNER = None # No partner assigned
+                        self.response = b"O" # O message with target image (not used), unless compact
+                        self.log.debug("Sending an Obstacle Message to %s", self.COLOR)
+                        self.enter("DRIVE")
+                    else:
+                        self.PARTNER, self.EXCHANGE = pairing # The GeneExchange is shared by both of us for the G and T messages
+                        self.begin_exchange()
+                        self.ROBOT.partner = self.PARTNER
+                        self.log.info("Robot %s partnered with Robot %s", self.COLOR, self.PARTNER)
+                        self.response = b"R" # R message with target image (not used), unless compact
+                        self.log.debug("Sending a Robot Message to %s", self.COLOR)
+                        self.enter("GEN_PROT")
 
-                                        # We've been claimed!
-                                        if server.myRIOs[self.COLOR]["partner"] != None:
-                                                self.PARTNER = server.myRIOs[self.COLOR]["partner"]
-                                                print("{}Robot {} partnered with Robot {}".format(print_tabs(self.thread_index), self.COLOR, self.PARTNER))
+                    yield SendCached(self.response)
+                    latency = time.time() - collided
+                    arena.matchmaker.record(latency)
+                    if server.metrics.timing:
+                        server.metrics.pairing.observe(latency)
 
-                                        else:
-                                                for color in potential_partners:
-                                                        # If someone set my partner to themselves... ive been claimed OR this dude's colliding
-                                                        if server.myRIOs[color]["colliding"]:
-                                                                server.myRIOs[color]["colliding"] = False # Set that robot to not be colliding; we have claimed it as our partner
-                                                                server.myRIOs[self.COLOR]["colliding"] = False # both of us are not available anymore
-                                                                server.myRIOs[color]["partner"] = self.COLOR
-                                                                self.PARTNER = color
-                                                                print("{}Robot {} partnered with Robot {}".format(print_tabs(self.thread_index), self.COLOR, self.PARTNER))
-                                                                break # We're partnered!!!!
+                else:
+                    self.log.warning("Received incorrect message from robot %s", self.COLOR)
 
-                                        server.lock.release()
+            # ---------- ---------- ---------- ----------
 
-                                        if self.PARTNER == None:
-                                                #print("{}Robot {} has no partner".format(print_tabs(self.thread_index), self.COLOR))
-                                                robot_collision = False
-                                                server.myRIOs[self.COLOR]["colliding"] = False
-                                        else:
-                                                #print("{}Robot {} has partner {}".format(print_tabs(self.thread_index), self.COLOR, self.PARTNER))
-                                                robot_collision = True
 
-                                        # Check who it collided with
-            				if not robot_collision:
-            					self.response = "O:" + server.target_image # O message with target image (not used)
-            					print("{}Sending an Obstacle Message to {}".format(print_tabs(self.thread_index), self.COLOR))
-            					self.STATE = "DRIVE"
-            				else:
-            					self.response = "R:" + server.target_image # R message with target image (not used)
-            					print("{}Sending a Robot Message to {}".format(print_tabs(self.thread_index), self.COLOR))
-                                                self.STATE = "GEN_PROT"
-                                                server.myRIOs[self.COLOR]["partner"] = None
+            # ---------- If in the GEN_PROT state ----------
 
-            				self.request.sendall(self.response)
+            elif self.STATE == "GEN_PROT":
 
-                                else:
-                                        print("{} ERROR: Received incorrect message from robot {}".format(print_tabs(self.thread_index), self.COLOR))
+                if kind == b"G":
 
-                        # ---------- ---------- ---------- ----------
+                    self.log.debug("%s sent a G message", self.COLOR)
 
+                    if self.CODEC is not None:
+                        payload = self.decode_genes(payload)
+                        if payload is None:
+                            break
 
-                        # ---------- If in the GEN_PROT state ----------
+                    self.ROBOT.genes = copy_into(self.ROBOT.genes, payload)
+                    if arena.history is not None:
+                        arena.history.append(b"G", self.COLOR, self.PARTNER, self.ROBOT.genes)
 
-            		elif self.STATE == "GEN_PROT":
+                    # Sleep until the partner's genes arrive
+                    self.EXCHANGE.genes.post(self.COLOR, self.ROBOT.genes)
+                    self.GENES = yield Wait(self.EXCHANGE.genes.future(self.PARTNER), EXCHANGE_TIMEOUT)
 
-            			if(self.data.find("G") != -1):
+                    # Partner never showed up; hand the robot its own genes back so it isn't stuck
+                    if self.GENES is None:
+                        self.log.warning("Timed out waiting on genes from %s", self.PARTNER)
+                        self.GENES = self.ROBOT.genes
 
+                    self.log.debug("Forwarding Genes from %s to %s", self.COLOR, self.PARTNER)
 
-            				if len(self.data) < 1538:
-            					self.STILL_RECEIVING = True
-            					continue
-            				else:
-            					self.STILL_RECEIVING = False
+                    self.enter("FORWARD_GENES")
 
-            				print("{}{} sent a G message".format(print_tabs(self.thread_index), self.COLOR))
+                    # Saved by a background writer (if enabled); never rendered here
+                    if arena.snapshots is not None:
+                        arena.snapshots.submit(arena.snapshot_label("{}_from_{}".format(self.COLOR, self.PARTNER)), self.GENES, arena.image_size)
 
-                                        server.myRIOs[self.COLOR]["genes"] = bytearray(self.data.split('G:')[1])
-                                        server.myRIOs[self.COLOR]["genes_ready"] = True
+                    yield Send(b"G", self.GENES if self.CODEC is None else self.CODEC.encode(self.GENES))
+                    self.log.debug("Forwarded genes")
 
-                                        while not server.myRIOs[self.PARTNER]["genes_ready"]:
-                                                pass
+                # Offloaded generation (framed only): mother and father in, the next generation's mother and father out, no T
+                elif kind == b"N" and self.connection.frames.mode == framing.FRAMED:
 
-            				self.GENES = server.myRIOs[self.PARTNER]["genes"]
+                    if self.CODEC is not None:
+                        payload = self.decode_genes(payload)
+                        if payload is None:
+                            break
 
-                                        print("{}Forwarding Genes from {} to {}".format(print_tabs(self.thread_index), self.COLOR, self.PARTNER))
-                                        
-                                        self.response = "G:" + self.GENES
-                                        self.STATE = "FORWARD_GENES"
+                    if server.breeder is None or len(payload) != 2 * arena.gene_size:
+                        self.log.warning("%s sent N with %d bytes of genes; not offloading", self.COLOR, len(payload))
+                        yield Send(b"X") # TRY AGAIN (with G and T)
+                        continue
 
-            				print("{}Showing contents of genes message".format(print_tabs(self.thread_index)))
-            				show_image(self.GENES)
+                    mother, father = bytes(payload[:arena.gene_size]), bytes(payload[arena.gene_size:])
+                    self.ROBOT.genes = copy_into(self.ROBOT.genes, mother)
 
-            				self.request.sendall(self.response)
-                                        print("{}Forwarded genes".format(print_tabs(self.thread_index)))
+                    # The partner gets our mother whether it sent G or N; if it sent N, its parents are posted before its mother
+                    self.EXCHANGE.parents.post(self.COLOR, (mother, father))
+                    self.EXCHANGE.genes.post(self.COLOR, self.ROBOT.genes)
+                    partner_genes = yield Wait(self.EXCHANGE.genes.future(self.PARTNER), EXCHANGE_TIMEOUT)
+                    partner_parents = self.EXCHANGE.parents.future(self.PARTNER)
 
-                        # ---------- ---------- ---------- ----------
+                    brood = 0
+                    if partner_genes is None:
+                        self.log.warning("Timed out waiting on genes from %s; breeding %s alone", self.PARTNER, self.COLOR)
+                        bred = server.breeder.submit(arena, [[mother, father]])
+                    elif partner_parents.done():
+                        # Both offloaded: one job breeds us both, each with the other's mother to pick from
+                        parents = {self.COLOR: (mother, father), self.PARTNER: partner_parents.result()}
+                        colors = sorted(parents)
+                        brood = colors.index(self.COLOR)
+                        bred = self.EXCHANGE.breed(lambda: server.breeder.submit(
+                            arena, [list(parents[color]) + [parents[other][0]] for color, other in zip(colors, reversed(colors))]))
+                    else:
+                        bred = server.breeder.submit(arena, [[mother, father, partner_genes]])
 
+                    offspring = yield Wait(bred, EXCHANGE_TIMEOUT)
+                    if offspring is None:
+                        self.log.warning("No offloaded generation for %s; handing its parents back", self.COLOR)
+                        mother, father, second_best_genes = mother, father, father
+                    else:
+                        mother, father, second_best_genes = offspring[brood]
 
-                        # ---------- If in the FORWARD_GENES state ----------
-            		elif self.STATE == "FORWARD_GENES":
+                    # A partner that sent G still expects our second best child in its T
+                    self.ROBOT.second_best_genes = copy_into(self.ROBOT.second_best_genes, second_best_genes)
+                    self.EXCHANGE.second_best_genes.post(self.COLOR, self.ROBOT.second_best_genes)
 
-            			if(self.data.find("T") != -1):
+                    self.enter("DRIVE")
 
-            				if len(self.data) < 1538:
-            					self.STILL_RECEIVING = True
-                                                print("{}Didn't get the whole gene message from robot {}".format(print_tabs(self.thread_index), self.COLOR))
-            					continue
-            				else:
-            					self.STILL_RECEIVING = False
+                    if arena.snapshots is not None:
+                        arena.snapshots.submit(arena.snapshot_label("{}_bred_with_{}".format(self.COLOR, self.PARTNER)), mother, arena.image_size)
+                    if arena.history is not None:
+                        arena.history.append(b"N", self.COLOR, self.PARTNER, mother)
 
-                                        server.myRIOs[self.COLOR]["genes_ready"] = False
-            				server.myRIOs[self.COLOR]["second_best_genes"] = bytearray(self.data.split('T:')[1])
-                                        server.myRIOs[self.COLOR]["second_best_genes_received"] = False
-                                        server.myRIOs[self.COLOR]["second_best_genes_ready"] = True
+                    yield Send(b"N", mother + father if self.CODEC is None else self.CODEC.encode(mother + father))
+                    self.log.debug("Sent %s its offloaded generation", self.COLOR)
 
-                                        print("{} Robot {} is waiting on second best genes from other".format(print_tabs(self.thread_index), self.COLOR))
+                    # This pairing is over, as after T
+                    self.ROBOT.partner = None
+                    self.PARTNER = None
+                    self.EXCHANGE = None
+                    self.end_exchange()
 
-                                        while not server.myRIOs[self.PARTNER]["second_best_genes_ready"]:
-                                                pass
+            # ---------- ---------- ---------- ----------
 
-            				self.response = "T:"+server.myRIOs[self.PARTNER]["second_best_genes"]
 
-            				self.STATE = "DRIVE"
+            # ---------- If in the FORWARD_GENES state ----------
+            elif self.STATE == "FORWARD_GENES":
 
-            				print("{}Forwarding Second best child message from {} to {}".format(print_tabs(self.thread_index), self.COLOR, self.PARTNER))
+                if kind == b"T":
 
-            				self.request.sendall(self.response)
+                    if self.CODEC is not None:
+                        payload = self.decode_genes(payload)
+                        if payload is None:
+                            break
 
-                                        print("{}Forwarded Second best child message from {} to {}".format(print_tabs(self.thread_index), self.COLOR, self.PARTNER))
+                    self.ROBOT.second_best_genes = copy_into(self.ROBOT.second_best_genes, payload)
+                    if arena.history is not None:
+                        arena.history.append(b"T", self.COLOR, self.PARTNER, self.ROBOT.second_best_genes)
 
+                    self.log.debug("Robot %s is waiting on second best genes from other", self.COLOR)
 
-                                        server.myRIOs[self.COLOR]["second_best_genes_received"] = True
+                    self.EXCHANGE.second_best_genes.post(self.COLOR, self.ROBOT.second_best_genes)
+                    second_best_genes = yield Wait(self.EXCHANGE.second_best_genes.future(self.PARTNER), EXCHANGE_TIMEOUT)
 
-                                        print("{}{}Set 2nd best genes recvd".format(print_tabs(self.thread_index), self.COLOR))
+                    if second_best_genes is None:
+                        self.log.warning("Timed out waiting on second best genes from %s", self.PARTNER)
+                        second_best_genes = self.ROBOT.second_best_genes
 
-                                        while not server.myRIOs[self.PARTNER]["second_best_genes_received"]:
-                                                pass
+                    self.enter("DRIVE")
 
-                                        server.myRIOs[self.COLOR]["second_best_genes_ready"] = False
+                    self.log.debug("Forwarding Second best child message from %s to %s", self.COLOR, self.PARTNER)
 
-                                        print("{}{}Set 2nd best genes ready to false".format(print_tabs(self.thread_index), self.COLOR))
+                    yield Send(b"T", second_best_genes if self.CODEC is None else self.CODEC.encode(second_best_genes))
 
-                        # ---------- ---------- ---------- ----------
+                    self.log.debug("Forwarded Second best child message from %s to %s", self.COLOR, self.PARTNER)
 
+                    # This pairing is over; the next collision gets a fresh GeneExchange
+                    self.ROBOT.partner = None
+                    self.PARTNER = None
+                    self.EXCHANGE = None
+                    self.end_exchange()
 
-	def finish(self):
-        	print('{}:{} disconnected'.format(*self.client_address))
+            # ---------- ---------- ---------- ----------
 
-        
-class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
-	pass
-    
+#
+# -------------------- -------------- --------------------
+#
 
-	'''
-    	HOST := IP address of computer where broker is running (String)
-    	PORT := Port number that myRIOs connect to (Int > 9999)
+
+'''
+A threaded engine connection: replies and the pushed D are written with
+blocking sends on the handler's socket.
+'''
+class ThreadedConnection(connections.Connection):
+
+    def __init__(self, color, sock, frames, counters=None, recording=None):
+        super().__init__(color, frames, counters, recording)
+        self.sock = sock
+
+    def write(self, buffers):
+        sendall_buffers(self.sock, buffers)
+
+    def close_output(self):
+        self.sock.shutdown(socket.SHUT_WR)
+
+    # Wakes the handler up if it's blocked in recv
+    def abort(self):
+        self.sock.shutdown(socket.SHUT_RDWR)
+
+
+'''
+The RequestHandler class for our server (threaded engine): one thread per
+connection drives a RobotSession, blocking on each effect.
+
+'''
+class MyRIOConnectionHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.frames = framing.FrameReader()
+        recording = self.server.recorder.open(self.client_address) if self.server.recorder is not None else None
+        self.connection = ThreadedConnection(None, self.request, self.frames, self.server.metrics.open(), recording)
+        self.server.connections.add(self.connection)
+        self.session = RobotSession(self.server, self.client_address, threading.current_thread().name, self.connection)
+
+    def handle(self):
+
+        session = self.session.run()
+        metrics = self.server.metrics
+        result = None
+
+        while True:
+            try:
+                effect = session.send(result)
+            except StopIteration:
+                break
+
+            result = None
+            if isinstance(effect, Recv):
+                result = self.recv_frame()
+                if result is not None:
+                    self.connection.received(result)
+            elif isinstance(effect, Send):
+                self.connection.send(self.frames.encode(effect.kind, effect.payload), effect.kind, effect.payload)
+            elif isinstance(effect, SendCached):
+                self.connection.send((self.session.ARENA.replies.encoded(self.frames.mode, effect.kind),), effect.kind)
+            elif isinstance(effect, Wait):
+                started = time.perf_counter() if metrics.timing else None
+                futures.wait((effect.future, self.server.closing), effect.timeout, futures.FIRST_COMPLETED)
+                result = effect.future.result() if effect.future.done() else None
+                if started is not None:
+                    metrics.waiting.observe(time.perf_counter() - started, (self.session.STATE,))
+
+    # Next complete frame, receiving straight into the connection's buffer; None once the client is gone
+    def recv_frame(self):
+
+        try:
+            frame = self.frames.next_frame()
+            while frame is None:
+                received = self.request.recv_into(self.frames.buffer())
+                if received == 0:
+                    return None
+                self.frames.commit(received)
+                self.connection.count_read(received)
+                frame = self.frames.next_frame()
+        except framing.ProtocolError as err:
+            self.session.log.warning("%s:%s protocol error: %s", self.client_address[0], self.client_address[1], str(err))
+            return None
+        except ConnectionError:
+            return None # Reset; e.g. a client that hung up without reading the D we pushed
+
+        return frame
+
+    def finish(self):
+        if self.connection.recording is not None:
+            self.connection.recording.close()
+        self.server.metrics.close(self.connection.counters)
+        self.server.connections.remove(self.connection)
+        self.session.log.info('%s:%s disconnected', *self.client_address)
+
+
+class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 100 # Listen backlog (socketserver's 5 drops connects when robots start together); as asyncio's
+
+    # Stop accepting connections (serve_forever returns); the ones already open keep being served
+    def stop_accepting(self):
+        self.shutdown()
+
+
+    '''
+    HOST := IP address of computer where broker is running (String)
+    PORT := Port number that myRIOs connect to (Int > 9999)
             You may have to set your computer to allow incoming connections
             on this port number through administrative tools
-    	'''
+    '''
+
+#
+# -------------------- Lifecycle --------------------
+#
+
+'''
+A broker that can be embedded (tests, benchmarks, the load generator) as
+well as run from the command line. It hosts the arena given to the
+constructor (if any) and those added with add_arena(). start() serves from a
+background thread, wait() blocks until every arena is done (a robot sent D)
+or request_stop() was called, and stop() shuts it down:
+
+ 1. stop accepting connections and pairing robots (collisions get O)
+ 2. let the gene exchanges in progress finish, for up to drain_timeout
+    seconds (once DONE, also give the clients that long to hang up)
+ 3. wake every wait, close every connection and wait for the handlers to end
+ 4. close the listening socket, the snapshot writer, the recording, the
+    histories, the breeding workers and the stats port
+
+Given a stats_address, start() also serves the metrics (see metrics.py) there;
+timing turns the timing histograms on from the start. Given a record
+filename, every frame of the session is recorded there (see recording.py).
+Given offload (a number of worker processes, 0 for one per core), robots can
+have the broker breed their generations (N messages, see breeding.py). Given
+a history directory, every arena's exchanges are kept there (see history.py),
+in files of history_size bytes of records.
+'''
+class Broker(object):
+
+    def __init__(self, myRIOs=None, count=0, target_image=None, address=('', 8080), engine="threads", compact_replies=COMPACT_REPLIES,
+                 image_size=framing.IMAGE_SIZE, stats_address=None, timing=False, record=None, offload=None,
+                 history=None, history_size=None):
+
+        if engine == "asyncio":
+            import async_broker
+            self.server = async_broker.AsyncTCPServer(address)
+        else:
+            self.server = ThreadedTCPServer(address, MyRIOConnectionHandler)
+
+        init_server(self.server, myRIOs, count, target_image, compact_replies, image_size)
+        self.server.metrics.timing = timing
+
+        self.engine = engine
+        self.compact_replies = compact_replies
+        self.image_size = image_size
+        self.stats_address = stats_address
+        self.stats = None # metrics.StatsServer, once started
+        self.record = record
+        self.offload = offload
+        self.history = history
+        self.history_size = history_size
+        self.thread = None
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    @property
+    def server_address(self):
+        return self.server.server_address
+
+    # Host another GA session (also while serving; images of the broker's size unless given); returns its Arena
+    def add_arena(self, name, myRIOs, count, target_image, image_size=None):
+        return add_arena(self.server, name, myRIOs, count, target_image, self.compact_replies, image_size or self.image_size)
+
+    # The broker's metrics.BrokerMetrics
+    @property
+    def metrics(self):
+        return self.server.metrics
+
+    # Switch the timing histograms on or off (also while serving)
+    def set_timing(self, enabled):
+        self.server.metrics.timing = enabled
+
+    # Arena named name (the one given to the constructor by default)
+    def arena(self, name=arenas.DEFAULT):
+        return self.server.arenas[name]
+
+    def start(self):
+
+        # Recording starts with the arenas' settings, so a replay can set them up again
+        if self.record is not None:
+            self.server.recorder = recording.Recorder(self.record)
+            for arena in self.server.arenas:
+                self.server.recorder.arena(arena)
+
+        # Only the histories and offloading need NumPy
+        if self.history is not None:
+            import history
+            self.server.history = history.History(self.history, self.history_size or history.HISTORY_SIZE)
+            for arena in self.server.arenas:
+                arena.history = self.server.history.open(arena)
+
+        if self.offload is not None:
+            import breeding
+            self.server.breeder = breeding.Breeder(self.offload or None)
+            watch_breeder(self.server)
+
+        if self.stats_address is not None:
+            server = self.server
+            self.stats = metrics.StatsServer(self.stats_address, server.metrics, lambda: server_state(server)).start()
+
+        self.thread = threading.Thread(target=self.server.serve_forever, name="broker")
+        self.thread.daemon = True
+        self.thread.start()
+
+        return self
+
+    # Make wait() return; only sets an event, so it's safe from a signal handler
+    def request_stop(self):
+        self.server.finished.set()
+
+    # Block until the session is done or a stop was requested; False on timeout
+    def wait(self, timeout=None):
+        return self.server.finished.wait(timeout)
+
+    def stop(self, drain_timeout=DRAIN_TIMEOUT):
+
+        with self.lock:
+            if self.stopped or self.thread is None:
+                return
+            self.stopped = True
+
+        server = self.server
+        log = broker_logging.log
+        deadline = time.time() + drain_timeout
+
+        server.stopping = True
+        server.finished.set()
+        server.stop_accepting()
+
+        if not server.exchanges.wait_idle(drain_timeout):
+            log.warning("Stopping with %d gene exchanges still in progress", server.exchanges.count)
+        if server.arenas.all_done():
+            server.connections.wait_closed(max(0.0, deadline - time.time()))
+
+        server.closing.set_result(True)
+        for connection in server.connections:
+            connection.close()
+        if not server.connections.wait_closed(CLOSE_TIMEOUT):
+            log.warning("%d connections did not close", len(server.connections))
+
+        server.shutdown()
+        server.server_close()
+        self.thread.join()
+
+        if server.breeder is not None:
+            server.breeder.close()
+
+        for writer in set(arena.snapshots for arena in server.arenas if arena.snapshots is not None):
+            if not writer.close():
+                log.warning("Gave up waiting for the snapshots still queued for %s", writer.directory)
+            if writer.failed:
+                log.warning("%d snapshots could not be saved in %s", writer.failed, writer.directory)
+
+        if server.recorder is not None:
+            if not server.recorder.close():
+                log.warning("Gave up waiting for the records still queued for %s", self.record)
+            if server.recorder.dropped:
+                log.warning("%d records were dropped from %s (marked by gap records)", server.recorder.dropped, self.record)
+            if server.recorder.failed:
+                log.warning("%d records could not be written to %s", server.recorder.failed, self.record)
+
+        if server.history is not None:
+            if not server.history.close():
+                log.warning("Gave up waiting for the exchanges still queued for the histories in %s", self.history)
+            if server.history.failed:
+                log.warning("%d exchanges could not be written to the histories in %s", server.history.failed, self.history)
+            if server.history.dropped:
+                log.warning("%d exchanges were left out of the histories in %s", server.history.dropped, self.history)
+
+        if self.stats is not None:
+            self.stats.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+# Have SIGINT and SIGTERM ask the broker to stop; a second one kills the process. SIGUSR1 switches timing on and off (main thread only)
+def install_signal_handlers(broker):
+
+    def handle(signum, frame):
+        signal.signal(signum, signal.SIG_DFL)
+        broker.request_stop()
+
+    def toggle_timing(signum, frame):
+        broker.set_timing(not broker.metrics.timing)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, handle)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, toggle_timing)
+
+#
+# -------------------- -------------- --------------------
+#
 
 if __name__ == "__main__":
 
 
     try:
-        opts, args  = getopt.getopt(sys.argv[1:], "hi:f:") # Arguments -c, -i, -f are required; -h is not
+        opts, args  = getopt.getopt(sys.argv[1:], "hi:f:", ["engine=", "log-level=", "log-format=", "snapshots=", "snapshot-format=", "compact-replies", "drain-timeout=", "arena=", "image-size=", "stats-port=", "timing", "record=", "offload=", "history=", "history-size="]) # Arguments -i, -f are required (unless there are arenas); the rest are not
     except getopt.GetoptError as err:
-    	usage()
+        usage()
         sys.exit(2)
 
     input_file = None
     configuration_file = None
-
-    count = 0
+    engine = "threads"
+    log_level = "info"
+    log_format = "text"
+    snapshot_directory = None
+    snapshot_format = "png"
+    compact_replies = COMPACT_REPLIES
+    drain_timeout = DRAIN_TIMEOUT
+    arena_options = [] # (name, configuration file, target image) of every --arena
+    image_size = framing.IMAGE_SIZE
+    stats_port = None
+    timing = False
+    record = None
+    offload = None
+    history_directory = None
+    history_size = None
 
     # Parse the arguments
     for opt, arg in opts:
-		if opt == '-h':
-			usage()
-			sys.exit()
-		elif opt in ("-i"):
-			input_file = arg
-		elif opt in ("-f"):
-			configuration_file = arg
-
-    if(input_file == None or configuration_file == None):
-		usage()
-		sys.exit(2)
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt in ("-i"):
+            input_file = arg
+        elif opt in ("-f"):
+            configuration_file = arg
+        elif opt == "--engine":
+            engine = arg
+        elif opt == "--log-level":
+            log_level = arg
+        elif opt == "--log-format":
+            log_format = arg
+        elif opt == "--snapshots":
+            snapshot_directory = arg
+        elif opt == "--snapshot-format":
+            snapshot_format = arg
+        elif opt == "--compact-replies":
+            compact_replies = True
+        elif opt == "--drain-timeout":
+            drain_timeout = float(arg)
+        elif opt == "--image-size":
+            try:
+                image_size = parse_image_size(arg)
+            except ValueError:
+                usage()
+                sys.exit(2)
+        elif opt == "--stats-port":
+            stats_port = int(arg)
+        elif opt == "--timing":
+            timing = True
+        elif opt == "--record":
+            record = arg
+        elif opt == "--offload":
+            offload = int(arg)
+        elif opt == "--history":
+            history_directory = arg
+        elif opt == "--history-size":
+            history_size = int(float(arg) * 1024 * 1024)
+        elif opt == "--arena":
+            try:
+                arena_options.append(parse_arena_option(arg))
+            except ValueError:
+                usage()
+                sys.exit(2)
+
+    if((input_file == None) != (configuration_file == None) or (input_file == None and not arena_options) or engine not in ENGINES or log_level not in broker_logging.LEVELS
+       or log_format not in broker_logging.FORMATS or snapshot_format not in snapshots.FORMATS or (offload is not None and offload < 0)
+       or (history_size is not None and history_size <= 0)):
+        usage()
+        sys.exit(2)
+
+    # Log through a background writer, so handlers never wait on the console
+    log = broker_logging.setup(log_level, log_format)
 
     # Set server hostname to be local and port to 8888
     HOST, PORT = '', 8080 # list on port 8080 for all available interfaces
 
     # Create the server, binding to all interfaces on port 8080
-    server = ThreadedTCPServer((HOST, PORT), MyRIOConnectionHandler)
+    # The stats port only listens locally
+    stats_address = ('127.0.0.1', stats_port) if stats_port is not None else None
 
-    # A dictionary of connected myRIOS associating color and address
-    server.myRIOs = {}
-    server.thread_index = 0
+    broker = Broker(address=(HOST, PORT), engine=engine, compact_replies=compact_replies, image_size=image_size,
+                    stats_address=stats_address, timing=timing, record=record, offload=offload,
+                    history=history_directory, history_size=history_size)
+    server = broker.server
 
-    # Open the configuration file
-    try:
-		configuration = open(configuration_file, 'r')
-    except:
-		print("Cannot read configuration file")
-		exit(2)
+    # The -i/-f session is the default arena; every --arena adds another
+    if configuration_file is not None:
+        arena_options.insert(0, (arenas.DEFAULT, configuration_file, input_file))
 
-    # Parse configuration file
-    for config in configuration:
-		color = config.split(':')[0]
-		ip = config.split(':')[1].strip()
-		server.myRIOs[color] = {}
-		server.myRIOs[color]["ip"] = ip
-                if color != "webcam":
-		      count +=1 
-
-    configuration.close()
-
-    # Show robot count and contents of the data dictionary
-    print("Robot Count:{}\n".format(count))
+    # Open the configuration files
+    for name, arena_configuration, arena_image in arena_options:
+        try:
+            myRIOs, count = read_configuration(arena_configuration)
+        except IOError:
+            print("Cannot read configuration file {}".format(arena_configuration))
+            sys.exit(2)
+        try:
+            broker.add_arena(name, myRIOs, count, load_target_image(arena_image, image_size))
+        except ValueError as err:
+            print(err)
+            sys.exit(2)
 
-    print_data_dictionary()
-    
-    server.COUNT = count
-    server.DONE = False
-    server.img = Image.open(input_file).convert('RGB').resize((32,16))
+    writer = None
+    if snapshot_directory is not None:
+        writer = snapshots.SnapshotWriter(snapshot_directory, snapshot_format)
 
-    # convert image to byte array
-    int_list = [pix for tupl in list(server.img.getdata()) for pix in tupl]
-    server.target_image = bytearray(int_list)
+    for arena in server.arenas:
+        arena.snapshots = writer
 
-    # This is the final image
-    server.RESULT = None
+        # Show robot count and contents of the data dictionary
+        log.info("Arena %s Robot Count:%d\n", arena.name, arena.COUNT)
 
-    # Lock to be used by the threads to prevent a deadlock
-    server.lock = threading.Lock()
-    server.lock2 = threading.Lock()
+        print_data_dictionary(arena)
 
-    server.colliding_bots = []
+        # Print target image size in bytes
+        log.info('Arena %s target image is size: %d (%dx%d)', arena.name, len(arena.target_image), *arena.image_size)
 
-    # Print target image size in bytes
-    print('Target image is size: {}'.format(len(server.target_image)))
-    show_image(server.target_image)
+    if arenas.DEFAULT in server.arenas:
+        show_image(broker.arena().target_image, image_size)
 
     # Start the server thread
-    server_thread = threading.Thread(target=server.serve_forever)
-
-    server_thread.daemon = True
-    server_thread.start()
-    print "Server loop running in thread:", server_thread.name
-
-    # Loop until Ctrl+C is pressed
-    while True:
-        try:
-            pass
-
-        except KeyboardInterrupt:
-            server.shutdown()
-               
+    broker.start()
+    log.info("Server loop running in thread: %s (%s engine)", broker.thread.name, engine)
+    if record is not None:
+        log.info("Recording the session to %s", record)
+    if history_directory is not None:
+        log.info("Keeping the generation histories in %s", history_directory)
+    if offload is not None:
+        log.info("Breeding offloaded generations on %d worker processes", server.breeder.workers)
+    if broker.stats is not None:
+        log.info("Stats on http://%s:%d/metrics and /state (timing %s)", broker.stats.server_address[0], broker.stats.server_address[1], "on" if timing else "off")
+
+    # Sleep until a robot reports the result, or SIGINT (Ctrl+C) / SIGTERM; then drain and stop
+    install_signal_handlers(broker)
+    broker.wait()
+
+    if server.arenas.all_done():
+        log.info("Session done; stopping")
+    else:
+        log.info("Stopping (draining for up to %gs)", drain_timeout)
+    broker.stop(drain_timeout)
+    log.info("Stopped")
+
+    broker_logging.shutdown()
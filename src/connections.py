@@ -0,0 +1,158 @@
+'''
+Connection registry for the Communication Broker
+Every engine registers its open connections here, so the broker can reach all
+of them at once: as soon as a robot reports the result, broadcast() pushes D
+(with the result; bare for the webcam) to everybody else, concurrently, rather
+than waiting for each of them to send its next message.
+
+A connection that got D is finished: whatever its session still sends is
+dropped, and the broker stops writing to it. Legacy clients read the pushed D
+as the reply to whatever they send next.
+'''
+
+import threading
+from concurrent import futures
+
+MAX_PUSH_WORKERS = 32 # Most sockets written at the same time
+
+
+'''
+One open connection, encoding with its framing.FrameReader. Engines subclass
+it and implement write(buffers), close_output() and abort(); send(), finish()
+and close() may be called from any thread. Given counters (a
+metrics.ConnectionCounters), it counts what it receives (engines call
+count_read and received) and sends; given a recording
+(recording.ConnectionRecording), it records those messages too.
+'''
+class Connection(object):
+
+    def __init__(self, color, frames, counters=None, recording=None):
+        self.color = color
+        self.frames = frames
+        self.counters = counters
+        self.recording = recording
+        self.finished = False # Got D; nothing more gets sent
+        self.lock = threading.Lock() # Keeps a push from interleaving with a reply
+
+    # Send a reply (tuple of buffers; a kind message with payload, if given) unless the connection is finished
+    def send(self, buffers, kind=None, payload=b""):
+        with self.lock:
+            if not self.finished:
+                self.write(buffers)
+                self.count_sent(kind, buffers, payload)
+
+    # Send kind and payload as the last message, then close our side; False if it was already finished
+    def finish(self, kind, payload=b""):
+
+        with self.lock:
+            if self.finished:
+                return False
+            self.finished = True
+            try:
+                buffers = self.encode(kind, payload)
+                self.write(buffers)
+                self.count_sent(kind, buffers, payload)
+                self.close_output()
+            except OSError:
+                pass # Already gone
+
+        return True
+
+    # Close the connection without another word (the broker is stopping); its handler sees the end of stream
+    def close(self):
+
+        with self.lock:
+            self.finished = True
+        try:
+            self.abort()
+        except OSError:
+            pass # Already gone
+
+    # Count (and record) a kind message (None: just the bytes) made of buffers as sent; with the lock held
+    def count_sent(self, kind, buffers, payload=b""):
+
+        counters = self.counters
+        if counters is not None:
+            if kind is not None:
+                counters.sent[kind] = counters.sent.get(kind, 0) + 1
+            for buffer in buffers:
+                counters.bytes_out += len(buffer)
+
+        if self.recording is not None and kind is not None:
+            self.recording.sent(self.frames.mode, kind, payload)
+
+    # Count nbytes read from the socket (from the handler only)
+    def count_read(self, nbytes):
+        if self.counters is not None:
+            self.counters.bytes_in += nbytes
+
+    # Count (and record) a frame received (from the handler only)
+    def received(self, frame):
+
+        if self.counters is not None:
+            self.counters.received[frame.kind] = self.counters.received.get(frame.kind, 0) + 1
+        if self.recording is not None:
+            self.recording.received(self.frames.mode, frame)
+
+    # Encode a message the way this connection's client expects it
+    def encode(self, kind, payload=b""):
+        return self.frames.encode(kind, payload)
+
+    def write(self, buffers):
+        raise NotImplementedError
+
+    # Tell the client we won't send anything else (it reads up to here, then end of stream)
+    def close_output(self):
+        raise NotImplementedError
+
+    # Shut the connection down both ways
+    def abort(self):
+        raise NotImplementedError
+
+
+class ConnectionRegistry(object):
+
+    def __init__(self):
+        self.connections = set()
+        self.changed = threading.Condition()
+
+    def add(self, connection):
+        with self.changed:
+            self.connections.add(connection)
+
+    def remove(self, connection):
+        with self.changed:
+            self.connections.discard(connection)
+            self.changed.notify_all()
+
+    def __len__(self):
+        return len(self.connections)
+
+    # Iterate over a snapshot, so connections may come and go meanwhile
+    def __iter__(self):
+        with self.changed:
+            return iter(list(self.connections))
+
+    '''
+    Push kind (D) to every connection but exclude: with payload to the robots,
+    bare to the webcam. The writes run on a pool of threads, so one robot on a
+    slow link doesn't hold up the others; returns their futures.
+    '''
+    def broadcast(self, kind, payload=b"", exclude=None):
+
+        with self.changed:
+            targets = [connection for connection in self.connections if connection is not exclude]
+        if not targets:
+            return []
+
+        pool = futures.ThreadPoolExecutor(min(MAX_PUSH_WORKERS, len(targets)), thread_name_prefix="push")
+        pushed = [pool.submit(connection.finish, kind, b"" if connection.color == "webcam" else payload)
+                  for connection in targets]
+        pool.shutdown(wait=False)
+
+        return pushed
+
+    # Wait until every connection is closed, or timeout seconds; True if they all were
+    def wait_closed(self, timeout=None):
+        with self.changed:
+            return self.changed.wait_for(lambda: not self.connections, timeout)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+'''
+Convergence of a session, from its generation history (communication_broker.py --history, see history.py)
+Reads the history file straight from its memory mapping, so it can also run
+while the broker is still writing it. Reports every robot's exchanges and
+fitness (first, best, latest: the Hamming distance from the target, lower is
+better) and how the arena's best fitness came down over the session.
+
+With -o <directory>, also writes the target, the result (if there is one) and
+the genes of every k-th record (-k) as images (PPM, or BMP with --bmp),
+numbered in order, to look at the convergence frame by frame. With -w, keeps
+reading and prints every new best fitness as it comes in, until Ctrl+C.
+
+usage: convergence.py [-o <directory> [-k <every k-th record>] [--bmp]] [-w] <history file>
+'''
+
+import getopt
+import os
+import sys
+import time
+
+import history
+import image_codec
+
+STEPS = 10 # Points of the best fitness timeline
+WATCH_INTERVAL = 0.5 # Seconds between looks at a history being written (-w)
+
+
+def usage():
+    print('usage: convergence.py [-o <directory> [-k <every k-th record>] [--bmp]] [-w] <history file>')
+
+# Seconds as minutes:seconds
+def clock(seconds):
+    return "{:d}:{:04.1f}".format(int(seconds // 60), seconds % 60)
+
+def report(store):
+
+    records = store.latest()
+    print("arena {}: {}x{} images, {} records ({} appended, room for {}), {}".format(
+        store.arena or "default", store.size[0], store.size[1], len(records), store.count, store.capacity,
+        "result reported" if store.has_result() else "no result yet"))
+    if not len(records):
+        return
+
+    started = float(records["time"][0])
+    for robot in sorted(set(records["robot"])):
+        mine = records[records["robot"] == robot]
+        fitness = mine["fitness"]
+        print(" {:16} {:6d} exchanges  first {:9d}  best {:9d}  latest {:9d}  ({})".format(
+            robot.decode(errors='replace'), int(mine["generation"].max()), fitness[0], fitness.min(), fitness[-1],
+            ", ".join("{} {}".format(int((mine["kind"] == kind).sum()), kind.decode()) for kind in (b"G", b"T", b"N") if (mine["kind"] == kind).any())))
+
+    # Best fitness so far, at STEPS points through the session
+    best = records["fitness"].copy()
+    for i in range(1, len(best)):
+        best[i] = min(best[i], best[i - 1])
+    print(" best fitness over time:")
+    for step in range(1, STEPS + 1):
+        i = step * len(records) // STEPS - 1
+        print("  {:>8}  {:9d}".format(clock(float(records["time"][i]) - started), best[i]))
+
+# Target, result and every k-th record's genes as images in directory
+def export(store, directory, k, image_format):
+
+    write = image_codec.write_bmp if image_format == "bmp" else image_codec.write_ppm
+    os.makedirs(directory, exist_ok=True)
+
+    write(os.path.join(directory, "target.{}".format(image_format)), store.target.tobytes(), store.size)
+    if store.has_result():
+        write(os.path.join(directory, "result.{}".format(image_format)), store.result.tobytes(), store.size)
+
+    records = store.latest()
+    written = 0
+    for i in range(0, len(records), k):
+        record = records[i]
+        write(os.path.join(directory, "{:06d}_{}_{}_{}.{}".format(i, record["robot"].decode(errors='replace'), record["kind"].decode(),
+                                                                 record["fitness"], image_format)), record["genes"].tobytes(), store.size)
+        written += 1
+
+    print("wrote {} images to {}".format(written + 1 + store.has_result(), directory))
+
+# Print every new best fitness as the broker appends records
+def watch(store):
+
+    seen = 0
+    best = None
+    while True:
+        count = store.count
+        if count - seen > store.capacity:
+            seen = count - store.capacity # Wrapped past what we hadn't read yet
+        for i in range(seen, count):
+            record = store.records[i % store.capacity]
+            if best is None or record["fitness"] < best:
+                best = int(record["fitness"])
+                print("{} {:9d}  {} ({}, generation {})".format(time.strftime("%H:%M:%S", time.localtime(float(record["time"]))), best,
+                                                              record["robot"].decode(errors='replace'), record["kind"].decode(), record["generation"]))
+        seen = count
+        sys.stdout.flush()
+        time.sleep(WATCH_INTERVAL)
+
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ho:k:w", ["bmp"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    directory = None
+    k = 1
+    image_format = "ppm"
+    watching = False
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt == '-o':
+            directory = arg
+        elif opt == '-k':
+            k = int(arg)
+        elif opt == '--bmp':
+            image_format = "bmp"
+        elif opt == '-w':
+            watching = True
+
+    if len(args) != 1 or k < 1:
+        usage()
+        sys.exit(2)
+
+    try:
+        store = history.read(args[0])
+    except (IOError, ValueError, history.HistoryError) as err:
+        print(err)
+        sys.exit(2)
+
+    report(store)
+    if directory is not None:
+        export(store, directory, k, image_format)
+    if watching:
+        try:
+            watch(store)
+        except KeyboardInterrupt:
+            pass
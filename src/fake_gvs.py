@@ -1,7 +1,6 @@
 import socket
 import sys
 import time
-import Image
 import io
 import random
 
@@ -17,12 +16,14 @@ import random
 # ----------
 # ----------
 
-Grid = [['-' for x in xrange(10)] for x in xrange(10)] # Create a 10x10 array of '-'s to be used as grid
+GRID_SIZE = 10 # Cells per side of the arena
+
+Grid = [['-' for x in range(GRID_SIZE)] for x in range(GRID_SIZE)] # Create a GRID_SIZE x GRID_SIZE array of '-'s to be used as grid
 locations = {}
 
 def clear_grid():
     global Grid
-    Grid = [['-' for x in xrange(10)] for x in xrange(10)] # Create a 10x10 array of '-'s to be used as grid
+    Grid = [['-' for x in range(GRID_SIZE)] for x in range(GRID_SIZE)] # Create a GRID_SIZE x GRID_SIZE array of '-'s to be used as grid
 
 # Generate a random array of bytes (random image)
 def generate_random_genes():
@@ -57,66 +58,73 @@ def update_grid():
         location_y = locations[color][1]
         Grid[location_x][location_y] = color
 
+# One step of the random walk from (x, y) on a size x size grid (also used by load_generator.py)
+def random_step(location, size=GRID_SIZE, rng=random):
+
+    location_x = location[0]
+    location_y = location[1]
+
+    # Find directions that the robot can travel (0=North, 1=East, 2=South, 3=West)
+    available_directions = []
+    if location_x != 0:
+        available_directions.append(3)
+    if location_x != size - 1:
+        available_directions.append(1)
+    if location_y != 0:
+        available_directions.append(0)
+    if location_y != size - 1:
+        available_directions.append(2)
+
+    # Choose random direction
+    direction = available_directions[rng.randint(0,len(available_directions)-1)]
+
+    if direction == 0:
+        return (location_x, location_y-1)
+    if direction == 1:
+        return (location_x+1, location_y)
+    if direction == 2:
+        return (location_x, location_y+1)
+    return (location_x-1, location_y)
+
 # Do one iteration
 def iterate():
 
     global locations
 
     for color in locations:
-        location_x = locations[color][0]
-        location_y = locations[color][1]
-
-        # Find directions that the robot can travel (0=North, 1=East, 2=South, 3=West)
-        available_directions = []
-        if location_x != 0:
-            available_directions.append(3)
-        if location_x != 9:
-            available_directions.append(1)
-        if location_y != 0:
-            available_directions.append(0)
-        if location_y != 9:
-            available_directions.append(2)
-
-        # Choose random direction
-        direction = available_directions[random.randint(0,len(available_directions)-1)]
-
-        if direction == 0:
-            locations[color] = ((locations[color][0], locations[color][1]-1))
-        if direction == 1:
-            locations[color] = ((locations[color][0]+1, locations[color][1]))
-        if direction == 2:
-            locations[color] = ((locations[color][0], locations[color][1]+1))
-        if direction == 3:
-            locations[color] = ((locations[color][0]-1, locations[color][1]))
+        locations[color] = random_step(locations[color])
 
     update_grid()
-    print locations
+    print(locations)
 
-#HOST, PORT = "localhost", 8888
 
-# Create a socket (SOCK_STREAM means a TCP socket)
-#sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+if __name__ == "__main__":
 
-#try:
-    # Connect to server and send data
-    #sock.connect((HOST, PORT))
-    
-'''except:
-    sock.close()
-    print("Could not set up socket connection")
-    sys.exit(0)
-'''
-print('Welcome to the GVS Simulator\n')
+    #HOST, PORT = "localhost", 8888
+
+    # Create a socket (SOCK_STREAM means a TCP socket)
+    #sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-# Initialize robots
-locations["R"] = (0,0)
-locations["B"] = (2,8)
-locations["G"] = (6,1)
+    #try:
+        # Connect to server and send data
+        #sock.connect((HOST, PORT))
+    
+    '''except:
+        sock.close()
+        print("Could not set up socket connection")
+        sys.exit(0)
+    '''
+    print('Welcome to the GVS Simulator\n')
+
+    # Initialize robots
+    locations["R"] = (0,0)
+    locations["B"] = (2,8)
+    locations["G"] = (6,1)
 
-update_grid()
+    update_grid()
 
-for i in range(100):
+    for i in range(100):
 
-    show_grid()
-    time.sleep(1)
-    iterate()
+        show_grid()
+        time.sleep(1)
+        iterate()
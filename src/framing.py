@@ -0,0 +1,292 @@
+'''
+Message framing for the Communication Broker
+Turns the TCP byte stream of a connection into complete (kind, payload)
+frames, whatever the recv() boundaries were, and encodes replies.
+
+Two wire formats, picked per connection from its first byte:
+
+ - legacy (current myRIO firmware): "H", "C", "W:color:x,y" and
+   "G:"/"T:"/"D:" followed by exactly the gene size (GENE_SIZE, unless the
+   arena's images are another size) in bytes
+ - framed: the client first sends MAGIC, then every message (both ways) is a
+   HEADER (kind byte, big-endian payload length) followed by the payload, so
+   payloads may contain any byte (including ':') and be of any size
+
+The image size is a session parameter: the framed S (start) payload is the
+width and height (IMAGE_HEADER) followed by the target image, and robots size
+their genes from it. Legacy S carries the target image alone.
+'''
+
+import collections
+import functools
+import re
+import struct
+
+IMAGE_SIZE = (32, 16) # width, height of the robots' images, unless the arena says otherwise
+GENE_SIZE = 1536 # 32x16 RGB
+IMAGE_HEADER = struct.Struct(">HH") # width, height (framed S payload)
+
+MAGIC = b"\xffGAF" # Framed clients start with this; legacy messages never start with 0xff
+HEADER = struct.Struct(">cI") # kind, payload length
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+LEGACY = "legacy"
+FRAMED = "framed"
+
+# Replies that the legacy firmware expects as plain words instead of "kind:payload"
+LEGACY_REPLIES = {
+    b"A": b"Thanks", # Acknowledge a webcam update
+    b"X": b"TRY AGAIN", # Unexpected message
+}
+
+# Legacy messages carrying genes, and messages made of their kind alone
+LEGACY_GENE_KINDS = (b"G", b"T", b"D")
+LEGACY_BARE_KINDS = (b"H", b"C")
+LEGACY_LOCATION = re.compile(br"W:[^:]*:[-0-9,]*")
+LEGACY_INCOMPLETE_LOCATION = re.compile(br"[-0-9]*(,-?)?") # Coordinates cut off before the comma, or right after it (or its minus sign)
+
+'''
+One message; payload is a memoryview into the reader's buffer, valid until the
+next call to buffer()/feed() on that reader (copy it to keep it longer).
+'''
+Frame = collections.namedtuple("Frame", ["kind", "payload"])
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Header for a framed message; cached, since the same few (kind, length) pairs repeat all session
+@functools.lru_cache(maxsize=256)
+def frame_header(kind, length):
+    return HEADER.pack(kind, length)
+
+# Prefix of a legacy "kind:payload" message
+@functools.lru_cache(maxsize=64)
+def legacy_prefix(kind):
+    return kind + b":"
+
+# Encode one framed message (what a framed client sends, after MAGIC)
+def encode_frame(kind, payload=b""):
+    return frame_header(kind, len(payload)) + payload
+
+# Bytes of genes for an image of size (width, height): 3 (RGB) per pixel
+def gene_size(image_size):
+    return image_size[0] * image_size[1] * 3
+
+# Framed S payload: the image size, then the target image
+def encode_start(image_size, target_image):
+    return IMAGE_HEADER.pack(*image_size) + bytes(target_image)
+
+# Image size and target image (a view) of a framed S payload
+def decode_start(payload):
+
+    if len(payload) < IMAGE_HEADER.size:
+        raise ProtocolError("S payload too short for the image size")
+    image_size = IMAGE_HEADER.unpack_from(payload)
+    target_image = memoryview(payload)[IMAGE_HEADER.size:]
+    if len(target_image) != gene_size(image_size):
+        raise ProtocolError("{}x{} target image is {} bytes".format(image_size[0], image_size[1], len(target_image)))
+
+    return image_size, target_image
+
+
+'''
+Per-connection receive buffer. Engines either recv_into(buffer()) and
+commit(n), or feed(data); then they take frames with next_frame() until it
+returns None (incomplete frame, read more). A frame bigger than the buffer
+(a high resolution image) moves it to a big enough one, which then streams
+recv_into()s of whatever has arrived until the frame is complete.
+'''
+class FrameReader(object):
+
+    def __init__(self, size=4096, gene_size=GENE_SIZE):
+        self.buf = bytearray(size)
+        self.start = 0 # First unconsumed byte
+        self.end = 0 # End of received data
+        self.needed = 1 # Bytes the pending frame needs in total
+        self.mode = None # LEGACY or FRAMED, once the first byte is in
+        self.set_gene_size(gene_size)
+
+    # Size of the genes in legacy G, T and D messages (set once the arena is known)
+    def set_gene_size(self, gene_size):
+        self.legacy_gene_message_size = gene_size + 2 # "G:" + genes
+
+    # Writable view of the free space, with room for at least min_size bytes and the pending frame
+    def buffer(self, min_size=1):
+
+        pending = self.end - self.start
+        size = max(pending + min_size, self.needed)
+
+        # Frame too big for the buffer; move to a bigger one (never resize: frames may still be viewed)
+        if size > len(self.buf):
+            buf = bytearray(max(size, 2 * len(self.buf)))
+            buf[:pending] = self.buf[self.start:self.end]
+            self.buf = buf
+            self.start, self.end = 0, pending
+
+        # Out of room at the end; move the pending bytes to the front
+        elif len(self.buf) - self.end < min_size or len(self.buf) - self.start < self.needed:
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.start, self.end = 0, pending
+
+        return memoryview(self.buf)[self.end:]
+
+    # Account for n bytes received into buffer()
+    def commit(self, n):
+        self.end += n
+
+    # Copy received data into the buffer
+    def feed(self, data):
+        self.buffer(len(data))[:len(data)] = data
+        self.commit(len(data))
+
+    # Next complete frame, or None if more data is needed
+    def next_frame(self):
+
+        while self.start < self.end:
+
+            if self.mode is None:
+                if self.buf[self.start] != MAGIC[0]:
+                    self.mode = LEGACY
+                elif self.end - self.start < len(MAGIC):
+                    self.needed = len(MAGIC)
+                    return None
+                elif self.buf[self.start:self.start + len(MAGIC)] != MAGIC:
+                    raise ProtocolError("bad preamble")
+                else:
+                    self.mode = FRAMED
+                    self.start += len(MAGIC)
+                    continue
+
+            if self.mode == FRAMED:
+                frame = self.framed()
+            else:
+                frame = self.legacy()
+
+            if frame is not None:
+                self.needed = 1
+                return frame
+            if self.needed > 0:
+                return None
+
+        # Everything consumed; start over at the front of the buffer
+        self.start = self.end = 0
+        return None
+
+    # The next frame if it is complete and of kind (framed mode only); otherwise None, and it is left for next_frame
+    def next_frame_of(self, kind):
+
+        if self.mode != FRAMED or self.end - self.start < HEADER.size:
+            return None
+        frame_kind, length = HEADER.unpack_from(self.buf, self.start)
+        if frame_kind != kind or self.end - self.start < HEADER.size + length:
+            return None
+
+        return self.next_frame()
+
+    # Framed mode: header + payload
+    def framed(self):
+
+        available = self.end - self.start
+        if available < HEADER.size:
+            self.needed = HEADER.size
+            return None
+
+        kind, length = HEADER.unpack_from(self.buf, self.start)
+        if length > MAX_PAYLOAD:
+            raise ProtocolError("{} byte payload is too large".format(length))
+
+        if available < HEADER.size + length:
+            self.needed = HEADER.size + length
+            return None
+
+        return self.take(HEADER.size, HEADER.size + length, kind)
+
+    '''
+    Legacy mode. Returns None with needed > 0 if the frame is incomplete, and
+    None with needed == 0 after skipping a byte that starts no message (stray
+    newlines and the like). A location update ends at the first byte that
+    can't be part of it, or at the end of the data received so far (the
+    legacy webcam waits for "Thanks" before sending the next one), unless its
+    coordinates are clearly cut off there: no comma yet, or ending in ',' or
+    '-'. Those wait for the rest.
+    '''
+    def legacy(self):
+
+        available = self.end - self.start
+        kind = bytes(self.buf[self.start:self.start + 1])
+
+        if kind in LEGACY_BARE_KINDS:
+            return self.take(1, 1, kind)
+
+        if kind in LEGACY_GENE_KINDS:
+            if available < self.legacy_gene_message_size:
+                self.needed = self.legacy_gene_message_size
+                return None
+            return self.take(2, self.legacy_gene_message_size, kind)
+
+        if kind == b"W":
+            match = LEGACY_LOCATION.match(self.buf, self.start, self.end)
+            if match is not None and (match.end() < self.end or not self.location_cut_off(match)):
+                return self.take(2, match.end() - self.start, kind)
+            if match is not None or available < 2 or self.buf[self.start + 1:self.start + 2] == b":":
+                self.needed = available + 1
+                return None
+
+        self.start += 1
+        self.needed = 0
+        return None
+
+    # Do the coordinates of a location update running up to the end of the data stop short of x,y?
+    def location_cut_off(self, match):
+        coordinates = self.buf[self.buf.rindex(b":", self.start, match.end()) + 1:match.end()]
+        return LEGACY_INCOMPLETE_LOCATION.fullmatch(coordinates) is not None
+
+    # Consume size bytes as a frame whose payload starts at offset
+    def take(self, offset, size, kind):
+        payload = memoryview(self.buf)[self.start + offset:self.start + size]
+        self.start += size
+        return Frame(kind, payload)
+
+    '''
+    Encode a reply in this connection's format, as a tuple of buffers to send
+    back to back (header, payload): the payload is never copied.
+    '''
+    def encode(self, kind, payload=b""):
+
+        if self.mode == FRAMED:
+            return (frame_header(kind, len(payload)), payload)
+
+        if kind in LEGACY_REPLIES:
+            return (LEGACY_REPLIES[kind],)
+        if kind == b"D" and not payload:
+            return (b"DONE",) # What the legacy webcam gets when the session is over
+        return (legacy_prefix(kind), payload)
+
+
+'''
+Replies that are the same for every robot (S, O and R, which carry the target
+image), fully encoded in both formats once, so sending one is a single
+sendall of an immutable buffer. update() a reply whenever its payload changes;
+framed_payload, if given, is sent to framed clients instead of payload.
+An empty payload makes a compact reply: the bare kind in legacy format, a
+zero-length frame in framed format.
+'''
+class ReplyCache(object):
+
+    def __init__(self):
+        self.replies = {} # kind -> {LEGACY: bytes, FRAMED: bytes}
+
+    def update(self, kind, payload=b"", framed_payload=None):
+
+        payload = bytes(payload)
+        framed_payload = payload if framed_payload is None else bytes(framed_payload)
+        self.replies[kind] = {
+            LEGACY: legacy_prefix(kind) + payload if payload else kind,
+            FRAMED: frame_header(kind, len(framed_payload)) + framed_payload,
+        }
+
+    # The encoded reply for a connection in mode
+    def encoded(self, mode, kind):
+        return self.replies[kind][FRAMED if mode == FRAMED else LEGACY]
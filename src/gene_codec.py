@@ -0,0 +1,108 @@
+'''
+Gene payload encoding for the Communication Broker
+A framed client can ask for its G and T payloads to be encoded (E message
+with the encodings it supports, comma separated; the broker answers E with
+the one it picked, or empty for none). Each encoded payload is a method byte
+followed by the body:
+
+ - RAW: the genes as they are
+ - ZLIB: the genes, zlib-compressed
+ - DELTA: the genes XORed with the last genes sent the same way on this
+   connection (same size), zlib-compressed; a robot's genes only change a
+   little from one exchange to the next, so this is mostly zeros
+
+The sender picks whichever is smallest (RAW when compression doesn't pay off),
+so the receiver just follows the method byte. Both ends keep one GeneCodec
+per connection, which remembers the last genes sent and received.
+'''
+
+import zlib
+
+NAME = "xor-zlib" # The only encoding so far
+ENCODINGS = (NAME,)
+
+RAW = 0
+ZLIB = 1
+DELTA = 2
+
+LEVEL = 1 # zlib level: fastest; a few percent larger than the default
+RETRY_AFTER = 16 # Payloads sent without trying ZLIB, after it didn't save an eighth
+
+
+class CodecError(Exception):
+    pass
+
+
+# Pick our encoding from a client's E payload (comma separated names); None if we share none
+def negotiate(offer):
+
+    for name in bytes(offer).decode(errors='replace').split(","):
+        if name.strip() in ENCODINGS:
+            return name.strip()
+    return None
+
+# a XOR b (same length), a whole buffer at a time
+def xor(a, b):
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+class GeneCodec(object):
+
+    def __init__(self, level=LEVEL):
+        self.level = level
+        self.sent = None # Last genes encoded (what the other end will XOR with)
+        self.received = None # Last genes decoded
+        self.skip = 0 # Payloads left before trying ZLIB again (random-looking genes don't compress)
+
+    # Encoded payload for genes (any buffer)
+    def encode(self, genes):
+
+        genes = bytes(genes)
+        best = (RAW, genes)
+
+        if self.sent is not None and len(self.sent) == len(genes):
+            body = zlib.compress(xor(genes, self.sent), self.level)
+            if len(body) < len(best[1]):
+                best = (DELTA, body)
+
+        # Nothing to XOR with, or the genes changed too much for the delta to compress
+        if best[0] == RAW or len(best[1]) > len(genes) // 2:
+            if self.skip:
+                self.skip -= 1
+            else:
+                body = zlib.compress(genes, self.level)
+                if len(body) < len(best[1]):
+                    best = (ZLIB, body)
+                if len(body) > len(genes) - len(genes) // 8:
+                    self.skip = RETRY_AFTER
+
+        self.sent = genes
+        return bytes((best[0],)) + best[1]
+
+    # Genes (bytes) of an encoded payload
+    def decode(self, payload):
+
+        if len(payload) < 1:
+            raise CodecError("empty gene payload")
+
+        method = payload[0]
+        body = memoryview(payload)[1:]
+        try:
+            if method == RAW:
+                genes = bytes(body)
+            elif method == ZLIB:
+                genes = zlib.decompress(body)
+            elif method == DELTA:
+                if self.received is None:
+                    raise CodecError("delta without earlier genes")
+                genes = zlib.decompress(body)
+                if len(genes) != len(self.received):
+                    raise CodecError("{} byte delta against {} byte genes".format(len(genes), len(self.received)))
+                genes = xor(genes, self.received)
+            else:
+                raise CodecError("unknown gene encoding {}".format(method))
+        except zlib.error as err:
+            raise CodecError(str(err))
+
+        self.received = genes
+        return genes
@@ -0,0 +1,23 @@
+'''
+Genetic algorithm in Python (vectorized with NumPy); see ga.py, and
+islands.py for running several at once on every core.
+genetic_algorithm.cpp in this directory is the original single-threaded tool.
+'''
+
+from genetic.ga import (
+    GeneticAlgorithm,
+    Offspring,
+    crossover,
+    crossover_fitness,
+    crossover_mask,
+    fitness,
+    from_bytes,
+    hamming_diff,
+    mutate,
+    next_generations,
+    pixel_distance,
+    random_genes,
+    to_bytes,
+    tournament,
+)
+from genetic.islands import IslandModel
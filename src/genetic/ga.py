@@ -0,0 +1,281 @@
+'''
+Vectorized genetic algorithm (NumPy port of genetic_algorithm.cpp)
+Instead of generating one child at a time with rand() per pixel, a whole
+generation is handled as one uint8 array of shape (children, rows, cols, 3):
+crossover is a random bit mask, mutations are applied in one batch and fitness
+(Hamming distance from the target) is one reduction.
+
+Children's fitness is not rescanned either: with the per-pixel distances of
+both parents cached, a child's fitness follows from its crossover mask (one
+matrix-vector product) plus the change made by each of its few mutations.
+'''
+
+import collections
+
+import numpy as np
+
+NUM_CHILDREN = 500
+MUTATION_RATE = 0.5 # Chance, per row of every child, of a mutation (as in generate_child)
+CHUNK_BYTES = 16 * 1024 * 1024 # Children are scored in chunks of about this many pixel bytes
+EXACT_PIXELS = 2 ** 24 // 765 # Pixels whose distances (up to 765 each) sum exactly in float32
+
+# What one pair's generation came to (see next_generations)
+Offspring = collections.namedtuple("Offspring", "mother father mother_fitness father_fitness second_best second_best_fitness")
+
+
+# Genes as bytes (what the robots exchange) to a (rows, cols, 3) image, without copying
+def from_bytes(genes, rows, cols):
+    return np.frombuffer(genes, dtype=np.uint8).reshape(rows, cols, 3)
+
+def to_bytes(image):
+    return np.ascontiguousarray(image, dtype=np.uint8).tobytes()
+
+# Random (rows, cols, 3) image
+def random_genes(rows, cols, rng):
+    return rng.integers(0, 256, size=(rows, cols, 3), dtype=np.uint8)
+
+# Hamming distance of one image from the target (sum of per-component differences)
+def hamming_diff(image, target):
+    return int(np.abs(image.astype(np.int16) - target).sum())
+
+# Per-pixel Hamming distance of an image from the target, as a flat int32 array of rows*cols
+def pixel_distance(image, target):
+    return np.abs(image.astype(np.int16) - target).sum(axis=-1, dtype=np.int32).ravel()
+
+'''
+Hamming distance of every image of a population from the target, as an
+int64 array. Computed in chunks so the int16 temporaries stay small.
+'''
+def fitness(population, target):
+
+    result = np.empty(len(population), dtype=np.int64)
+    step = max(1, CHUNK_BYTES // max(1, target.size))
+    target = target.astype(np.int16)
+
+    for start in range(0, len(population), step):
+        chunk = population[start:start + step].astype(np.int16)
+        chunk -= target
+        np.abs(chunk, out=chunk)
+        result[start:start + step] = chunk.reshape(len(chunk), -1).sum(axis=1)
+
+    return result
+
+# Crossover mask: one random bit per pixel per child (1 = from the mother), shape (children, rows*cols)
+def crossover_mask(children, rows, cols, rng):
+
+    pixels = children * rows * cols
+    bits = np.unpackbits(np.frombuffer(rng.bytes(pixels // 8 + 1), dtype=np.uint8))[:pixels]
+    return bits.reshape(children, rows * cols)
+
+'''
+Crossover: every pixel of every child comes from the mother or the father
+with equal chance, as picked by mask (a new crossover_mask if not given):
+child = father ^ ((mother ^ father) & 0xff where the bit is set).
+Writes into (and returns) out when given.
+'''
+def crossover(mother, father, children, rng, out=None, mask=None):
+
+    if out is None:
+        out = np.empty((children,) + mother.shape, dtype=np.uint8)
+    if mask is None:
+        mask = crossover_mask(children, mother.shape[0], mother.shape[1], rng)
+
+    # 0xff for every component of a pixel taken from the mother, 0 otherwise
+    components = np.repeat(mask.reshape(-1), 3)
+    np.negative(components, out=components)
+
+    flat = out.reshape(children, -1)
+    np.bitwise_and(np.bitwise_xor(mother, father).reshape(1, -1), components.reshape(children, -1), out=flat)
+    np.bitwise_xor(flat, father.reshape(1, -1), out=flat)
+
+    return out
+
+'''
+Fitness of children straight from their crossover mask, given the per-pixel
+distances of the mother and father: the father's total plus, for every pixel
+taken from the mother, the difference between the two. The products run in
+float32 over blocks of EXACT_PIXELS, where every partial sum is an exact integer.
+'''
+def crossover_fitness(mother_distance, father_distance, mask):
+
+    children, pixels = mask.shape
+    delta = (mother_distance.astype(np.int64) - father_distance).astype(np.float32)
+    result = np.full(children, int(father_distance.sum()), dtype=np.int64)
+
+    step = max(1, CHUNK_BYTES // (4 * min(pixels, EXACT_PIXELS)))
+    for start in range(0, pixels, EXACT_PIXELS):
+        block = delta[start:start + EXACT_PIXELS]
+        for first in range(0, children, step):
+            products = mask[first:first + step, start:start + EXACT_PIXELS].astype(np.float32) @ block
+            result[first:first + step] += np.rint(products).astype(np.int64)
+
+    return result
+
+'''
+Mutations, as in generate_child: for each row of each child, with chance
+rate, pick a channel c (0=r, 1=g, 2=b) and randomize channel c and every
+channel after it (the switch falls through), each at a random pixel.
+Given the target, returns how much the mutations changed each child's
+fitness (int64 array).
+'''
+def mutate(population, rng, rate=MUTATION_RATE, target=None):
+
+    children, rows, cols = population.shape[:3]
+    pixels = rows * cols
+
+    mutating = rng.random((children, rows)) < rate
+    first_channel = rng.integers(0, 3, size=(children, rows))
+    child_index = np.broadcast_to(np.arange(children)[:, np.newaxis], (children, rows))
+
+    # Every mutated component of every child, as an index into the flattened population
+    positions = []
+    for channel in range(3):
+        child = child_index[mutating & (first_channel <= channel)]
+        positions.append((child * pixels + rng.integers(0, pixels, size=len(child))) * 3 + channel)
+    positions = np.concatenate(positions)
+    values = rng.integers(0, 256, size=len(positions), dtype=np.uint8)
+
+    flat = population.reshape(-1)
+    if target is None:
+        flat[positions] = values
+        return None
+
+    # Score each mutated component once (by its final value), however many times it was hit
+    touched = np.sort(positions)
+    touched = touched[np.concatenate(([True], touched[1:] != touched[:-1]))]
+    wanted = target.reshape(-1).astype(np.int16)[touched % (pixels * 3)]
+
+    old = np.abs(flat[touched].astype(np.int16) - wanted)
+    flat[positions] = values
+    new = np.abs(flat[touched].astype(np.int16) - wanted)
+
+    return np.bincount(touched // (pixels * 3), weights=new - old, minlength=children).astype(np.int64)
+
+'''
+Tournament, as in genetic_algorithm.cpp: the best child replaces the mother
+(which becomes the father) if it beats her, and the runner-up then replaces
+the father if it beats him; otherwise the best child may still replace the
+father. Returns (mother, father, mother fitness, father fitness).
+'''
+def tournament(mother, father, mother_fitness, father_fitness, population, scores):
+
+    order = np.argsort(scores, kind="stable")[:2]
+    best, best_score = order[0], scores[order[0]]
+
+    if best_score < mother_fitness:
+        father, father_fitness = mother, mother_fitness
+        mother, mother_fitness = population[best].copy(), int(best_score)
+        if len(order) > 1 and scores[order[1]] < father_fitness:
+            father, father_fitness = population[order[1]].copy(), int(scores[order[1]])
+    elif best_score < father_fitness:
+        father, father_fitness = population[best].copy(), int(best_score)
+
+    return mother, father, mother_fitness, father_fitness
+
+
+'''
+One generation for each of several mother/father pairs at once, all evolving
+towards the same target: mothers and fathers are (pairs, rows, cols, 3).
+Every pair's children come out of one crossover into a (pairs, children, rows,
+cols, 3) population, which is mutated and scored as a whole; then each pair
+holds its own tournament. Returns an Offspring per pair, with its second best
+child (what a robot sends in T).
+'''
+def next_generations(target, mothers, fathers, num_children, rng, rate=MUTATION_RATE):
+
+    pairs = len(mothers)
+    rows, cols = target.shape[:2]
+
+    # As in crossover(), with each pair's children masking their own parents
+    mask = crossover_mask(pairs * num_children, rows, cols, rng)
+    components = np.repeat(mask.reshape(pairs, num_children, rows * cols), 3, axis=-1)
+    np.negative(components, out=components)
+
+    population = np.bitwise_and(np.bitwise_xor(mothers, fathers).reshape(pairs, 1, -1), components, out=components)
+    np.bitwise_xor(population, fathers.reshape(pairs, 1, -1), out=population)
+
+    population = population.reshape(pairs * num_children, rows, cols, 3)
+    mutate(population, rng, rate)
+    scores = fitness(population, target).reshape(pairs, num_children)
+    population = population.reshape(pairs, num_children, rows, cols, 3)
+
+    offspring = []
+    for i in range(pairs):
+        mother, father, mother_fitness, father_fitness = tournament(
+            mothers[i], fathers[i], hamming_diff(mothers[i], target), hamming_diff(fathers[i], target), population[i], scores[i])
+        second = np.argsort(scores[i], kind="stable")[min(1, num_children - 1)]
+        offspring.append(Offspring(mother, father, mother_fitness, father_fitness, population[i, second].copy(), int(scores[i, second])))
+
+    return offspring
+
+
+class GeneticAlgorithm(object):
+
+    '''
+    A mother/father pair evolving towards target, a (rows, cols, 3) uint8
+    image. The population array is allocated once (or handed in, e.g. in
+    shared memory) and reused every generation.
+    '''
+    def __init__(self, target, num_children=NUM_CHILDREN, mutation_rate=MUTATION_RATE, seed=None, mother=None, father=None, population=None):
+
+        self.target = np.asarray(target, dtype=np.uint8)
+        rows, cols = self.target.shape[:2]
+        self.rng = np.random.default_rng(seed)
+        self.num_children = num_children
+        self.mutation_rate = mutation_rate
+        self.generation = 0
+
+        mother = random_genes(rows, cols, self.rng) if mother is None else np.array(mother, dtype=np.uint8)
+        father = random_genes(rows, cols, self.rng) if father is None else np.array(father, dtype=np.uint8)
+        self.set_parents(mother, father)
+
+        if population is None:
+            population = np.empty((num_children, rows, cols, 3), dtype=np.uint8)
+        self.population = population
+        self.rows, self.cols = rows, cols
+
+    # Replace the parents; the mother is always the better one
+    def set_parents(self, mother, father):
+
+        mother_fitness = hamming_diff(mother, self.target)
+        father_fitness = hamming_diff(father, self.target)
+        if father_fitness < mother_fitness:
+            mother, father = father, mother
+            mother_fitness, father_fitness = father_fitness, mother_fitness
+
+        self.mother, self.father = mother, father
+        self.mother_fitness, self.father_fitness = mother_fitness, father_fitness
+        self.mother_distance = pixel_distance(mother, self.target)
+        self.father_distance = pixel_distance(father, self.target)
+
+    # One generation; returns the mother's (best) fitness
+    def step(self):
+
+        mask = crossover_mask(self.num_children, self.rows, self.cols, self.rng)
+        crossover(self.mother, self.father, self.num_children, self.rng, out=self.population, mask=mask)
+        scores = crossover_fitness(self.mother_distance, self.father_distance, mask)
+        scores += mutate(self.population, self.rng, self.mutation_rate, target=self.target)
+
+        mother, father = self.mother, self.father
+        self.mother, self.father, self.mother_fitness, self.father_fitness = tournament(
+            self.mother, self.father, self.mother_fitness, self.father_fitness, self.population, scores)
+        self.generation += 1
+
+        # Only parents that changed need their per-pixel distances again
+        if self.father is mother:
+            self.father_distance = self.mother_distance
+        elif self.father is not father:
+            self.father_distance = pixel_distance(self.father, self.target)
+        if self.mother is not mother:
+            self.mother_distance = pixel_distance(self.mother, self.target)
+
+        return self.mother_fitness
+
+    # Run up to generations generations, or until the mother is under threshold; returns her fitness
+    def run(self, generations, threshold=0):
+
+        for i in range(generations):
+            if self.step() < threshold:
+                break
+
+        return self.mother_fitness
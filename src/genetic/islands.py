@@ -0,0 +1,176 @@
+'''
+Island-model genetic algorithm on every core
+Each island is a GeneticAlgorithm (its own mother/father pair) evolved by a
+worker process. Every epoch the islands run a few generations, then swap
+genes the way colliding robots do in the broker: each island is handed
+another island's mother (as in G:), who replaces its father if she is better.
+
+The target, parents and populations live in one multiprocessing.shared_memory
+block, so workers are handed only indices: nothing gene-sized is pickled.
+'''
+
+import collections
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from genetic.ga import MUTATION_RATE, NUM_CHILDREN, GeneticAlgorithm, hamming_diff, random_genes
+
+MIGRATION_INTERVAL = 20 # Generations between gene swaps
+
+# Where everything is in the shared block: the (rows, cols, 3) target, the (islands, 2, rows, cols, 3) parents, then the (islands, children, rows, cols, 3) populations
+Layout = collections.namedtuple("Layout", "name islands children rows cols")
+
+# Epoch outcome of one island
+IslandResult = collections.namedtuple("IslandResult", "island generations mother_fitness father_fitness")
+
+
+# Views of the target, parents and populations in a shared block
+def shared_arrays(buffer, layout):
+
+    image = (layout.rows, layout.cols, 3)
+    size = layout.rows * layout.cols * 3
+    target = np.ndarray(image, dtype=np.uint8, buffer=buffer)
+    parents = np.ndarray((layout.islands, 2) + image, dtype=np.uint8, buffer=buffer, offset=size)
+    populations = np.ndarray((layout.islands, layout.children) + image, dtype=np.uint8,
+                             buffer=buffer, offset=(1 + layout.islands * 2) * size)
+    return target, parents, populations
+
+# Bytes of shared memory a layout needs
+def shared_size(layout):
+    return (1 + layout.islands * (2 + layout.children)) * layout.rows * layout.cols * 3
+
+'''
+Worker side: evolve one island for up to generations generations (or until
+its mother is under threshold) and write the new parents back to shared
+memory. The random stream depends only on (seed, island, epoch), so a run is
+reproducible whatever the number of workers.
+'''
+def evolve_island(layout, island, epoch, generations, threshold, mutation_rate, seed):
+
+    block = shared_memory.SharedMemory(name=layout.name)
+    try:
+        target, parents, populations = shared_arrays(block.buf, layout)
+        ga = GeneticAlgorithm(target, num_children=layout.children, mutation_rate=mutation_rate,
+                              seed=(seed, island, epoch), mother=parents[island, 0], father=parents[island, 1],
+                              population=populations[island])
+        ga.run(generations, threshold)
+        parents[island, 0] = ga.mother
+        parents[island, 1] = ga.father
+        result = IslandResult(island, ga.generation, ga.mother_fitness, ga.father_fitness)
+        del target, parents, populations, ga
+    finally:
+        block.close()
+
+    return result
+
+
+class IslandModel(object):
+
+    '''
+    islands GeneticAlgorithms evolving towards target on workers processes
+    (one per core by default). Use as a context manager, or call close(), to
+    release the worker pool and the shared memory.
+    '''
+    def __init__(self, target, islands=None, workers=None, num_children=NUM_CHILDREN, mutation_rate=MUTATION_RATE,
+                 migration_interval=MIGRATION_INTERVAL, seed=None):
+
+        self.target = np.asarray(target, dtype=np.uint8)
+        rows, cols = self.target.shape[:2]
+        self.workers = workers or os.cpu_count() or 1
+        self.islands = islands or self.workers
+        self.mutation_rate = mutation_rate
+        self.migration_interval = migration_interval
+        self.seed = 0 if seed is None else seed
+        self.epoch = 0
+        self.generations = 0 # Generations run, summed over islands
+
+        layout = Layout(None, self.islands, num_children, rows, cols)
+        self.block = shared_memory.SharedMemory(create=True, size=shared_size(layout))
+        self.layout = layout._replace(name=self.block.name)
+        target, self.parents, populations = shared_arrays(self.block.buf, self.layout)
+        target[:] = self.target
+        del target, populations
+
+        rng = np.random.default_rng(self.seed)
+        for island in range(self.islands):
+            self.parents[island, 0] = random_genes(rows, cols, rng)
+            self.parents[island, 1] = random_genes(rows, cols, rng)
+        self.fitness = [(hamming_diff(mother, self.target), hamming_diff(father, self.target)) for mother, father in self.parents]
+
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+            self.parents = None
+            self.block.close()
+            self.block.unlink()
+
+    # Best fitness over all islands
+    def best_fitness(self):
+        return min(min(pair) for pair in self.fitness)
+
+    # Copy of the best genes over all islands
+    def best(self):
+
+        island, parent = min(((i, p) for i in range(self.islands) for p in range(2)), key=lambda ip: self.fitness[ip[0]][ip[1]])
+        return self.parents[island, parent].copy()
+
+    '''
+    Gene swap between epochs, as between colliding robots: every island gets
+    the mother of a partner island (a different one every epoch) and takes
+    her as its father when she beats him (or as its mother if she beats her).
+    '''
+    def migrate(self):
+
+        if self.islands < 2:
+            return
+
+        offset = 1 + self.epoch % (self.islands - 1)
+        mothers = self.parents[:, 0].copy()
+        mother_fitness = [mother for mother, father in self.fitness]
+
+        for island in range(self.islands):
+            partner = (island + offset) % self.islands
+            mother, father = self.fitness[island]
+            if mother_fitness[partner] < father:
+                self.parents[island, 1] = mothers[partner]
+                self.fitness[island] = (mother, mother_fitness[partner])
+                if mother_fitness[partner] < mother:
+                    self.parents[island, [0, 1]] = self.parents[island, [1, 0]]
+                    self.fitness[island] = (mother_fitness[partner], mother)
+
+    # One epoch: every island runs migration_interval generations, then they swap genes
+    def step(self, threshold=0):
+
+        jobs = [self.pool.submit(evolve_island, self.layout, island, self.epoch, self.migration_interval,
+                                 threshold, self.mutation_rate, self.seed)
+                for island in range(self.islands)]
+        for job in jobs:
+            result = job.result()
+            self.fitness[result.island] = (result.mother_fitness, result.father_fitness)
+            self.generations += result.generations
+
+        self.migrate()
+        self.epoch += 1
+        return self.best_fitness()
+
+    # Run up to epochs epochs, or until some island is under threshold; returns the best fitness
+    def run(self, epochs, threshold=0):
+
+        for i in range(epochs):
+            if self.step(threshold) < threshold:
+                break
+
+        return self.best_fitness()
@@ -0,0 +1,228 @@
+'''
+Generation history for the Communication Broker (communication_broker.py --history)
+Every arena gets a file that holds its target image, its result (once a
+robot reports it) and a record of every genes a robot handed over in a G, T
+or N exchange: when, which robot and partner, the robot's generation (its
+exchanges so far, counting this one: the G and T of an exchange share it)
+and fitness (Hamming distance from the target), and the genes themselves.
+Records all have the same size, so the file is allocated once and
+memory-mapped, and readers (convergence.py, or anything else with read())
+get NumPy views straight onto it, also while the session runs.
+
+append() only copies the genes: scoring them and writing the record is left
+to a background writer (background.py), shared by the arenas. Once the file
+is full it wraps around, keeping the latest capacity records.
+
+The file is a HEADER_SIZE header (HEADER, then padding), the target image,
+the result, and, from the next page, the records (record_dtype()). The
+header's count (records appended so far) goes up once a record is written, so
+a reader never sees a record being written, only (after a wrap) one being
+overwritten: read the slot, then check count hasn't gone past it.
+'''
+
+import mmap
+import os
+import time
+
+import numpy as np
+
+import background
+
+MAGIC = b"GAHIST\x00\x01" # Generation history, version 1
+HEADER = np.dtype([("magic", "S8"), ("width", "<u4"), ("height", "<u4"), ("capacity", "<u8"), ("count", "<u8"),
+                   ("record_size", "<u4"), ("has_result", "u1"), ("arena", "S64"), ("started", "<f8")])
+HEADER_SIZE = 4096
+
+HISTORY_SIZE = 256 * 1024 * 1024 # Bytes of records per arena, unless given (--history-size)
+MAX_PENDING = 4096 # Records queued before new ones get dropped
+BATCH_SIZE = 256 # Most records written per wakeup
+
+
+class HistoryError(Exception):
+    pass
+
+
+# One record: time, the robot's generation, message kind, robot and partner (colors), fitness and genes
+def record_dtype(width, height):
+    return np.dtype([("time", "<f8"), ("generation", "<u4"), ("kind", "S1"), ("robot", "S16"), ("partner", "S16"),
+                     ("fitness", "<i8"), ("genes", "u1", (height, width, 3))])
+
+# Where the records start, after the header, target image and result
+def records_offset(width, height):
+    end = HEADER_SIZE + 2 * width * height * 3
+    return -(-end // mmap.PAGESIZE) * mmap.PAGESIZE
+
+# Hamming distance of genes from target (both (rows, cols, 3))
+def fitness(genes, target):
+    return int(np.abs(genes.astype(np.int16) - target).sum())
+
+
+'''
+A history file, mapped: header (a one-element HEADER array), target, result
+and records (record_dtype() array of capacity slots), all views onto it.
+'''
+class HistoryFile(object):
+
+    def __init__(self, filename, mode="r"):
+
+        self.filename = filename
+        header = np.memmap(filename, dtype=HEADER, mode=mode, shape=(1,))
+        if header["magic"][0] != MAGIC:
+            raise HistoryError("{} is not a generation history".format(filename))
+
+        width, height, capacity = int(header["width"][0]), int(header["height"][0]), int(header["capacity"][0])
+        self.size = (width, height)
+        self.header = header
+        self.target = np.memmap(filename, dtype=np.uint8, mode=mode, offset=HEADER_SIZE, shape=(height, width, 3))
+        self.result = np.memmap(filename, dtype=np.uint8, mode=mode, offset=HEADER_SIZE + width * height * 3, shape=(height, width, 3))
+        self.records = np.memmap(filename, dtype=record_dtype(width, height), mode=mode, offset=records_offset(width, height), shape=(capacity,))
+
+    @property
+    def capacity(self):
+        return len(self.records)
+
+    # Records appended so far (more than capacity once it wrapped)
+    @property
+    def count(self):
+        return int(self.header["count"][0])
+
+    @property
+    def arena(self):
+        return self.header["arena"][0].decode(errors='replace')
+
+    def has_result(self):
+        return bool(self.header["has_result"][0])
+
+    # The records still in the file, oldest first: a view, unless it wrapped (then a copy, in order)
+    def latest(self):
+
+        count = self.count
+        if count <= self.capacity:
+            return self.records[:count]
+        start = count % self.capacity
+        return np.concatenate((self.records[start:], self.records[:start]))
+
+    def flush(self):
+        for array in (self.header, self.target, self.result, self.records):
+            array.flush()
+
+
+# Create (or overwrite) a history file for size (width, height) images with room for capacity records; returns it open for writing
+def create(filename, size, capacity, arena=""):
+
+    width, height = size
+    length = records_offset(width, height) + capacity * record_dtype(width, height).itemsize
+
+    with open(filename, 'wb') as f:
+        # Claim the disk space now: writing to a mapped page the disk has no room for kills the process
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(f.fileno(), 0, length)
+        else:
+            f.truncate(length)
+
+    header = np.memmap(filename, dtype=HEADER, mode="r+", shape=(1,))
+    header[0] = (MAGIC, width, height, capacity, 0, record_dtype(width, height).itemsize, 0, arena.encode()[:64], time.time())
+    header.flush()
+    del header
+
+    return HistoryFile(filename, "r+")
+
+# Open a history file to read (also while a broker writes it)
+def read(filename):
+    return HistoryFile(filename, "r")
+
+
+'''
+An arena's history, as the broker writes it (see History.open): append()
+queues a record, set_target() and set_result() write those right away.
+'''
+class ArenaHistory(object):
+
+    def __init__(self, history, store):
+        self.history = history
+        self.store = store
+        self.generations = {} # Robot color -> exchanges it completed (T or N; written by the writer thread only)
+
+    # Queue a record of genes a robot (color) handed over in a kind exchange with partner; False if it was dropped
+    def append(self, kind, color, partner, genes):
+        return self.history.queue((self, time.time(), kind, color, partner, bytes(genes)))
+
+    def set_target(self, target_image):
+        self.store.target[...] = np.frombuffer(bytes(target_image), dtype=np.uint8).reshape(self.store.target.shape)
+
+    def set_result(self, result):
+
+        result = bytes(result)
+        if len(result) != self.store.result.size:
+            return
+        self.store.result[...] = np.frombuffer(result, dtype=np.uint8).reshape(self.store.result.shape)
+        self.store.header["has_result"] = 1
+
+    # Writer thread: score and write one record into the next slot
+    def write(self, when, kind, color, partner, genes):
+
+        store = self.store
+        if len(genes) != store.target.size:
+            return False
+
+        genes = np.frombuffer(genes, dtype=np.uint8).reshape(store.target.shape)
+        generation = self.generations.get(color, 0) + 1
+        if kind != b"G": # T or N completes the exchange
+            self.generations[color] = generation
+
+        count = store.count
+        record = store.records[count % store.capacity]
+        record["time"] = when
+        record["generation"] = generation
+        record["kind"] = kind
+        record["robot"] = color.encode()[:16]
+        record["partner"] = (partner or "").encode()[:16]
+        record["fitness"] = fitness(genes, store.target)
+        record["genes"] = genes
+        store.header["count"] = count + 1
+
+        return True
+
+
+'''
+The generation histories of a broker's arenas: <directory>/<arena>.history
+each, written by one background writer.
+'''
+class History(background.BackgroundWriter):
+
+    def __init__(self, directory, size=HISTORY_SIZE):
+
+        self.directory = directory
+        self.size = size
+        self.arenas = []
+
+        os.makedirs(directory, exist_ok=True)
+        super().__init__("history", MAX_PENDING, BATCH_SIZE)
+
+    # An arena's history file (made with room for as many records as fit in size bytes), holding its target image; returns its ArenaHistory
+    def open(self, arena):
+
+        width, height = arena.image_size
+        capacity = max(1, self.size // record_dtype(width, height).itemsize)
+        store = create(os.path.join(self.directory, "{}.history".format(arena.name)), arena.image_size, capacity, arena.name)
+
+        history = ArenaHistory(self, store)
+        history.set_target(arena.target_image)
+        with self.lock:
+            self.arenas.append(history)
+
+        return history
+
+    # Writer thread: write a record queued by an ArenaHistory (entry: it, then its write() arguments)
+    def write(self, entry):
+        return entry[0].write(*entry[1:])
+
+    # Write what is still queued, stop the writer thread and flush every file to disk; False if the writer didn't finish in time
+    def close(self, timeout=background.CLOSE_TIMEOUT):
+
+        finished = super().close(timeout)
+        with self.lock:
+            for history in self.arenas:
+                history.store.flush()
+
+        return finished
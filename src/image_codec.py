@@ -0,0 +1,79 @@
+'''
+Image conversions for the Communication Broker
+Genes are an image's RGB bytes, row by row from the top left (what Pillow's
+'RGB' mode holds), so converting either way is one frombytes()/tobytes() call
+rather than a Python loop over the pixels. write_bmp() and write_ppm() save
+genes without going through Pillow at all, cheap enough to snapshot every
+generation (like writeBMP in genetic/genetic_algorithm.cpp).
+'''
+
+import random
+import struct
+
+from PIL import Image
+
+BMP_HEADER = struct.Struct('<2sIHHI') # BITMAPFILEHEADER: "BM", file size, reserved, reserved, pixel offset
+BMP_INFO = struct.Struct('<IiiHHIIiiII') # BITMAPINFOHEADER (24 bits, uncompressed)
+
+
+# Pillow image of genes (size is width, height)
+def to_image(genes, size):
+    return Image.frombytes('RGB', tuple(size), bytes(genes))
+
+# Genes of a Pillow image
+def from_image(img):
+    return bytearray(img.convert('RGB').tobytes())
+
+# Genes of an image file, resized to size
+def load(input_file, size):
+    return from_image(Image.open(input_file).convert('RGB').resize(tuple(size)))
+
+# Random genes (a random image) of n bytes, from random's generator so seeding it still works
+def random_genes(n):
+    return bytearray(random.getrandbits(8 * n).to_bytes(n, 'little')) if n else bytearray()
+
+# Check genes hold a whole image of size
+def check_size(genes, size):
+
+    width, height = size
+    if len(genes) != width * height * 3:
+        raise ValueError("{} bytes of genes for a {}x{} image".format(len(genes), width, height))
+
+'''
+24-bit BMP file of genes: BGR rows from the bottom up, each padded to four
+bytes. Swapping the channels is three slice assignments and the rows are
+copied one slice each, so the cost grows with the height, not the pixels.
+'''
+def encode_bmp(genes, size):
+
+    check_size(genes, size)
+    width, height = size
+    row = width * 3
+    padding = bytes(-row % 4)
+
+    rgb = bytes(genes)
+    bgr = bytearray(rgb)
+    bgr[0::3] = rgb[2::3]
+    bgr[2::3] = rgb[0::3]
+
+    bgr = memoryview(bgr)
+    pixels = padding.join([bgr[start:start + row] for start in range((height - 1) * row, -1, -row)]) + padding
+    offset = BMP_HEADER.size + BMP_INFO.size
+
+    return b"".join((BMP_HEADER.pack(b"BM", offset + len(pixels), 0, 0, offset),
+                     BMP_INFO.pack(BMP_INFO.size, width, height, 1, 24, 0, len(pixels), 2835, 2835, 0, 0),
+                     pixels))
+
+# Binary PPM (P6) file of genes: a text header, then the genes as they are
+def encode_ppm(genes, size):
+
+    check_size(genes, size)
+    return b"P6\n%d %d\n255\n" % tuple(size) + bytes(genes)
+
+def write_bmp(filename, genes, size):
+    with open(filename, 'wb') as f:
+        f.write(encode_bmp(genes, size))
+
+def write_ppm(filename, genes, size):
+    with open(filename, 'wb') as f:
+        f.write(encode_ppm(genes, size))
@@ -0,0 +1,583 @@
+#!/usr/bin/env python3
+
+'''
+Load generator for the Communication Broker (replaces socketclient.py)
+Simulates every myRIO of a configuration file (color:ip per line, as in
+robot.conf) plus the webcam, each connecting from its own IP, so use loopback
+aliases (127.0.0.N) for a local run; -n writes such a configuration.
+
+The robots wander the fake_gvs.py random walk, which the webcam streams to the
+broker as W:color:x,y updates. Each robot says HELLO (H, waits for S), then
+keeps driving: when the walk puts another robot within reach it reports a
+collision (C) and, once partnered (R), swaps genes (G, then T); otherwise now
+and then it hits an obstacle (C, expecting O). When time is up the first robot
+sends D with its genes, which the broker pushes to everybody else; they read it
+as the reply to their next message.
+
+Reports message throughput, latency percentiles per message kind, and how many
+collisions with a robot in reach got no partner (failed pairings).
+
+With --encoding, robots ask for their G and T payloads to be delta encoded and
+compressed (gene_codec.py); the report then shows the gene bytes sent over the
+wire against the raw genes. Needs --framed, as does --arenas.
+
+With --batch-locations, the webcam sends every robot's location in one L
+frame per update, without waiting for a reply (needs --framed).
+
+With --offload, partnered robots have the broker breed their next generation:
+one N with their mother and father instead of G and T (needs --framed; a
+--local broker then breeds on one worker process per core).
+
+With --arenas K, K independent sessions (arena0..) run at once on the same
+addresses; every client names its arena in its HELLO, so it needs --framed.
+
+usage: load_generator.py (-f <configuration file> | -n <robots> [-w <write configuration>])
+                         [-a <host:port>] [-d <seconds>] [-r <webcam updates/s>] [-s <seed>]
+                         [--framed] [--compact-replies] [--local threads|asyncio] [--arenas <count>]
+                         [--image-size <width>x<height>] [--encoding] [--batch-locations] [--offload]
+'''
+
+import getopt
+import random
+import socket
+import sys
+import threading
+import time
+
+import communication_broker as broker
+import fake_gvs
+import framing
+import gene_codec
+
+CELL_SIZE = 100 # Webcam units per fake_gvs grid cell; neighbouring cells are within DISTANCE_THRESHOLD
+DRIVE_TIME = 0.05 # Seconds a robot drives between looking around
+OBSTACLE_CHANCE = 0.05 # Chance, when nobody is in reach, of running into an obstacle
+PHASES = ("H", "W", "C", "G", "T", "N", "D") # Latencies reported (H: HELLO to START, C: collision to R/O, ...)
+
+
+def usage():
+    print('usage: load_generator.py (-f <configuration file> | -n <robots> [-w <write configuration>])')
+    print('                         [-a <host:port>] [-d <seconds>] [-r <webcam updates/s>] [-s <seed>]')
+    print('                         [--framed] [--compact-replies] [--local threads|asyncio] [--arenas <count>]')
+    print('                         [--image-size <width>x<height>] [--encoding] [--batch-locations] [--offload]')
+
+# Configuration for robots robot0..robotN-1 on 127.0.0.2.. and the webcam on 127.0.0.1, as (color, ip) pairs
+def loopback_configuration(num_robots):
+
+    configuration = [("robot{}".format(i), "127.0.0.{}".format(i + 2)) for i in range(num_robots)]
+    configuration.append(("webcam", "127.0.0.1"))
+    return configuration
+
+def write_configuration(configuration, configuration_file):
+
+    with open(configuration_file, 'w') as f:
+        for color, ip in configuration:
+            f.write("{}:{}\n".format(color, ip))
+
+# Value at fraction (0..1) of a sorted list
+def percentile(values, fraction):
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+'''
+Client end of one broker connection, in either framing. In legacy mode the
+reply's first two bytes tell what follows: "X:" and gene_size bytes, or one of
+the plain words (Thanks, TRY AGAIN, DONE); with compact replies, O and R come
+alone. A framed S tells the image size, which sets gene_size.
+'''
+class BrokerConnection(object):
+
+    LEGACY_WORDS = {b"Th": (b"A", 4), b"TR": (b"X", 7), b"DO": (b"D", 2)} # First bytes -> (kind, bytes left)
+
+    def __init__(self, address, ip, framed=False, compact=False, gene_size=framing.GENE_SIZE):
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.bind((ip, 0))
+        self.sock.connect(address)
+        self.framed = framed
+        self.compact = compact
+        self.gene_size = gene_size
+        if framed:
+            self.sock.sendall(framing.MAGIC)
+
+    def send(self, kind, payload=b""):
+
+        if self.framed:
+            self.sock.sendall(framing.encode_frame(kind, payload))
+        elif kind in (b"G", b"T", b"D", b"W"):
+            self.sock.sendall(kind + b":" + payload)
+        else:
+            self.sock.sendall(kind)
+
+    # Next reply as (kind, payload); None once the broker hung up
+    def recv(self):
+
+        if self.framed:
+            header = self.recv_exactly(framing.HEADER.size)
+            if header is None:
+                return None
+            kind, length = framing.HEADER.unpack(header)
+            payload = self.recv_exactly(length)
+            if payload is None:
+                return None
+            if kind == b"S":
+                image_size, target_image = framing.decode_start(payload)
+                self.gene_size = framing.gene_size(image_size)
+            return (kind, payload)
+
+        start = self.recv_exactly(1)
+        if start is None:
+            return None
+        if self.compact and start in (b"O", b"R"):
+            return (start, b"")
+        rest = self.recv_exactly(1)
+        if rest is None:
+            return None
+        start += rest
+        if start in self.LEGACY_WORDS:
+            kind, left = self.LEGACY_WORDS[start]
+            return None if self.recv_exactly(left) is None else (kind, b"")
+        payload = self.recv_exactly(self.gene_size)
+        return None if payload is None else (start[:1], payload)
+
+    # Exactly n bytes, or None if the connection closed first (received in place, however it's split up)
+    def recv_exactly(self, n):
+
+        data = bytearray(n)
+        view = memoryview(data)
+        received = 0
+        while received < n:
+            chunk = self.sock.recv_into(view[received:])
+            if not chunk:
+                return None
+            received += chunk
+
+        return bytes(data)
+
+    # Send a message and wait for the reply; returns (reply, seconds it took)
+    def request(self, kind, payload=b""):
+
+        start = time.perf_counter()
+        self.send(kind, payload)
+        reply = self.recv()
+        return reply, time.perf_counter() - start
+
+    def close(self):
+        self.sock.close()
+
+
+'''
+The simulated arena: where every robot is on the fake_gvs grid, shared by the
+webcam (which moves them and reports it) and the robots (which look for
+somebody in reach before reporting a collision).
+'''
+class Arena(object):
+
+    def __init__(self, colors, size, rng):
+        self.size = size
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.locations = dict((color, (rng.randrange(size), rng.randrange(size))) for color in colors)
+
+    # Move every robot one step; returns their new locations
+    def iterate(self):
+        with self.lock:
+            for color in self.locations:
+                self.locations[color] = fake_gvs.random_step(self.locations[color], self.size, self.rng)
+            return dict(self.locations)
+
+    # Is another robot on a neighbouring cell (or the same one)?
+    def in_reach(self, color):
+        with self.lock:
+            x, y = self.locations[color]
+            for other, (ox, oy) in self.locations.items():
+                if other != color and abs(ox - x) <= 1 and abs(oy - y) <= 1:
+                    return True
+        return False
+
+
+class LoadGenerator(object):
+
+    def __init__(self, address, configuration, duration, webcam_rate, seed, framed, compact=False, arena=None, image_size=framing.IMAGE_SIZE,
+                 encoding=False, batch_locations=False, offload=False):
+
+        self.address = address
+        self.robots = [(color, ip) for color, ip in configuration if color != "webcam"]
+        self.webcam_ip = dict(configuration).get("webcam")
+        self.duration = duration
+        self.webcam_rate = webcam_rate
+        self.seed = seed
+        self.framed = framed
+        self.compact = compact
+        self.hello = b"" if arena is None else arena.encode() # HELLO payload: the arena's name, if any
+        self.gene_size = framing.gene_size(image_size) # What legacy robots assume; framed ones learn it from S
+        self.encoding = encoding # Ask for gene_codec encoded G and T payloads
+        self.batch_locations = batch_locations # Webcam sends one unacknowledged L with every location
+        self.offload = offload # Partnered robots send N (mother and father) and get their next generation back
+
+        rng = random.Random(seed)
+        grid = max(fake_gvs.GRID_SIZE, int(round(2 * len(self.robots) ** 0.5))) # Keep the arena about as crowded as the 10x10 demo
+        self.arena = Arena([color for color, ip in self.robots], grid, rng)
+
+        self.lock = threading.Lock()
+        self.latencies = dict((phase, []) for phase in PHASES)
+        self.messages = 0
+        self.exchanges = 0
+        self.obstacles = 0
+        self.failed_pairings = 0 # Collided with a robot in reach, got an obstacle reply
+        self.exchange_timeouts = 0 # Got our own genes back (the partner never sent theirs)
+        self.gene_bytes = 0 # Genes exchanged in G and T, both ways
+        self.wire_bytes = 0 # What they took on the wire
+        self.location_batches = 0 # L messages the webcam sent
+        self.errors = []
+
+        self.started = threading.Event() # Every robot got START
+        self.stopping = threading.Event() # Time's up; finish the current exchange
+        self.done = threading.Event() # The broker has the result
+        self.finished = threading.Barrier(len(self.robots)) # Every robot is done driving
+        self.result = None
+
+    def record(self, phase, latency, messages=1):
+        with self.lock:
+            self.latencies[phase].append(latency)
+            self.messages += messages
+
+    '''
+    Send genes in a G or T message and wait for the partner's (or, in N, for
+    our next generation); returns (their genes, seconds it took), or (None,
+    seconds) if the reply isn't kind.
+    '''
+    def swap(self, connection, codec, kind, genes):
+
+        payload = genes if codec is None else codec.encode(genes)
+        reply, latency = connection.request(kind, payload)
+        if reply is None or reply[0] != kind:
+            return None, latency
+
+        partner_genes = reply[1] if codec is None else codec.decode(reply[1])
+        with self.lock:
+            self.gene_bytes += len(genes) + len(partner_genes)
+            self.wire_bytes += len(payload) + len(reply[1])
+
+        return partner_genes, latency
+
+    def fail(self, who, what):
+        with self.lock:
+            self.errors.append("{}: {}".format(who, what))
+
+    # One simulated myRIO
+    def robot(self, index, color, ip):
+
+        rng = random.Random("{}:{}".format(self.seed, index))
+
+        try:
+            connection = BrokerConnection(self.address, ip, self.framed, self.compact, self.gene_size)
+        except OSError as err:
+            self.fail(color, err)
+            self.finished.abort()
+            return
+
+        try:
+            reply, latency = connection.request(b"H", self.hello)
+            if reply is None or reply[0] != b"S":
+                raise IOError("no START (got {})".format(reply and reply[0]))
+            self.record("H", latency)
+            genes = rng.randbytes(connection.gene_size)
+            father = rng.randbytes(connection.gene_size)
+
+            codec = None
+            if self.encoding:
+                reply, latency = connection.request(b"E", gene_codec.NAME.encode())
+                if reply is None or reply[0] != b"E":
+                    raise IOError("bad encoding reply")
+                if reply[1]:
+                    codec = gene_codec.GeneCodec()
+
+            self.started.wait()
+
+            while not self.stopping.is_set():
+                time.sleep(DRIVE_TIME)
+                partner_in_reach = self.arena.in_reach(color)
+                if not partner_in_reach and rng.random() >= OBSTACLE_CHANCE:
+                    continue
+
+                reply, latency = connection.request(b"C")
+                if reply is None or reply[0] not in (b"R", b"O"):
+                    raise IOError("bad collision reply {}".format(reply and reply[0]))
+                self.record("C", latency)
+
+                if reply[0] == b"O":
+                    with self.lock:
+                        self.obstacles += 1
+                        self.failed_pairings += partner_in_reach
+                    continue
+
+                # Partnered and offloading: the broker breeds us (and our partner, in the same job)
+                if self.offload:
+                    parents, latency = self.swap(connection, codec, b"N", genes + father)
+                    if parents is None or len(parents) != 2 * len(genes):
+                        raise IOError("bad N reply")
+                    self.record("N", latency)
+                    with self.lock:
+                        self.exchanges += 1
+                    genes, father = parents[:len(genes)], parents[len(genes):]
+                    continue
+
+                # Partnered: swap genes, then the second best child (a mutated copy of what we got)
+                partner_genes, latency = self.swap(connection, codec, b"G", genes)
+                if partner_genes is None:
+                    raise IOError("bad G reply")
+                self.record("G", latency)
+
+                child = bytearray(partner_genes)
+                child[rng.randrange(len(child))] = rng.getrandbits(8)
+                second_best_genes, latency = self.swap(connection, codec, b"T", bytes(child))
+                if second_best_genes is None:
+                    raise IOError("bad T reply")
+                self.record("T", latency)
+
+                with self.lock:
+                    self.exchanges += 1
+                    self.exchange_timeouts += partner_genes == genes
+                genes = bytes(child)
+
+            # Everybody stops driving; the first robot reports the result, the rest pick it up
+            self.finished.wait()
+            if index == 0:
+                self.result = genes
+                connection.send(b"D", genes)
+                connection.recv() # The broker hangs up once it has the result
+                self.done.set()
+            else:
+                self.done.wait()
+                reply, latency = connection.request(b"C")
+                if reply is None or reply[0] != b"D" or reply[1] != self.result:
+                    raise IOError("did not get the result")
+                self.record("D", latency)
+
+        except (IOError, threading.BrokenBarrierError, gene_codec.CodecError) as err:
+            self.fail(color, err)
+            self.finished.abort()
+            self.done.set()
+        finally:
+            connection.close()
+
+    # The simulated webcam: step the random walk and report every robot's location
+    def webcam(self):
+
+        try:
+            connection = BrokerConnection(self.address, self.webcam_ip, self.framed, gene_size=self.gene_size)
+        except OSError as err:
+            self.fail("webcam", err)
+            return
+
+        try:
+            if self.hello:
+                reply, latency = connection.request(b"H", self.hello)
+                if reply is None or reply[0] != b"A":
+                    raise IOError("arena {} refused the webcam".format(self.hello.decode()))
+            while not self.done.is_set():
+                start = time.perf_counter()
+                if self.batch_locations:
+                    self.send_locations(connection, self.arena.iterate())
+                    time.sleep(max(0.0, 1.0 / self.webcam_rate - (time.perf_counter() - start)))
+                    continue
+                for color, (x, y) in self.arena.iterate().items():
+                    reply, latency = connection.request(b"W", "{}:{},{}".format(color, x * CELL_SIZE, y * CELL_SIZE).encode())
+                    if reply is None or reply[0] not in (b"A", b"D"):
+                        raise IOError("bad location reply")
+                    self.record("W", latency)
+                    if reply[0] == b"D":
+                        return
+                time.sleep(max(0.0, 1.0 / self.webcam_rate - (time.perf_counter() - start)))
+        except IOError as err:
+            self.fail("webcam", err)
+        finally:
+            connection.close()
+
+    # Every robot's location in one L frame; there is no reply
+    def send_locations(self, connection, locations):
+
+        connection.send(b"L", "\n".join("{}:{},{}".format(color, x * CELL_SIZE, y * CELL_SIZE) for color, (x, y) in locations.items()).encode())
+        with self.lock:
+            self.location_batches += 1
+            self.messages += 1
+
+    # Run the whole session; returns its wall-clock time
+    def run(self):
+
+        threads = [threading.Thread(target=self.robot, args=(i, color, ip)) for i, (color, ip) in enumerate(self.robots)]
+        if self.webcam_ip is not None:
+            threads.append(threading.Thread(target=self.webcam))
+        for thread in threads:
+            thread.daemon = True
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        # Drive for duration seconds once every robot has its START
+        while len(self.latencies["H"]) < len(self.robots) and not self.errors:
+            time.sleep(0.01)
+        self.started.set()
+        time.sleep(self.duration)
+        self.stopping.set()
+
+        for thread in threads:
+            thread.join()
+
+        return time.perf_counter() - start
+
+    def report(self, elapsed):
+
+        print("{} robots, {:.1f}s: {} messages ({:.1f}/s), {} gene exchanges ({:.1f}/s)".format(
+            len(self.robots), elapsed, self.messages, self.messages / elapsed, self.exchanges, self.exchanges / elapsed))
+        print("collisions: {} paired, {} obstacles, {} failed pairings (robot in reach, no partner), {} exchange timeouts".format(
+            len(self.latencies["C"]) - self.obstacles, self.obstacles, self.failed_pairings, self.exchange_timeouts))
+        if self.location_batches:
+            print("locations: {} batches ({:.1f}/s), not acknowledged".format(self.location_batches, self.location_batches / elapsed))
+        if self.gene_bytes:
+            print("genes: {} bytes exchanged, {} on the wire ({:.1%})".format(self.gene_bytes, self.wire_bytes, self.wire_bytes / self.gene_bytes))
+
+        for phase in PHASES:
+            latencies = sorted(self.latencies[phase])
+            if latencies:
+                print("{:>2} {:6} replies  p50 {:8.2f}ms  p95 {:8.2f}ms  p99 {:8.2f}ms  max {:8.2f}ms".format(
+                    phase, len(latencies), *(1000.0 * percentile(latencies, f) for f in (0.5, 0.95, 0.99, 1.0))))
+
+        for error in self.errors:
+            print("error: {}".format(error))
+
+
+# myRIOs registry and robot count for a configuration, as read_configuration returns them
+def registry(configuration):
+
+    myRIOs = broker.robot_state.RobotRegistry()
+    for color, ip in configuration:
+        myRIOs.add(color, ip)
+
+    return myRIOs, len([color for color, ip in configuration if color != "webcam"])
+
+'''
+Start a broker in this process on an ephemeral loopback port; returns it (a
+communication_broker.Broker). It hosts the configuration as its default
+arena, or, given arena names, as each of those arenas.
+'''
+def start_local_broker(configuration, engine, compact_replies=False, arena_names=None, image_size=framing.IMAGE_SIZE, offload=None):
+
+    target_image = bytearray(framing.gene_size(image_size))
+
+    if not arena_names:
+        myRIOs, count = registry(configuration)
+        return broker.Broker(myRIOs, count, target_image, ('127.0.0.1', 0), engine, compact_replies, image_size, offload=offload).start()
+
+    local_broker = broker.Broker(address=('127.0.0.1', 0), engine=engine, compact_replies=compact_replies, image_size=image_size, offload=offload)
+    for name in arena_names:
+        myRIOs, count = registry(configuration)
+        local_broker.add_arena(name, myRIOs, count, target_image)
+
+    return local_broker.start()
+
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hf:n:w:a:d:r:s:", ["framed", "compact-replies", "local=", "arenas=", "image-size=", "encoding", "batch-locations", "offload"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    configuration = None
+    configuration_file = None
+    num_robots = None
+    address = ("localhost", 8080)
+    duration = 10.0
+    webcam_rate = 5.0
+    seed = 0
+    framed = False
+    compact = False
+    local = None
+    num_arenas = 0
+    image_size = framing.IMAGE_SIZE
+    encoding = False
+    batch_locations = False
+    offload = False
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt == '-f':
+            myRIOs, count = broker.read_configuration(arg)
+            configuration = [(color, myRIOs[color].ip) for color in myRIOs]
+        elif opt == '-n':
+            num_robots = int(arg)
+        elif opt == '-w':
+            configuration_file = arg
+        elif opt == '-a':
+            host, _, port = arg.rpartition(':')
+            address = (host or "localhost", int(port))
+        elif opt == '-d':
+            duration = float(arg)
+        elif opt == '-r':
+            webcam_rate = float(arg)
+        elif opt == '-s':
+            seed = int(arg)
+        elif opt == '--framed':
+            framed = True
+        elif opt == '--compact-replies':
+            compact = True
+        elif opt == '--local':
+            local = arg
+        elif opt == '--arenas':
+            num_arenas = int(arg)
+        elif opt == '--image-size':
+            image_size = broker.parse_image_size(arg)
+        elif opt == '--encoding':
+            encoding = True
+        elif opt == '--batch-locations':
+            batch_locations = True
+        elif opt == '--offload':
+            offload = True
+
+    if num_robots is not None:
+        configuration = loopback_configuration(num_robots)
+    if configuration is None or (local is not None and local not in broker.ENGINES) or ((num_arenas or encoding or batch_locations or offload) and not framed):
+        usage()
+        sys.exit(2)
+
+    if configuration_file is not None:
+        write_configuration(configuration, configuration_file)
+        print("Wrote {}; start the broker and this generator with -f {}".format(configuration_file, configuration_file))
+        sys.exit()
+
+    arena_names = ["arena{}".format(i) for i in range(num_arenas)]
+
+    local_broker = None
+    if local is not None:
+        local_broker = start_local_broker(configuration, local, compact, arena_names, image_size, 0 if offload else None)
+        address = local_broker.server_address
+
+    # One generator per arena (or just one, for the broker's default arena), all running at once
+    generators = [LoadGenerator(address, configuration, duration, webcam_rate, seed + i, framed, compact, name, image_size, encoding, batch_locations, offload)
+                  for i, name in enumerate(arena_names or [None])]
+    elapsed = [None] * len(generators)
+
+    def run(i):
+        elapsed[i] = generators[i].run()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(generators))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if local_broker is not None:
+        local_broker.stop()
+
+    for name, generator, seconds in zip(arena_names or [None], generators, elapsed):
+        if name is not None:
+            print("arena {}:".format(name))
+        generator.report(seconds)
+    sys.exit(1 if any(generator.errors for generator in generators) else 0)
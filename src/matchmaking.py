@@ -0,0 +1,80 @@
+'''
+Collision matchmaking for the Communication Broker
+A robot that reports a collision joins the queue; if a robot within range is
+already waiting there, both are paired on the spot. Otherwise it waits until
+a partner comes along or it gives up (and gets the obstacle reply).
+Pairings are handed out through concurrent.futures.Future so both broker
+engines can wait on them.
+'''
+
+import collections
+import threading
+import time
+from concurrent import futures
+
+
+class Matchmaker(object):
+
+    def __init__(self, locations, radius, make_exchange):
+        self.locations = locations # spatial_index.GridIndex of robot locations
+        self.radius = radius
+        self.make_exchange = make_exchange # Builds the object a new pair shares
+        self.waiting = {} # color -> future of a robot waiting for a partner
+        self.lock = threading.Lock()
+
+        # Metrics
+        self.started = time.time()
+        self.pairings = 0
+        self.obstacles = 0
+        self.latencies = collections.deque(maxlen=1000) # Recent collision-to-reply latencies (seconds)
+
+    '''
+    A robot collided. Returns a future that resolves to (partner color, shared
+    exchange) once it is paired; already resolved if a partner was waiting.
+    '''
+    def collide(self, color):
+
+        matched = futures.Future()
+
+        with self.lock:
+            for other in self.locations.nearby(color, self.radius):
+                if other in self.waiting:
+                    exchange = self.make_exchange()
+                    self.waiting.pop(other).set_result((color, exchange))
+                    matched.set_result((other, exchange))
+                    self.pairings += 1
+                    return matched
+
+            # Nobody around yet; wait for someone to collide near us
+            self.waiting[color] = matched
+
+        return matched
+
+    # Stop waiting for a partner; False if we got paired in the meantime (the future has the partner)
+    def cancel(self, color, matched):
+
+        with self.lock:
+            if self.waiting.get(color) is matched:
+                del self.waiting[color]
+                self.obstacles += 1
+                return True
+            return False
+
+    # Record how long a collision took to answer
+    def record(self, latency):
+        self.latencies.append(latency)
+
+    # Snapshot of the matchmaking metrics
+    def stats(self):
+
+        latencies = sorted(self.latencies)
+        stats = {
+            "pairings": self.pairings,
+            "obstacles": self.obstacles,
+            "waiting": len(self.waiting),
+            "pairings_per_second": self.pairings / max(time.time() - self.started, 1e-9),
+        }
+        for name, fraction in (("latency_p50", 0.5), ("latency_p95", 0.95), ("latency_max", 1.0)):
+            stats[name] = latencies[min(int(fraction * len(latencies)), len(latencies) - 1)] if latencies else None
+
+        return stats
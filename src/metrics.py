@@ -0,0 +1,287 @@
+'''
+Metrics for the Communication Broker
+Counters (messages per kind, bytes in and out) are always kept. Each
+connection counts its own in a ConnectionCounters, which only its handler
+(or, for sends, whoever holds the connection's lock) writes, so counting a
+message is a dict update with no lock; they are added up when scraped.
+Histograms (pairing latency, time spent in each handler
+state, time spent waiting) are the hot-path timing; they are only recorded
+while Registry.timing is on, which can be switched at runtime (stats port,
+SIGUSR1) to profile a running session.
+
+StatsServer serves them on a local HTTP port:
+
+ - GET /metrics: Prometheus text format
+ - GET /state: JSON snapshot of the arenas and their robots
+ - GET /timing: whether timing is on; POST /timing?enable=1 (or 0) switches it
+'''
+
+import bisect
+import http.server
+import json
+import threading
+import urllib.parse
+
+# Histogram buckets (seconds): from a reply sent straight away to a robot waiting out a timeout
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8" # Prometheus text exposition format
+
+
+# Label value as text (message kinds are bytes)
+def label_text(value):
+    return value.decode(errors='replace') if isinstance(value, (bytes, bytearray)) else str(value)
+
+# {name="value",...} for a sample, or nothing without labels
+def format_labels(names, values):
+
+    if not names:
+        return ""
+    pairs = ('{}="{}"'.format(name, label_text(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+# Sample value as Prometheus writes it
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+'''
+What one connection received and sent: messages by kind (bytes) and bytes,
+framing included.
+'''
+class ConnectionCounters(object):
+
+    __slots__ = ("received", "sent", "bytes_in", "bytes_out")
+
+    def __init__(self):
+        self.received = {}
+        self.sent = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    # Add other's counts to ours
+    def add(self, other):
+
+        for mine, theirs in ((self.received, dict(other.received)), (self.sent, dict(other.sent))):
+            for kind, count in theirs.items():
+                mine[kind] = mine.get(kind, 0) + count
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+
+
+'''
+A value read when the metrics are collected: function returns a number, or
+a dict of label values (tuples) to numbers. kind is "gauge" or, for totals
+kept elsewhere (the matchmakers'), "counter".
+'''
+class Gauge(object):
+
+    def __init__(self, name, description, function, labels=(), kind="gauge"):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.labels = tuple(labels)
+        self.kind = kind
+
+    def samples(self):
+
+        value = self.function()
+        if not isinstance(value, dict):
+            return [(self.name, (), (), value)]
+        return [(self.name, self.labels, key, value[key]) for key in sorted(value)]
+
+
+'''
+Bucketed observations (seconds), per combination of label values.
+'''
+class Histogram(object):
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {} # label values -> [counts per bucket (+Inf last), sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, values=()):
+
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(values)
+            if entry is None:
+                entry = self.values[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bucket] += 1
+            entry[1] += value
+
+    def samples(self):
+
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+
+        samples = []
+        for key, counts, total in sorted(values, key=lambda item: [label_text(v) for v in item[0]]):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((self.name + "_bucket", self.labels + ("le",), key + ("+Inf" if bound == float("inf") else repr(bound),), cumulative))
+            samples.append((self.name + "_sum", self.labels, key, total))
+            samples.append((self.name + "_count", self.labels, key, cumulative))
+
+        return samples
+
+
+class Registry(object):
+
+    def __init__(self, timing=False):
+        self.metrics = []
+        self.timing = timing # Record the histograms (hot-path timing)?
+
+    def gauge(self, name, description, function, labels=(), kind="gauge"):
+        return self.register(Gauge(name, description, function, labels, kind))
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    # Everything, in the Prometheus text format
+    def render(self):
+
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.description))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for name, labels, values, value in metric.samples():
+                lines.append("{}{} {}".format(name, format_labels(labels, values), format_value(value)))
+
+        return "\n".join(lines) + "\n"
+
+
+'''
+The broker's metrics. Engines count into their connections' counters (see
+open()) and record the histograms directly; the broker adds gauges for what
+it already keeps (connections, exchanges in progress, the matchmakers'
+totals).
+'''
+class BrokerMetrics(Registry):
+
+    def __init__(self, timing=False):
+
+        super().__init__(timing)
+
+        self.live = set() # ConnectionCounters of the open connections
+        self.closed = ConnectionCounters() # Everything the closed ones counted
+        self.lock = threading.Lock()
+
+        self.gauge("broker_messages_received_total", "Messages received, by kind", lambda: self.by_kind(self.totals().received), ("kind",), "counter")
+        self.gauge("broker_messages_sent_total", "Messages sent, by kind", lambda: self.by_kind(self.totals().sent), ("kind",), "counter")
+        self.gauge("broker_bytes_total", "Bytes received (in) and sent (out), framing included", self.bytes, ("direction",), "counter")
+
+        self.pairing = self.histogram("broker_pairing_seconds", "Time from a collision to its O or R reply (timing)")
+        self.state = self.histogram("broker_state_seconds", "Time a session spent in a handler state (timing)", ("state",))
+        self.waiting = self.histogram("broker_wait_seconds", "Time a session spent waiting (start barrier, partner, genes), by handler state (timing)", ("state",))
+
+    # Counters for a new connection, added up until close() and kept in the totals after
+    def open(self):
+
+        counters = ConnectionCounters()
+        with self.lock:
+            self.live.add(counters)
+
+        return counters
+
+    def close(self, counters):
+
+        with self.lock:
+            if counters in self.live:
+                self.live.discard(counters)
+                self.closed.add(counters)
+
+    # Everything counted so far (a ConnectionCounters)
+    def totals(self):
+
+        totals = ConnectionCounters()
+        with self.lock:
+            for counters in [self.closed] + list(self.live):
+                totals.add(counters)
+
+        return totals
+
+    def by_kind(self, counts):
+        return {(kind,): count for kind, count in counts.items()}
+
+    def bytes(self):
+        totals = self.totals()
+        return {("in",): totals.bytes_in, ("out",): totals.bytes_out}
+
+
+class StatsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/metrics":
+            self.reply(200, self.server.registry.render().encode(), CONTENT_TYPE)
+        elif path == "/state":
+            self.reply_json(self.server.state())
+        elif path == "/timing":
+            self.reply_json({"timing": self.server.registry.timing})
+        else:
+            self.reply(404, b"not found\n")
+
+    def do_POST(self):
+
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/timing":
+            self.reply(404, b"not found\n")
+            return
+
+        enable = urllib.parse.parse_qs(url.query).get("enable", ["1"])[-1]
+        self.server.registry.timing = enable.lower() not in ("0", "false", "off", "no")
+        self.reply_json({"timing": self.server.registry.timing})
+
+    def reply_json(self, value):
+        self.reply(200, (json.dumps(value, indent=1) + "\n").encode(), "application/json")
+
+    def reply(self, status, body, content_type="text/plain; charset=utf-8"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes aren't worth a log line each
+    def log_message(self, format, *args):
+        pass
+
+
+'''
+HTTP stats port: registry (a Registry) at /metrics, state() (anything
+json.dumps takes) at /state. start() serves from a background thread.
+'''
+class StatsServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, registry, state):
+        super().__init__(address, StatsHandler)
+        self.registry = registry
+        self.state = state
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="stats")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
@@ -0,0 +1,215 @@
+'''
+Session recording for the Communication Broker (communication_broker.py --record)
+Every frame a connection receives or sends is appended to a binary log, with
+its time and the connection it went through, so a session can be replayed
+later (replay.py) to reproduce a stall or measure the broker on real traffic.
+
+record() copies the payload and leaves it to a background writer
+(background.py), which packs a batch at a time into a buffered file and
+flushes it. Where records had to be dropped, a GAP record says how many, so a
+replay knows the session is not all there.
+
+The file is MAGIC followed by records: a RECORD header (time, connection,
+event, framing mode, kind, payload length), then the payload.
+
+ - ARENA (connection 0): an arena's settings as JSON, a newline, then its
+   target image; written for every arena when recording starts (or the arena
+   is added), so replay.py can set up the same sessions
+ - OPEN: a connection came in; the payload is its "ip:port"
+ - IN: a frame it received (the payload as received: encoded genes stay encoded)
+ - OUT: a message it was sent. The S, O and R replies come from the arena's
+   cache and are recorded without their payload (the target image)
+ - CLOSE: the connection is gone
+ - GAP (connection 0): records were dropped here; the payload is how many,
+   in decimal
+'''
+
+import collections
+import itertools
+import json
+import queue
+import struct
+import time
+
+import background
+import framing
+
+MAGIC = b"GABREC\x00\x01" # Broker recording, version 1
+RECORD = struct.Struct('>dIBBcI') # time, connection, event, mode, kind, payload length
+
+OPEN = 0
+IN = 1
+OUT = 2
+CLOSE = 3
+ARENA = 4
+GAP = 5
+EVENTS = {OPEN: "open", IN: "in", OUT: "out", CLOSE: "close", ARENA: "arena", GAP: "gap"}
+
+MODES = {None: 0, framing.LEGACY: 1, framing.FRAMED: 2} # Framing mode of the connection when recorded (None: not known yet)
+MODE_NAMES = {code: mode for mode, code in MODES.items()}
+
+NO_KIND = b"-" # Kind of the records that aren't messages
+
+BUFFER_SIZE = 1 << 20 # File buffer; records reach the disk a batch at a time anyway
+MAX_PENDING = 65536 # Records queued before new ones get dropped
+BATCH_SIZE = 1024 # Most records written per wakeup
+
+Record = collections.namedtuple("Record", ["time", "connection", "event", "mode", "kind", "payload"])
+
+
+class RecordingError(Exception):
+    pass
+
+
+# A GAP record (as queued) for count records dropped at when
+def gap_record(when, count):
+    return (when, 0, GAP, 0, NO_KIND, str(count).encode())
+
+
+class Recorder(background.BackgroundWriter):
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.file = open(filename, 'wb', buffering=BUFFER_SIZE)
+        self.file.write(MAGIC)
+        self.ids = itertools.count(1) # Connection numbers (0 is the broker itself)
+        self.gap = 0 # Records dropped since the last GAP record was queued
+        self.error = None # The write that failed, if one did
+
+        super().__init__("recorder", MAX_PENDING, BATCH_SIZE)
+
+    # Queue a record (payload is copied); False if it was dropped
+    def record(self, connection, event, mode, kind, payload=b""):
+
+        when = time.time()
+        if self.gap:
+            self.queue_gap(when)
+
+        if not self.queue((when, connection, event, MODES.get(mode, 0), kind, bytes(payload))):
+            with self.lock:
+                self.gap += 1
+            return False
+
+        return True
+
+    # Queue a GAP record for the records dropped since the last one, where they would have been
+    def queue_gap(self, when):
+
+        with self.lock:
+            if not self.gap:
+                return
+            try:
+                self.pending.put_nowait(gap_record(when, self.gap))
+            except queue.Full:
+                return
+            self.gap = 0
+
+    # Record a new connection from client_address; returns its ConnectionRecording
+    def open(self, client_address):
+
+        recording = ConnectionRecording(self, next(self.ids))
+        self.record(recording.id, OPEN, None, NO_KIND, "{}:{}".format(*client_address).encode())
+
+        return recording
+
+    # Record an arena's settings and target image (see communication_broker.Arena)
+    def arena(self, arena):
+
+        settings = {
+            "name": arena.name,
+            "image_size": list(arena.image_size),
+            "count": arena.COUNT,
+            "compact_replies": arena.compact_replies,
+            "robots": [[color, arena.myRIOs[color].ip] for color in arena.myRIOs],
+        }
+        self.record(0, ARENA, None, NO_KIND, json.dumps(settings).encode() + b"\n" + bytes(arena.target_image))
+
+    # Writer thread: pack a batch into the file and flush it; nothing more once a write failed (the file can't be trusted past it)
+    def write_batch(self, batch):
+
+        if self.error is not None:
+            self.write_failed(self.error, len(batch))
+            return
+
+        try:
+            for entry in batch:
+                self.file.write(RECORD.pack(*entry[:5], len(entry[5])))
+                self.file.write(entry[5])
+            self.file.flush()
+        except Exception as err:
+            self.error = err
+            self.write_failed(err, len(batch))
+            return
+
+        self.written += len(batch)
+
+    '''
+    Write what is still queued (and a GAP for what was dropped last), stop the
+    writer thread and close the file; False if the writer didn't finish in
+    time (the file is then left to it).
+    '''
+    def close(self, timeout=background.CLOSE_TIMEOUT):
+
+        if not super().close(timeout):
+            return False
+
+        if self.gap:
+            self.write_batch([gap_record(time.time(), self.gap)])
+            self.gap = 0
+        try:
+            self.file.close()
+        except OSError:
+            pass # Flushing what a failed write left in the buffer; counted already
+
+        return True
+
+
+'''
+What a Connection records through: its number in the recording, and the
+recorder.
+'''
+class ConnectionRecording(object):
+
+    __slots__ = ("recorder", "id")
+
+    def __init__(self, recorder, id):
+        self.recorder = recorder
+        self.id = id
+
+    def received(self, mode, frame):
+        self.recorder.record(self.id, IN, mode, frame.kind, frame.payload)
+
+    def sent(self, mode, kind, payload=b""):
+        self.recorder.record(self.id, OUT, mode, kind, payload)
+
+    def close(self):
+        self.recorder.record(self.id, CLOSE, None, NO_KIND)
+
+
+# Records of a recording file, in order; a truncated last record (the broker died mid-write) ends them
+def read(filename):
+
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise RecordingError("{} is not a broker recording".format(filename))
+
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            when, connection, event, mode, kind, length = RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield Record(when, connection, event, MODE_NAMES.get(mode), kind, payload)
+
+# Settings (dict) and target image of an ARENA record
+def decode_arena(record):
+
+    settings, _, target_image = record.payload.partition(b"\n")
+    return json.loads(settings.decode()), target_image
+
+# How many records a GAP record stands for
+def decode_gap(record):
+    return int(record.payload)
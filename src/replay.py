@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+
+'''
+Replay a recorded session (communication_broker.py --record, see recording.py)
+Sets up the recorded arenas on a broker in this process, then plays every
+recorded connection back from its own thread: each frame it received is sent
+again, at the recorded pace (or faster, or as fast as possible with -x 0), and
+the replies are read and checked against the recorded ones. Whatever the
+pace, frames are sent in the order they were received (a Sequencer holds
+each one back until every frame recorded before it went out and, where the
+broker had answered one before the next came in, got its answer), so the
+robots' collisions still come after the webcam updates that put them in
+reach of each other. A reply that doesn't come counts as missing, and the
+connection goes on with its next frame; a D the broker pushed is expected
+whenever it comes, not as the reply to one frame.
+
+Each connection connects from its recorded IP; when those aren't loopback
+addresses (a production recording), they are mapped onto 127.0.0.1.. in the
+order the arenas list them, so loopback aliases are needed as for
+load_generator.py.
+
+Reports how long the replay took, the reply latency per message kind, and
+how many replies differed from the recording (a pairing that came out
+differently, say) or never came. At the recorded pace, a stall shows up
+where it happened; as fast as possible, the broker's throughput on real
+traffic shows (a robot waiting out the pairing timeout holds up less, so
+more pairings may differ).
+
+Robots that offloaded their generations (N) need a broker that breeds them:
+'--offload <worker processes>' as for the broker.
+
+A recording the broker dropped records from (its writer fell behind) has
+gaps: frames are missing, so replies will differ for reasons that have
+nothing to do with the broker being replayed. replay.py refuses it unless
+given --allow-gaps.
+
+usage: replay.py [-x <speed>] [--engine threads|asyncio] [--stats-port <port>] [--offload <workers>] [--allow-gaps] <recording>
+'''
+
+import getopt
+import socket
+import sys
+import threading
+import time
+
+import communication_broker as broker
+import framing
+import load_generator
+import recording
+
+REPLY_SLACK = 2.0 # Seconds a reply may take beyond what it took when recorded, before it counts as missing
+SETTLE_TIME = 0.005 # Seconds the next step waits after one that gets no reply (L), so the broker has applied it
+KINDS = (b"H", b"W", b"E", b"C", b"G", b"T", b"N", b"D") # Latencies reported
+
+
+def usage():
+    print('usage: replay.py [-x <speed>] [--engine threads|asyncio] [--stats-port <port>] [--offload <workers>] [--allow-gaps] <recording>')
+
+
+'''
+One recorded message to send again: when it was received, and the kinds of
+the replies it got (and how long the first one took). If its first reply went
+out before the broker received the next message (of any connection), that
+message may depend on it (a C on the W that put its robot in reach): the
+next step then waits for the reply, not just for this one to be sent.
+'''
+class Step(object):
+
+    __slots__ = ("index", "time", "kind", "payload", "replies", "latency", "awaited")
+
+    def __init__(self, index, time, kind, payload):
+        self.index = index # Order it was received in, across all connections
+        self.time = time
+        self.kind = kind
+        self.payload = payload
+        self.replies = []
+        self.latency = 0.0
+        self.awaited = False # Answered before the next step came in
+
+
+'''
+Lets the steps go out in their recorded order: each connection waits for its
+step's turn, and says when it's done with it (sent, or answered if it is
+awaited) or that it will never send some.
+'''
+class Sequencer(object):
+
+    def __init__(self):
+        self.next = 0 # Index of the next step to send
+        self.skipped = set()
+        self.changed = threading.Condition()
+
+    def wait_turn(self, index):
+        with self.changed:
+            self.changed.wait_for(lambda: self.next >= index)
+
+    def done(self, index):
+        self.skip((index,))
+
+    # These steps won't be sent (their connection gave up)
+    def skip(self, indexes):
+
+        with self.changed:
+            self.skipped.update(indexes)
+            while self.next in self.skipped:
+                self.skipped.discard(self.next)
+                self.next += 1
+            self.changed.notify_all()
+
+
+class RecordedConnection(object):
+
+    def __init__(self, number, address, opened):
+        self.number = number
+        self.ip = address.rpartition(":")[0]
+        self.opened = opened
+        self.mode = None # Framing, from its first message
+        self.steps = []
+        self.pushed = 0 # D pushed to it (see connections.py): not a reply to any one step
+
+
+'''
+Arenas ((settings, target image) pairs) and connections (in the order they
+opened) of a recording; when it started; and how many records were dropped
+from it (see recording.GAP).
+'''
+def load(filename):
+
+    arenas = []
+    connections = {}
+    started = None
+    steps = 0
+    latest = None # Last step received, of any connection
+    dropped = 0
+
+    for record in recording.read(filename):
+        if started is None:
+            started = record.time
+
+        if record.event == recording.ARENA:
+            arenas.append(recording.decode_arena(record))
+
+        elif record.event == recording.GAP:
+            dropped += recording.decode_gap(record)
+
+        elif record.event == recording.OPEN:
+            connections[record.connection] = RecordedConnection(record.connection, record.payload.decode(), record.time)
+
+        elif record.connection in connections:
+            connection = connections[record.connection]
+            if record.event == recording.IN:
+                connection.mode = connection.mode or record.mode
+                latest = Step(steps, record.time, record.kind, record.payload)
+                connection.steps.append(latest)
+                steps += 1
+            elif record.event == recording.OUT and record.kind == b"D":
+                connection.pushed += 1
+            elif record.event == recording.OUT and connection.steps:
+                step = connection.steps[-1]
+                if not step.replies:
+                    step.latency = record.time - step.time
+                    step.awaited = step is latest
+                step.replies.append(record.kind)
+
+    return arenas, sorted(connections.values(), key=lambda connection: connection.opened), started, dropped
+
+# Recorded IP -> IP to replay it from: the same if they're all loopback, else 127.0.0.1.. in order
+def loopback_addresses(arenas, connections):
+
+    ips = []
+    for settings, target_image in arenas:
+        ips.extend(ip for color, ip in settings["robots"] if ip not in ips)
+    ips.extend(connection.ip for connection in connections if connection.ip not in ips)
+
+    if all(ip.startswith("127.") for ip in ips):
+        return {ip: ip for ip in ips}
+    return {ip: "127.0.0.{}".format(i + 1) for i, ip in enumerate(ips)}
+
+# A broker in this process hosting the recorded arenas (robots at their replay addresses)
+def start_broker(arenas, addresses, engine, stats_address=None, offload=None):
+
+    first = arenas[0][0]
+    local_broker = broker.Broker(address=('127.0.0.1', 0), engine=engine, compact_replies=first["compact_replies"],
+                                 image_size=tuple(first["image_size"]), stats_address=stats_address, offload=offload)
+
+    for settings, target_image in arenas:
+        myRIOs, count = load_generator.registry([(color, addresses[ip]) for color, ip in settings["robots"]])
+        local_broker.add_arena(settings["name"], myRIOs, settings["count"], bytearray(target_image), tuple(settings["image_size"]))
+
+    return local_broker.start()
+
+
+class Replay(object):
+
+    def __init__(self, address, arenas, connections, started, speed, addresses):
+
+        self.address = address
+        self.connections = connections
+        self.started = started
+        self.speed = speed
+        self.addresses = addresses
+
+        # Legacy clients need the gene size of their arena to read replies
+        self.gene_sizes = {}
+        for settings, target_image in arenas:
+            for color, ip in settings["robots"]:
+                self.gene_sizes.setdefault(ip, framing.gene_size(settings["image_size"]))
+        self.compact = arenas[0][0]["compact_replies"]
+
+        self.sequencer = Sequencer()
+        self.lock = threading.Lock()
+        self.latencies = {kind: [] for kind in KINDS}
+        self.sent = 0
+        self.diverged = 0
+        self.missing = 0
+        self.begin = None
+
+    # Sleep until a recorded time comes up in the replay (right away as fast as possible)
+    def wait_until(self, recorded):
+
+        if self.speed:
+            delay = self.begin + (recorded - self.started) / self.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    # Play one connection back
+    def client(self, recorded):
+
+        self.wait_until(recorded.opened)
+        try:
+            connection = load_generator.BrokerConnection(self.address, self.addresses[recorded.ip], recorded.mode == framing.FRAMED,
+                                                         self.compact, self.gene_sizes.get(recorded.ip, framing.GENE_SIZE))
+        except OSError as err:
+            print("connection {} ({}): {}".format(recorded.number, recorded.ip, err))
+            with self.lock:
+                self.missing += sum(len(step.replies) for step in recorded.steps) + recorded.pushed
+            self.sequencer.skip(step.index for step in recorded.steps)
+            return
+
+        left = 0 # Steps not done with yet (for the sequencer)
+        pushes = recorded.pushed # Pushed D still to come
+        try:
+            for i, step in enumerate(recorded.steps):
+                left = i
+                self.wait_until(step.time)
+                self.sequencer.wait_turn(step.index)
+                start = time.perf_counter()
+                try:
+                    connection.send(step.kind, step.payload)
+                    if not step.replies:
+                        time.sleep(SETTLE_TIME)
+                finally:
+                    if not step.awaited:
+                        self.sequencer.done(step.index)
+                        left = i + 1
+                with self.lock:
+                    self.sent += 1
+
+                alive, pushes = self.replies(connection, step, start, pushes)
+                if not alive:
+                    with self.lock:
+                        self.missing += sum(len(later.replies) for later in recorded.steps[i + 1:]) + pushes
+                    return
+                if step.awaited:
+                    self.sequencer.done(step.index)
+                    left = i + 1
+
+            missing = self.wait_pushes(connection, pushes)
+            with self.lock:
+                self.missing += missing
+        except OSError:
+            pass # The broker hung up (pushed D, then closed); whatever is left was never answered when recorded either
+        finally:
+            self.sequencer.skip(step.index for step in recorded.steps[left:])
+            connection.close()
+
+    '''
+    Read the replies to a step and compare them with the recorded ones, taking
+    any of the pushes (D) still to come on the way. A reply that doesn't come
+    in time counts as missing, with the rest of the step's, and the replay goes
+    on with the next step. Returns whether the broker is still there (if not, the step's
+    replies left count as missing) and the pushes still to come.
+    '''
+    def replies(self, connection, step, start, pushes):
+
+        j = 0
+        while j < len(step.replies):
+            connection.sock.settimeout(step.latency + REPLY_SLACK)
+            try:
+                reply = connection.recv()
+            except socket.timeout:
+                reply = False
+            if not reply:
+                with self.lock:
+                    self.missing += len(step.replies) - j
+                return reply is False, pushes
+
+            if reply[0] == b"D" and pushes:
+                pushes -= 1
+                continue
+
+            with self.lock:
+                if j == 0 and step.kind in self.latencies:
+                    self.latencies[step.kind].append(time.perf_counter() - start)
+                if reply[0] != step.replies[j]:
+                    self.diverged += 1
+            j += 1
+
+        return True, pushes
+
+    # Every step played: wait for the pushes (D) still to come; returns how many never did
+    def wait_pushes(self, connection, pushes):
+
+        connection.sock.settimeout(REPLY_SLACK)
+        while pushes:
+            try:
+                reply = connection.recv()
+            except socket.timeout:
+                reply = None
+            if reply is None:
+                break
+            if reply[0] == b"D":
+                pushes -= 1
+            else:
+                with self.lock:
+                    self.diverged += 1 # A reply the recording doesn't have
+
+        return pushes
+
+    # Play every connection back at once; returns the seconds it took
+    def run(self):
+
+        threads = [threading.Thread(target=self.client, args=(connection,)) for connection in self.connections]
+        self.begin = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return time.perf_counter() - self.begin
+
+    def report(self, elapsed):
+
+        print("replayed {} messages from {} connections in {:.2f}s ({:.0f} messages/s)".format(
+            self.sent, len(self.connections), elapsed, self.sent / max(elapsed, 1e-9)))
+        for kind in KINDS:
+            values = sorted(self.latencies[kind])
+            if values:
+                print(" {}  {:5d} replies  p50 {:8.2f}ms  p95 {:8.2f}ms  max {:8.2f}ms".format(
+                    kind.decode(), len(values), 1000 * load_generator.percentile(values, 0.5),
+                    1000 * load_generator.percentile(values, 0.95), 1000 * values[-1]))
+        print("{} replies differed from the recording, {} never came".format(self.diverged, self.missing))
+
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hx:", ["engine=", "stats-port=", "offload=", "allow-gaps"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    speed = 1.0
+    engine = "threads"
+    stats_address = None
+    offload = None
+    allow_gaps = False
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt == '-x':
+            speed = float(arg)
+        elif opt == '--engine':
+            engine = arg
+        elif opt == '--stats-port':
+            stats_address = ('127.0.0.1', int(arg))
+        elif opt == '--offload':
+            offload = int(arg)
+        elif opt == '--allow-gaps':
+            allow_gaps = True
+
+    if len(args) != 1 or engine not in broker.ENGINES or speed < 0 or (offload is not None and offload < 0):
+        usage()
+        sys.exit(2)
+
+    try:
+        arenas, connections, started, dropped = load(args[0])
+    except (IOError, recording.RecordingError) as err:
+        print(err)
+        sys.exit(2)
+    if not arenas:
+        print("{} has no arenas".format(args[0]))
+        sys.exit(2)
+    if dropped:
+        print("{} records were dropped from {}; replies will differ where they are missing".format(dropped, args[0]))
+        if not allow_gaps:
+            print("(replay it anyway with --allow-gaps)")
+            sys.exit(2)
+
+    addresses = loopback_addresses(arenas, connections)
+    local_broker = start_broker(arenas, addresses, engine, stats_address, offload)
+
+    replay = Replay(local_broker.server_address, arenas, connections, started, speed, addresses)
+    elapsed = replay.run()
+    local_broker.stop()
+
+    replay.report(elapsed)
@@ -0,0 +1,63 @@
+'''
+Per-robot state for the Communication Broker
+One RobotState (fixed __slots__, no per-instance dict) per configured myRIO
+(and the webcam), kept in a RobotRegistry that finds them by color or, when a
+connection comes in, by IP address.
+'''
+
+import threading
+
+
+class RobotState(object):
+
+    __slots__ = ("color", "ip", "location", "genes", "second_best_genes", "partner", "state", "lock")
+
+    def __init__(self, color, ip):
+        self.color = color
+        self.ip = ip
+        self.location = None # (x, y) where the webcam last saw the robot
+        self.genes = None # The robot's genes (preallocated buffer, forwarded as is)
+        self.second_best_genes = None # The robot's second best child's genes
+        self.partner = None # Color of the robot it is exchanging genes with
+        self.state = None # Handler state of its connection (INIT, DRIVE, ...), None when it isn't connected
+        self.lock = threading.Lock() # Held while several fields change together
+
+    # Traits worth displaying (no gene bytes)
+    def summary(self):
+        with self.lock:
+            return "color:{}\tip:{}\tlocation:{}\tpartner:{}".format(self.color, self.ip, self.location, self.partner)
+
+    # The same traits as a dict (for the stats port's JSON)
+    def snapshot(self):
+        with self.lock:
+            return {"ip": self.ip, "location": self.location, "partner": self.partner, "state": self.state}
+
+
+class RobotRegistry(object):
+
+    def __init__(self):
+        self.by_color = {}
+        self.by_ip = {}
+
+    # Register a robot; the first color configured for an IP is the one connections from it get
+    def add(self, color, ip):
+        robot = RobotState(color, ip)
+        self.by_color[color] = robot
+        self.by_ip.setdefault(ip, robot)
+        return robot
+
+    # Robot connecting from ip, or None if it isn't configured
+    def by_address(self, ip):
+        return self.by_ip.get(ip)
+
+    def __getitem__(self, color):
+        return self.by_color[color]
+
+    def __contains__(self, color):
+        return color in self.by_color
+
+    def __iter__(self):
+        return iter(self.by_color)
+
+    def __len__(self):
+        return len(self.by_color)
@@ -0,0 +1,56 @@
+'''
+Image snapshots for the Communication Broker
+Rather than opening a viewer for every gene exchange, the broker hands the
+genes to a SnapshotWriter, which saves them as PNG, BMP or PPM files from a
+background writer (background.py): BMP and PPM are written straight from the
+genes by image_codec, so they cost next to nothing; PNG has to be compressed.
+'''
+
+import os
+
+import background
+import framing
+import image_codec
+
+FORMATS = ("png", "bmp", "ppm")
+WRITERS = {"bmp": image_codec.write_bmp, "ppm": image_codec.write_ppm}
+MAX_PENDING = 1024 # Snapshots queued before new ones get dropped
+BATCH_SIZE = 64 # Most snapshots written per wakeup
+
+
+class SnapshotWriter(background.BackgroundWriter):
+
+    def __init__(self, directory, image_format="png", size=framing.IMAGE_SIZE):
+
+        self.directory = directory
+        self.image_format = image_format
+        self.size = size
+        self.count = 0 # Snapshots submitted (numbers the files)
+
+        os.makedirs(directory, exist_ok=True)
+        super().__init__("snapshots", MAX_PENDING, BATCH_SIZE)
+
+    # Queue a copy of genes (size pixels; the writer's size by default) to be saved as <number>_<label>; False if it was dropped
+    def submit(self, label, genes, size=None):
+
+        with self.lock:
+            self.count += 1
+            number = self.count
+
+        return self.queue((number, label, bytes(genes), tuple(size or self.size)))
+
+    # Writer thread: save a snapshot; False if its genes aren't size pixels
+    def write(self, snapshot):
+
+        number, label, genes, size = snapshot
+        width, height = size
+        if len(genes) != width * height * 3:
+            return False
+
+        filename = os.path.join(self.directory, "{:06d}_{}.{}".format(number, label, self.image_format))
+        if self.image_format in WRITERS:
+            WRITERS[self.image_format](filename, genes, size)
+        else:
+            image_codec.to_image(genes, size).save(filename)
+
+        return True
@@ -0,0 +1,77 @@
+'''
+Spatial index of robot locations for the Communication Broker
+Robots are bucketed into a grid of square cells as the webcam reports their
+locations, so "who is within this distance of me" only looks at the handful of
+cells around a robot instead of every robot in the arena.
+'''
+
+import math
+import threading
+
+
+class GridIndex(object):
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.locations = {} # key -> (x, y)
+        self.cells = {} # (column, row) -> set of keys in that cell
+        self.lock = threading.Lock()
+
+    def cell(self, x, y):
+        return (x // self.cell_size, y // self.cell_size)
+
+    # Move (or add) key to (x, y)
+    def update(self, key, x, y):
+
+        cell = self.cell(x, y)
+        with self.lock:
+            old = self.locations.get(key)
+            self.locations[key] = (x, y)
+            if old is not None:
+                old_cell = self.cell(*old)
+                if old_cell == cell:
+                    return
+                self.cells[old_cell].discard(key)
+                if not self.cells[old_cell]:
+                    del self.cells[old_cell]
+            self.cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+
+        with self.lock:
+            old = self.locations.pop(key, None)
+            if old is not None:
+                old_cell = self.cell(*old)
+                self.cells[old_cell].discard(key)
+                if not self.cells[old_cell]:
+                    del self.cells[old_cell]
+
+    # Last known (x, y) of key, or None
+    def location(self, key):
+        return self.locations.get(key)
+
+    # Other keys within radius of key, nearest first (empty if key has no location yet)
+    def nearby(self, key, radius):
+
+        with self.lock:
+            if key not in self.locations:
+                return []
+
+            x, y = self.locations[key]
+            column, row = self.cell(x, y)
+            reach = int(math.ceil(float(radius) / self.cell_size))
+            radius_squared = radius * radius
+
+            found = []
+            for c in range(column - reach, column + reach + 1):
+                for r in range(row - reach, row + reach + 1):
+                    for other in self.cells.get((c, r), ()):
+                        if other == key:
+                            continue
+                        ox, oy = self.locations[other]
+                        distance_squared = (ox - x) ** 2 + (oy - y) ** 2
+                        if distance_squared <= radius_squared:
+                            found.append((distance_squared, other))
+
+        found.sort()
+        return [other for distance_squared, other in found]
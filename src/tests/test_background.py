@@ -0,0 +1,74 @@
+'''
+Background writers: failed writes, close() on a writer that can't keep up, and the recording's gaps
+'''
+
+import threading
+
+import background
+import recording
+
+
+class ListWriter(background.BackgroundWriter):
+
+    def __init__(self, max_pending=4, batch_size=2):
+        self.items = []
+        self.release = threading.Event()
+        self.release.set()
+        super().__init__("test", max_pending, batch_size)
+
+    def write(self, item):
+        self.release.wait()
+        if item == "bad":
+            raise OSError("disk full")
+        self.items.append(item)
+        return item != "empty"
+
+
+def test_writes_in_order_and_counts():
+
+    writer = ListWriter(max_pending=10)
+    for item in ("a", "bad", "b", "empty", "c"):
+        assert writer.queue(item)
+    assert writer.close(1.0)
+    assert writer.items == ["a", "b", "empty", "c"]
+    assert (writer.written, writer.dropped, writer.failed) == (3, 1, 1)
+
+def test_drops_when_full():
+
+    writer = ListWriter()
+    writer.release.clear()
+    queued = sum(writer.queue(i) for i in range(20))
+    assert writer.dropped == 20 - queued
+    writer.release.set()
+    assert writer.close(1.0)
+    assert writer.written == queued
+
+def test_close_gives_up_on_a_stuck_writer():
+
+    writer = ListWriter()
+    writer.release.clear()
+    for i in range(20):
+        writer.queue(i)
+    assert not writer.close(0.1)
+    writer.release.set()
+
+
+def test_recording_marks_gaps(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(recording, "MAX_PENDING", 4)
+    filename = str(tmp_path / "session.rec")
+    recorder = recording.Recorder(filename)
+    write_batch = recorder.write_batch
+    release = threading.Event()
+    recorder.write_batch = lambda batch: (release.wait(), write_batch(batch))
+
+    for i in range(10):
+        recorder.record(1, recording.IN, None, b"H")
+    release.set()
+    assert recorder.close(1.0)
+
+    records = list(recording.read(filename))
+    gaps = [recording.decode_gap(record) for record in records if record.event == recording.GAP]
+    assert sum(gaps) == recorder.dropped > 0
+    assert len(records) == recorder.written
+    assert len(records) - len(gaps) == 10 - recorder.dropped
@@ -0,0 +1,93 @@
+'''
+FrameReader: legacy and framed messages, however the recv()s split or coalesce them
+'''
+
+import pytest
+
+import framing
+
+GENES = bytes(range(256)) * 6 # GENE_SIZE bytes, ':' included
+
+
+# Feed chunks one at a time, taking every complete frame after each; the frames (kind, payload bytes) and the reader
+def frames_of(*chunks):
+
+    reader = framing.FrameReader()
+    frames = []
+    for chunk in chunks:
+        reader.feed(chunk)
+        frame = reader.next_frame()
+        while frame is not None:
+            frames.append((frame.kind, bytes(frame.payload)))
+            frame = reader.next_frame()
+
+    return frames, reader
+
+# Every way of splitting data in two
+def splits(data):
+    return [(data[:i], data[i:]) for i in range(1, len(data))]
+
+# Every way of splitting data in two, except inside the digits after a location's comma (which read as a complete location)
+def location_splits(data):
+    return [(first, rest) for first, rest in splits(data) if not (first[-1:].isdigit() and b"," in first and rest[:1].isdigit())]
+
+
+def test_legacy_bare():
+    assert frames_of(b"HC")[0] == [(b"H", b""), (b"C", b"")]
+
+def test_legacy_genes_split_and_coalesced():
+    message = b"G:" + GENES
+    for chunks in splits(message + b"T:" + GENES):
+        assert frames_of(*chunks)[0] == [(b"G", GENES), (b"T", GENES)]
+
+def test_legacy_location_coalesced():
+    assert frames_of(b"W:red:12,34W:blue:-5,6H")[0] == [(b"W", b"red:12,34"), (b"W", b"blue:-5,6"), (b"H", b"")]
+
+def test_legacy_location_in_one_recv():
+
+    # The webcam waits for "Thanks": nothing follows a location, and it is taken right away
+    frames, reader = frames_of(b"W:red:12,34")
+    assert frames == [(b"W", b"red:12,34")]
+
+@pytest.mark.parametrize("chunks", location_splits(b"W:red:-12,-34"))
+def test_legacy_location_split(chunks):
+    assert frames_of(*chunks)[0] == [(b"W", b"red:-12,-34")]
+
+@pytest.mark.parametrize("first", [b"W", b"W:", b"W:red", b"W:red:", b"W:red:-", b"W:red:-12", b"W:red:-12,", b"W:red:-12,-"])
+def test_legacy_location_cut_off_waits(first):
+
+    frames, reader = frames_of(first)
+    assert frames == [] and reader.needed > 0
+    assert frames_of(first, b"W:red:-12,-34"[len(first):], b"H")[0] == [(b"W", b"red:-12,-34"), (b"H", b"")]
+
+def test_legacy_location_then_genes():
+    for chunks in location_splits(b"W:red:12,34G:" + GENES):
+        assert frames_of(*chunks)[0] == [(b"W", b"red:12,34"), (b"G", GENES)]
+
+def test_legacy_skips_stray_bytes():
+    assert frames_of(b"\r\nH\nC")[0] == [(b"H", b""), (b"C", b"")]
+
+
+def framed(*messages):
+    return framing.MAGIC + b"".join(framing.encode_frame(kind, payload) for kind, payload in messages)
+
+def test_framed_split_and_coalesced():
+
+    messages = [(b"H", b""), (b"G", GENES), (b"W", b"red:12,34"), (b"L", b"")]
+    data = framed(*messages)
+    assert frames_of(data)[0] == messages
+    for chunks in splits(data):
+        assert frames_of(*chunks)[0] == messages
+
+def test_framed_bytewise():
+    messages = [(b"G", GENES * 4), (b"C", b"")] # Bigger than the initial buffer
+    data = framed(*messages)
+    assert frames_of(*[data[i:i + 1] for i in range(len(data))])[0] == messages
+
+def test_framed_oversized_payload():
+    with pytest.raises(framing.ProtocolError):
+        frames_of(framing.MAGIC + framing.HEADER.pack(b"G", framing.MAX_PAYLOAD + 1))
+
+def test_bad_preamble():
+    with pytest.raises(framing.ProtocolError):
+        frames_of(b"\xffGAX")
@@ -0,0 +1,23 @@
+'''
+Generation history: one generation per exchange, whatever records it has
+'''
+
+import collections
+
+import history
+
+Arena = collections.namedtuple("Arena", ["name", "image_size", "target_image"])
+
+
+def test_generation_counts_exchanges(tmp_path):
+
+    writer = history.History(str(tmp_path), size=64 * 1024)
+    arena = writer.open(Arena("test", (4, 2), bytes(24)))
+    for kind in (b"G", b"T", b"N", b"G", b"T"):
+        assert arena.append(kind, "red", "blue", bytes(24))
+    arena.append(b"G", "blue", "red", bytes(24))
+    assert writer.close(1.0)
+
+    records = history.read(str(tmp_path / "test.history")).latest()
+    assert list(records["kind"]) == [b"G", b"T", b"N", b"G", b"T", b"G"]
+    assert list(records["generation"]) == [1, 1, 2, 3, 3, 1]
@@ -0,0 +1,148 @@
+'''
+The robot protocol end to end, against an in-process broker on loopback (both
+engines, both framings): two robots and the webcam of
+load_generator.loopback_configuration(2), so it needs the loopback addresses
+127.0.0.1-3 (Linux has them all).
+'''
+
+import threading
+import time
+from concurrent import futures
+
+import pytest
+
+import communication_broker as broker
+import framing
+import load_generator
+
+GENES = {"robot0": bytes(range(256)) * 6, "robot1": bytes(reversed(range(256))) * 6} # GENE_SIZE each, ':' included
+NEAR = {"robot0": (100, 100), "robot1": (150, 150)}
+FAR = {"robot0": (0, 0), "robot1": (5000, 5000)}
+
+
+class Session(object):
+
+    def __init__(self, engine, framed):
+
+        configuration = load_generator.loopback_configuration(2)
+        self.framed = framed
+        self.broker = load_generator.start_local_broker(configuration, engine)
+        self.clients = {color: load_generator.BrokerConnection(self.broker.server_address, ip, framed) for color, ip in configuration}
+        self.pool = futures.ThreadPoolExecutor(2)
+
+    def __getitem__(self, color):
+        return self.clients[color]
+
+    # Replies to kind messages the robots send at the same time (payloads by color; none by default)
+    def together(self, kind, payloads=None):
+
+        work = [self.pool.submit(self.clients[color].request, kind, (payloads or {}).get(color, b"")) for color in ("robot0", "robot1")]
+        return [w.result(timeout=10)[0] for w in work]
+
+    # Both robots say HELLO; returns their replies
+    def hello(self):
+        return self.together(b"H")
+
+    # The webcam reports the robots at locations
+    def move(self, locations):
+        for color, (x, y) in locations.items():
+            assert self.clients["webcam"].request(b"W", "{}:{},{}".format(color, x, y).encode())[0] == (b"A", b"")
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.broker.stop(1.0)
+        self.pool.shutdown()
+
+
+@pytest.fixture(params=[(engine, framed) for engine in broker.ENGINES for framed in (False, True)],
+                ids=lambda param: "{}-{}".format(param[0], "framed" if param[1] else "legacy"))
+def session(request, monkeypatch):
+
+    monkeypatch.setattr(broker, "PAIRING_TIMEOUT", 0.2)
+    session = Session(*request.param)
+    yield session
+    session.close()
+
+
+# Both robots partnered, near each other
+def partner(session):
+    session.hello()
+    session.move(NEAR)
+    assert [kind for kind, payload in session.together(b"C")] == [b"R", b"R"]
+
+
+def test_hello_gets_start(session):
+
+    target = bytes(framing.GENE_SIZE)
+    for kind, payload in session.hello():
+        assert kind == b"S"
+        if session.framed:
+            assert framing.decode_start(payload) == (framing.IMAGE_SIZE, target)
+        else:
+            assert payload == target
+
+def test_collision_alone_is_an_obstacle(session):
+
+    session.hello()
+    session.move(FAR)
+    reply, latency = session["robot0"].request(b"C")
+    assert reply[0] == b"O"
+
+def test_location_that_is_not_utf8(session):
+
+    # Thanked and ignored (no such robot); the webcam's connection carries on
+    reply, latency = session["webcam"].request(b"W", b"\xff\xfe:100,100")
+    assert reply == (b"A", b"")
+    session.move(NEAR)
+
+def test_partners_swap_genes(session):
+
+    partner(session)
+    assert session.together(b"G", GENES) == [(b"G", GENES["robot1"]), (b"G", GENES["robot0"])]
+    assert session.together(b"T", GENES) == [(b"T", GENES["robot1"]), (b"T", GENES["robot0"])]
+
+    # Back to driving: the next collision pairs them again
+    assert [kind for kind, payload in session.together(b"C")] == [b"R", b"R"]
+
+def test_done_is_pushed(session):
+
+    session.hello()
+    session["robot0"].send(b"D", GENES["robot0"])
+    assert session["robot1"].recv() == (b"D", GENES["robot0"])
+    assert session["webcam"].recv() == (b"D", b"")
+    assert session.broker.wait(5)
+
+def test_stop_drains_exchanges(session):
+
+    partner(session)
+    sent = session.pool.submit(session["robot0"].request, b"G", GENES["robot0"])
+    time.sleep(0.1) # robot0 waits on its partner's genes
+
+    stopping = threading.Thread(target=session.broker.stop, args=(5.0,))
+    stopping.start()
+    time.sleep(0.1)
+    assert stopping.is_alive() # Holding on for the exchange
+
+    assert session["robot1"].request(b"G", GENES["robot1"])[0] == (b"G", GENES["robot0"])
+    assert sent.result(timeout=5)[0] == (b"G", GENES["robot1"])
+    assert session.together(b"T", GENES) == [(b"T", GENES["robot1"]), (b"T", GENES["robot0"])]
+
+    stopping.join(5)
+    assert not stopping.is_alive()
+    for color in ("robot0", "robot1", "webcam"):
+        assert session[color].recv() is None
+
+def test_stop_hangs_up_on_waiting_robots(session):
+
+    session["robot0"].send(b"H") # robot1 never says HELLO, so no START
+    time.sleep(0.1)
+
+    started = time.perf_counter()
+    session.broker.stop(1.0)
+    assert time.perf_counter() - started < 5
+
+    # Woken by the stop, its session may get START out before the connection closes
+    reply = session["robot0"].recv()
+    if reply is not None:
+        assert reply[0] == b"S" and session["robot0"].recv() is None